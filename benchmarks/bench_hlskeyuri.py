@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+'''Benchmark of the AES-128 segment pipeline of hlskeyuri
+
+Serves synthetic encrypted playlists from a local HTTP server
+and reads them with KeyUriHLSStream and the stock HLSStream.
+Every case runs in a new process, for the peak RSS of the stream.
+
+    python benchmarks/bench_hlskeyuri.py
+    python benchmarks/bench_hlskeyuri.py --sizes 100K 1M --rotate 5 --playlists vod
+
+The IV of every segment is the media sequence number (num_to_iv),
+the key changes every --rotate segments. Broken cases use a https
+Key-URI on the http server, repaired with --hls-key-uri.
+Live cases add a new window of segments with every playlist reload,
+their MB/s includes the playlist reload time.
+'''
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+from Crypto.Cipher import AES
+from threading import Lock, Thread
+from time import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # python 2.7
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BROKEN_KEY_URI = 'http://${netloc}${path}${query}'
+
+
+def parse_size(value):
+    '''100K, 1M or 10M to bytes'''
+    match = re.match(r'^(\d+)([KM]?)$', value.upper())
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: {0}'.format(value))
+    return int(match.group(1)) * {'': 1, 'K': 1024, 'M': 1024 * 1024}[match.group(2)]
+
+
+def format_size(value):
+    if value >= 1024 * 1024:
+        return '{0}M'.format(value // (1024 * 1024))
+    return '{0}K'.format(value // 1024)
+
+
+def num_to_iv(n):
+    return bytes(bytearray((n >> (8 * (15 - i))) & 0xff for i in range(16)))
+
+
+class Case(object):
+    '''Encrypted segments of one benchmark case'''
+
+    def __init__(self, playlist, size, count, rotate, broken):
+        self.playlist = playlist
+        self.size = size
+        self.count = count
+        self.rotate = rotate
+        self.broken = broken
+        self.window = max(-(-count // 5), 1)
+
+        self.lock = Lock()
+        self.position = 0
+        self.key_requests = 0
+        self.segment_requests = 0
+
+        plain = bytes(bytearray(i % 251 for i in range(size)))
+        padding = 16 - size % 16
+        plain += bytes(bytearray([padding] * padding))
+        self.keys = [os.urandom(16) for i in range(-(-count // rotate))]
+        self.segments = [
+            AES.new(self.keys[num // rotate], AES.MODE_CBC, num_to_iv(num)).encrypt(plain)
+            for num in range(count)
+        ]
+
+    def name(self):
+        return '{0} {1} rotate={2}{3}'.format(
+            self.playlist, format_size(self.size), self.rotate,
+            ' broken' if self.broken else '')
+
+    def reset(self):
+        self.position = 0
+        self.key_requests = 0
+        self.segment_requests = 0
+
+    def m3u8(self, base_url):
+        if self.playlist == 'live':
+            with self.lock:
+                self.position = min(self.position + self.window, self.count)
+                first, last = max(self.position - self.window, 0), self.position
+        else:
+            first, last = 0, self.count
+
+        key_url = base_url.replace('http://', 'https://') if self.broken else base_url
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-TARGETDURATION:1',
+            '#EXT-X-MEDIA-SEQUENCE:{0}'.format(first),
+        ]
+        for num in range(first, last):
+            if num == first or num % self.rotate == 0:
+                lines.append('#EXT-X-KEY:METHOD=AES-128,URI="{0}key/{1}"'.format(
+                    key_url, num // self.rotate))
+            lines.extend(['#EXTINF:1.000,', '{0}.ts'.format(num)])
+        if last == self.count:
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+
+class BenchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), BenchHandler)
+        self.cases = {}
+
+    def url(self, case_id):
+        return 'http://127.0.0.1:{0}/{1}/'.format(self.server_port, case_id)
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        match = re.match(r'^/(\d+)/(index\.m3u8|key/(\d+)|(\d+)\.ts)', self.path)
+        case = match and self.server.cases.get(int(match.group(1)))
+        if not case:
+            self.send_error(404)
+            return
+
+        if match.group(3):
+            with case.lock:
+                case.key_requests += 1
+            data = case.keys[int(match.group(3))]
+        elif match.group(4):
+            with case.lock:
+                case.segment_requests += 1
+            data = case.segments[int(match.group(4))]
+        else:
+            data = case.m3u8(self.server.url(match.group(1))).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_stream(url, writer, broken, threads, decrypt_pool):
+    '''Reads the stream in this process and returns the result'''
+    from streamlink import Streamlink
+    from streamlink.stream import HLSStream
+    from plugins.hlskeyuri import HLSKeyUriPlugin, KeyUriHLSStream
+
+    session = Streamlink()
+    session.set_option('hls-live-restart', True)
+    session.set_option('hls-segment-threads', threads)
+    HLSKeyUriPlugin.set_option('key_uri', BROKEN_KEY_URI if broken else None)
+    HLSKeyUriPlugin.set_option('decrypt_pool', decrypt_pool)
+
+    stream_class = KeyUriHLSStream if writer == 'hlskeyuri' else HLSStream
+    size = 0
+    start = time()
+    fd = stream_class(session, url + 'index.m3u8').open()
+    try:
+        while True:
+            data = fd.read(1024 * 1024)
+            if not data:
+                break
+            size += len(data)
+    finally:
+        fd.close()
+
+    rss = None
+    if resource:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on mac
+        rss = rss if sys.platform == 'darwin' else rss * 1024
+    return {'bytes': size, 'seconds': time() - start, 'rss': rss}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', type=parse_size,
+                        default=[parse_size(s) for s in ('100K', '1M', '10M')],
+                        help='segment sizes, default is 100K 1M 10M')
+    parser.add_argument('--total', type=parse_size, default=parse_size('50M'),
+                        help='bytes of every case, default is 50M')
+    parser.add_argument('--rotate', type=int, default=5,
+                        help='new key every N segments, default is 5')
+    parser.add_argument('--playlists', nargs='+', choices=('vod', 'live'),
+                        default=['vod', 'live'])
+    parser.add_argument('--writers', nargs='+', choices=('hlskeyuri', 'hls'),
+                        default=['hlskeyuri', 'hls'])
+    parser.add_argument('--threads', type=int, default=1,
+                        help='--hls-segment-threads, default is 1')
+    parser.add_argument('--decrypt-pool', type=int, default=0,
+                        help='--hls-key-decrypt-pool of hlskeyuri, default is 0')
+    parser.add_argument('--run-stream', nargs=3, metavar=('URL', 'WRITER', 'BROKEN'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stream:
+        url, writer, broken = args.run_stream
+        print(json.dumps(run_stream(url, writer, broken == 'broken',
+                                    args.threads, args.decrypt_pool)))
+        return
+
+    server = BenchServer()
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    print('{0:<10} {1:<28} {2:>9} {3:>13} {4:>14}'.format(
+        'writer', 'case', 'MB/s', 'keys/segment', 'peak RSS MB'))
+    for playlist in args.playlists:
+        for size in args.sizes:
+            for broken in (False, True):
+                case = Case(playlist, size, max(args.total // size, args.rotate),
+                            args.rotate, broken)
+                case_id = len(server.cases)
+                server.cases[case_id] = case
+                for writer in args.writers:
+                    # the stock writer can't repair the Key-URI
+                    if broken and writer != 'hlskeyuri':
+                        continue
+
+                    case.reset()
+                    output = subprocess.check_output([
+                        sys.executable, os.path.abspath(__file__),
+                        '--threads', str(args.threads),
+                        '--decrypt-pool', str(args.decrypt_pool),
+                        '--run-stream', server.url(case_id), writer,
+                        'broken' if broken else 'ok',
+                    ])
+                    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+                    print('{0:<10} {1:<28} {2:>9.1f} {3:>13.3f} {4:>14}'.format(
+                        writer, case.name(),
+                        result['bytes'] / (1024.0 * 1024) / result['seconds'],
+                        case.key_requests / float(case.segment_requests or 1),
+                        '{0:.1f}'.format(result['rss'] / (1024.0 * 1024)) if result['rss'] else '-'))
+                del server.cases[case_id]
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''Benchmark of the playlist parsers of hlssession
+
+Compares the stock M3U8Parser with FastM3U8Parser on long media playlists,
+for the first load and for a reload with new segments at the end.
+
+    python benchmarks/bench_hlssession_parser.py
+    python benchmarks/bench_hlssession_parser.py --segments 10000 50000 --reloads 20
+'''
+import argparse
+import os
+import sys
+
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamlink.stream import hls_playlist  # noqa: E402
+from streamlink.stream.hls import Sequence  # noqa: E402
+
+from plugins.hlssession import CompactSequences, FastM3U8Parser  # noqa: E402
+
+BASE_URI = 'http://127.0.0.1/live/index.m3u8'
+
+
+def playlist(segments, key_rotate=0):
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        '#EXT-X-TARGETDURATION:6',
+        '#EXT-X-PLAYLIST-TYPE:EVENT',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+    ]
+    for num in range(segments):
+        if key_rotate and num % key_rotate == 0:
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="key/{0}"'.format(num // key_rotate))
+        if num % 100 == 0:
+            lines.append('#EXT-X-PROGRAM-DATE-TIME:2020-01-01T00:00:00.000Z')
+        lines.extend(['#EXTINF:6.000,', 'segment_{0}.ts'.format(num)])
+    return '\n'.join(lines) + '\n'
+
+
+def stock_parse(data):
+    m3u8 = hls_playlist.load(data, BASE_URI)
+    return [Sequence(m3u8.media_sequence + i, s) for i, s in enumerate(m3u8.segments)]
+
+
+def fast_parse(parser, data):
+    parser.base_uri = BASE_URI
+    m3u8 = parser.parse(data)
+    return CompactSequences(m3u8.segments, m3u8.media_sequence)
+
+
+def timed(func, *args):
+    start = time()
+    result = func(*args)
+    return time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', nargs='+', type=int, default=[1000, 10000, 50000],
+                        help='segments of the playlist, default is 1000 10000 50000')
+    parser.add_argument('--reloads', type=int, default=10,
+                        help='reloads with one new segment, default is 10')
+    parser.add_argument('--key-rotate', type=int, default=0,
+                        help='new EXT-X-KEY every N segments, default is no key')
+    args = parser.parse_args()
+
+    print('{0:>9} {1:>14} {2:>14} {3:>16} {4:>16}'.format(
+        'segments', 'stock load ms', 'fast load ms', 'stock reload ms', 'fast reload ms'))
+    for segments in args.segments:
+        data = playlist(segments + args.reloads, args.key_rotate)
+        # every reload has one more segment at the end
+        ends = []
+        for num in range(segments - 1, segments + args.reloads):
+            line = 'segment_{0}.ts\n'.format(num)
+            ends.append(data.index(line) + len(line))
+
+        stock_load, stock_sequences = timed(stock_parse, data[:ends[0]])
+        fast_parser = FastM3U8Parser()
+        fast_load, fast_sequences = timed(fast_parse, fast_parser, data[:ends[0]])
+        assert list(fast_sequences) == stock_sequences
+
+        stock_reload = fast_reload = 0
+        for end in ends[1:]:
+            stock_reload += timed(stock_parse, data[:end])[0]
+            fast_reload += timed(fast_parse, fast_parser, data[:end])[0]
+
+        print('{0:>9} {1:>14.1f} {2:>14.1f} {3:>16.1f} {4:>16.1f}'.format(
+            segments, stock_load * 1000, fast_load * 1000,
+            stock_reload * 1000 / args.reloads, fast_reload * 1000 / args.reloads))
+
+
+if __name__ == '__main__':
+    main()
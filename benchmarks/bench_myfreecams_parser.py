@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''Benchmark of the FCS message parser of myfreecams
+
+Compares the old regex parser of MyFreeCams._websocket_data with
+FCSFrameParser on the traffic of a guest login, followed by the
+session states of the room list and the user lookup.
+The traffic is generated in the format of a recorded session,
+every WebSocket frame has --frame-size bytes.
+Only the parsers are measured, unquote of the messages is the same for both.
+
+    python benchmarks/bench_myfreecams_parser.py
+    python benchmarks/bench_myfreecams_parser.py --models 500 5000 --frame-size 65536
+'''
+import argparse
+import json
+import os
+import re
+import sys
+
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamlink.compat import quote  # noqa: E402
+
+from plugins.myfreecams import FCSFrameParser  # noqa: E402
+
+_socket_re = re.compile(r'''(\w+) (\w+) (\w+) (\w+) (\w+)''')
+
+
+def fcs_message(fctype, sender, receiver, arg1, arg2, data=''):
+    message = '{0} {1} {2} {3} {4} {5}'.format(fctype, sender, receiver, arg1, arg2, data)
+    return '{0:04d}{1}'.format(len(message), message)
+
+
+def traffic(models, frame_size):
+    '''WebSocket frames of a guest login with the room list'''
+    messages = [
+        fcs_message(1, 0, 1234567, 0, 0, 'guest:guest'),
+        fcs_message(5, 0, 1234567, 0, 0, quote(json.dumps({'sid': 1234567, 'nm': 'Guest12345'}))),
+    ]
+    for i in range(models):
+        model = {
+            'lv': 4,
+            'nm': 'Model{0}'.format(i),
+            'sid': 100000 + i,
+            'uid': 20000000 + i,
+            'vs': (0, 90, 2, 12, 127)[i % 5],
+            'u': {'age': 20 + i % 30, 'camserv': 500 + i % 400, 'chat_bg': 0, 'country': '',
+                  'creation': 1300000000 + i, 'photos': i % 50, 'profile': 1},
+            'm': {'camscore': 1000.0 + i, 'continent': 'EU', 'flags': 1024, 'kbit': 0,
+                  'lastnews': 0, 'mg': 0, 'missmfc': 0, 'new_model': i % 2, 'rank': 0,
+                  'rc': i % 100, 'topic': quote('Hello from model {0}'.format(i))},
+        }
+        messages.append(fcs_message(20, 0, 0, model['sid'], 0, quote(json.dumps(model))))
+    messages.append(fcs_message(81, 0, 1234567, 0, 0, quote(json.dumps(
+        {'opts': 256, 'respkey': 123456789, 'serv': 1111, 'type': 14}))))
+    messages.append(fcs_message(10, 0, 1234567, 20, 0, quote(json.dumps(
+        {'nm': 'Model1', 'sid': 100001, 'uid': 20000001, 'vs': 0, 'u': {'camserv': 501}}))))
+
+    data = ''.join(messages)
+    return [data[i:i + frame_size] for i in range(0, len(data), frame_size)], len(messages)
+
+
+def regex_parse(frames):
+    '''The parser of MyFreeCams._websocket_data before FCSFrameParser
+
+    It lost the rest of a frame that didn't have 5 words,
+    the rest is kept here to compare the same messages.
+    '''
+    count = 0
+    buff = ''
+    for socket_buffer in frames:
+        socket_buffer = buff + socket_buffer
+        buff = ''
+        while True:
+            ws_answer = _socket_re.search(socket_buffer)
+            if bool(ws_answer) == 0:
+                buff = socket_buffer
+                break
+
+            FC = ws_answer.group(1)
+            int(FC[4:])
+
+            message_length = int(FC[0:4])
+            message = socket_buffer[4:4 + message_length]
+
+            if len(message) < message_length:
+                buff = ''.join(socket_buffer)
+                break
+
+            count += 1
+            socket_buffer = socket_buffer[4 + message_length:]
+
+            if len(socket_buffer) == 0:
+                break
+    return count
+
+
+def frame_parse(frames):
+    count = 0
+    parser = FCSFrameParser()
+    for frame in frames:
+        for fctype, message in parser.feed(frame):
+            count += 1
+    return count
+
+
+def timed(func, *args):
+    start = time()
+    result = func(*args)
+    return time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--models', nargs='+', type=int, default=[100, 1000, 5000],
+                        help='session states of the room list, default is 100 1000 5000')
+    parser.add_argument('--frame-size', type=int, default=16384,
+                        help='bytes of every WebSocket frame, default is 16384')
+    args = parser.parse_args()
+
+    print('{0:>7} {1:>9} {2:>10} {3:>10} {4:>14}'.format(
+        'models', 'messages', 'MB', 'regex ms', 'parser ms'))
+    for models in args.models:
+        frames, messages = traffic(models, args.frame_size)
+        regex_time, regex_count = timed(regex_parse, frames)
+        frame_time, frame_count = timed(frame_parse, frames)
+        assert regex_count == frame_count == messages
+
+        print('{0:>7} {1:>9} {2:>10.1f} {3:>10.1f} {4:>14.1f}'.format(
+            models, messages, sum(len(f) for f in frames) / (1024.0 * 1024),
+            regex_time * 1000, frame_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,13 @@ import json
 import logging
 import re
 
+from concurrent import futures
 from datetime import datetime
 from requests.utils import dict_from_cookiejar
-from threading import Thread, Timer
-from websocket import create_connection
+from select import select
+from threading import Event, Lock, Thread
+from time import time
+from websocket import ABNF, WebSocketTimeoutException, create_connection
 
 from streamlink.exceptions import PluginError
 from streamlink.plugin import Plugin, PluginArgument, PluginArguments
@@ -16,6 +19,235 @@ from streamlink.stream import RTMPStream
 log = logging.getLogger(__name__)
 
 
+class ControlScheduler(object):
+    '''One thread for the control WebSockets of every FC2 stream
+
+    Sends the heartbeats and reads the messages of all WebSockets
+    with select(), the number of threads stays the same
+    for any number of connected channels.
+
+    A read waits only read_timeout for the rest of a frame,
+    a partial frame stays in the frame buffer of its WebSocket
+    and is completed after the next select(),
+    a stalled WebSocket doesn't block the other WebSockets.
+    '''
+    heartbeat_interval = 30.0
+    # max. seconds until a new WebSocket is read
+    poll_interval = 0.2
+    # max. seconds of a read for the rest of a frame
+    read_timeout = 0.05
+    # max. seconds to receive the rest of a partial frame
+    recv_timeout = 10.0
+
+    lock = Lock()
+    thread = None
+    wakeup = Event()
+    connections = []
+
+    @classmethod
+    def add(cls, ws, heartbeat, on_message, on_close):
+        '''Read the messages of a WebSocket
+
+        heartbeat() returns the heartbeat message,
+        on_message(message) returns False to close the WebSocket,
+        on_close() is called once after the WebSocket is closed.
+        '''
+        ws.settimeout(cls.read_timeout)
+        connection = {
+            'ws': ws,
+            'heartbeat': heartbeat,
+            'on_message': on_message,
+            'on_close': on_close,
+            'next_heartbeat': 0,
+            # time of the first read of a partial frame
+            'partial': None,
+        }
+        with cls.lock:
+            cls.connections.append(connection)
+            if cls.thread is None:
+                cls.thread = Thread(target=cls.run, name='FC2ControlScheduler')
+                cls.thread.daemon = True
+                cls.thread.start()
+            cls.wakeup.set()
+        return connection
+
+    @classmethod
+    def close(cls, connection, error=None):
+        with cls.lock:
+            if connection not in cls.connections:
+                return
+            cls.connections.remove(connection)
+        if error is not None:
+            log.debug('WebSocket error: {0}'.format(error))
+        try:
+            connection['ws'].close()
+        except Exception:
+            pass
+        connection['on_close']()
+
+    @classmethod
+    def read(cls, connection):
+        ws = connection['ws']
+        while True:
+            try:
+                opcode, data = ws.recv_data(True)
+            except WebSocketTimeoutException:
+                if connection['partial'] is None:
+                    connection['partial'] = time()
+                return
+            except Exception as e:
+                cls.close(connection, e)
+                return
+            connection['partial'] = None
+            try:
+                if opcode == ABNF.OPCODE_CLOSE:
+                    cls.close(connection)
+                    return
+                if opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                    if opcode == ABNF.OPCODE_TEXT:
+                        data = data.decode('utf-8')
+                    if connection['on_message'](data) is False:
+                        cls.close(connection)
+                        return
+            except Exception as e:
+                cls.close(connection, e)
+                return
+            # a ssl socket can have data that select() doesn't know about
+            pending = getattr(ws.sock, 'pending', None)
+            if not (pending and pending()):
+                return
+
+    @classmethod
+    def run(cls):
+        while True:
+            with cls.lock:
+                connections = list(cls.connections)
+                if not connections:
+                    cls.wakeup.clear()
+            if not connections:
+                cls.wakeup.wait()
+                continue
+
+            now = time()
+            for connection in connections:
+                partial = connection['partial']
+                if partial is not None and now - partial > cls.recv_timeout:
+                    cls.close(connection, 'incomplete frame after {0:.0f}s'.format(now - partial))
+                    continue
+                if connection['next_heartbeat'] <= now:
+                    connection['next_heartbeat'] = now + cls.heartbeat_interval
+                    try:
+                        connection['ws'].send(connection['heartbeat']())
+                    except Exception as e:
+                        cls.close(connection, e)
+
+            socks = dict((c['ws'].sock, c) for c in connections
+                         if c in cls.connections and c['ws'].sock is not None)
+            try:
+                readable = select(list(socks), [], [], cls.poll_interval)[0]
+            except Exception:
+                # a WebSocket was closed by the server
+                readable = []
+                for connection in socks.values():
+                    if not connection['ws'].connected:
+                        cls.close(connection)
+            for sock in readable:
+                cls.read(socks[sock])
+
+
+class ControlClient(object):
+    '''One FC2 control WebSocket
+
+    Every client has its own message counters and host data,
+    many channels can be resolved at the same time,
+    the messages are read by the ControlScheduler.
+    '''
+    # chat messages of busy channels
+    ignored_names = ('comment', 'ng_commentq', 'user_count', 'ng_comment')
+    # ignored messages that start with the name are skipped without json.loads
+    _ignored_re = re.compile(
+        r'\s*\{\s*"name"\s*:\s*"(?:' + '|'.join(ignored_names) + ')"')
+
+    def __init__(self, ws_url):
+        self.ws_url = ws_url
+        self.connection = None
+        self.count = 0
+        self.count_ping = 0
+        self.host_data = None
+        # also set if the WebSocket is closed
+        self.host_event = Event()
+
+    def payload_msg(self, name):
+        ''' Format the WebSocket message '''
+        self.count_ping += 1
+        payload = json.dumps(
+            {
+                'name': str(name),
+                'arguments': {},
+                'id': int(self.count_ping)
+            }
+        )
+        return payload
+
+    def connect(self):
+        ws = create_connection(self.ws_url)
+        ws.send(self.payload_msg('get_media_server_information'))
+        self.connection = ControlScheduler.add(
+            ws, lambda: self.payload_msg('heartbeat'),
+            self.on_message, self.host_event.set)
+        return self
+
+    def close(self):
+        if self.connection is not None:
+            ControlScheduler.close(self.connection)
+
+    def on_message(self, message):
+        ''' print WebSocket messages '''
+        self.count += 1
+        if self._ignored_re.match(message):
+            return
+
+        data = json.loads(message)
+        if data['name'] not in self.ignored_names and log.isEnabledFor(logging.DEBUG):
+            time_utc = datetime.utcnow().strftime('%H:%M:%S UTC')
+            log.debug('{0} - {1} - {2}'.format(
+                time_utc, self.count, data['name']))
+
+        if (data['name'] == '_response_'
+                and data['arguments'].get('host')):
+            log.debug('Found host data')
+            self.host_data = data
+            self.host_event.set()
+        elif data['name'] == 'media_connection':
+            log.debug('successfully opened stream')
+        elif data['name'] == 'control_disconnection':
+            # also a User with points restricted program being broadcasted
+            if data.get('arguments').get('code') == 4512:
+                log.debug('Disconnected from Server')
+            return False
+        elif data['name'] == 'publish_stop':
+            log.debug('Stream ended')
+        elif data['name'] == 'channel_information':
+            if data['arguments'].get('fee') != 0:
+                log.error('Stream requires a fee now.')
+                return False
+        elif data['name'] == 'media_disconnection':
+            if data.get('arguments').get('code') == 104:
+                log.warning('Disconnected. '
+                            'Multiple connections has been detected.')
+            elif data.get('arguments').get('code'):
+                log.debug('error code {0}'.format(
+                    data['arguments']['code']))
+
+    def wait(self, timeout):
+        '''Returns the host data, None if the WebSocket was closed or timed out'''
+        host_timeout = not self.host_event.wait(timeout)
+        log.debug('host_timeout is {0}'.format(host_timeout))
+        if host_timeout:
+            self.close()
+        return self.host_data
+
+
 class FC2(Plugin):
 
     url_login = 'https://secure.id.fc2.com/?mode=login&switch_language=en'
@@ -47,11 +279,15 @@ class FC2(Plugin):
         }
     })
 
-    count = 0
-    count_ping = 0
+    # seconds to wait for the host data of the WebSocket
+    host_timeout = 30.0
 
-    host_data = ''
-    host_found = False
+    # member API data of every user_id: (expires, channel_data, user_data)
+    member_cache = {}
+    member_cache_lock = Lock()
+    member_cache_ttl = 300.0
+    # max. requests of channel_status at the same time
+    status_threads = 8
 
     arguments = PluginArguments(
         PluginArgument(
@@ -94,21 +330,85 @@ class FC2(Plugin):
 
         http.post(self.url_login, data=data, allow_redirects=True)
         cookies_list = self.save_cookies()
+        # user_data depends on the login
+        self.clear_member_cache()
 
         return self.cmp_cookies_list(cookies_list)
 
-    def _get_version(self, user_id):
+    @classmethod
+    def _get_member_data(cls, user_id):
+        '''channel_data and user_data of the member API, cached for member_cache_ttl'''
+        user_id = int(user_id)
+        with cls.member_cache_lock:
+            cached = cls.member_cache.get(user_id)
+        if cached and cached[0] > time():
+            return cached[1], cached[2]
+
         data = {
             'user': 1,
             'channel': 1,
             'profile': 1,
-            'streamid': int(user_id)
+            'streamid': user_id
         }
-        res = http.post(self.url_member_api, data=data)
-        res_data = http.json(res, schema=self._version_schema)
+        res = http.post(cls.url_member_api, data=data)
+        res_data = http.json(res, schema=cls._version_schema)
         channel_data = res_data['data']['channel_data']
         user_data = res_data['data']['user_data']
 
+        with cls.member_cache_lock:
+            now = time()
+            for key in [k for k, v in cls.member_cache.items() if v[0] <= now]:
+                del cls.member_cache[key]
+            cls.member_cache[user_id] = (now + cls.member_cache_ttl, channel_data, user_data)
+        return channel_data, user_data
+
+    @classmethod
+    def clear_member_cache(cls):
+        with cls.member_cache_lock:
+            cls.member_cache.clear()
+
+    @classmethod
+    def _get_control_server(cls, user_id, version):
+        data = {
+            'channel_id': user_id,
+            'channel_version': version,
+            'client_type': 'pc',
+            'client_app': 'browser'
+        }
+        res = http.post(cls.url_server, data=data)
+        return http.json(res)
+
+    @classmethod
+    def channel_status(cls, user_ids, threads=None):
+        '''Status of many channels, 'live', 'offline' or 'error' for every user_id
+
+        The member API data is cached, a cached channel needs
+        only one request, a following resolve of a live channel
+        doesn't use the member API again.
+        '''
+        def status(user_id):
+            try:
+                channel_data = cls._get_member_data(user_id)[0]
+                w_data = cls._get_control_server(user_id, channel_data['version'])
+            except Exception as e:
+                log.debug('Channel {0}: {1}'.format(user_id, e))
+                return 'error'
+            return 'offline' if w_data.get('status') == 11 else 'live'
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+
+        executor = futures.ThreadPoolExecutor(
+            max_workers=min(threads or cls.status_threads, len(user_ids)))
+        try:
+            return dict(zip(user_ids, executor.map(status, user_ids)))
+        finally:
+            executor.shutdown(wait=False)
+
+    def _get_version(self, user_id):
+        channel_data, user_data = self._get_member_data(user_id)
+
         if (channel_data['login_only'] != 0 and user_data['is_login'] != 1):
             raise PluginError('A login is required for this stream.')
 
@@ -121,29 +421,9 @@ class FC2(Plugin):
         log.debug('Found version: {0}'.format(version))
         return version
 
-    def payload_msg(self, name):
-        ''' Format the WebSocket message '''
-        self.count_ping += 1
-        payload = json.dumps(
-            {
-                'name': str(name),
-                'arguments': {},
-                'id': int(self.count_ping)
-            }
-        )
-        return payload
-
     def _get_ws_url(self, user_id, version):
         log.debug('_get_ws_url ...')
-        data = {
-            'channel_id': user_id,
-            'channel_version': version,
-            'client_type': 'pc',
-            'client_app': 'browser'
-        }
-
-        res = http.post(self.url_server, data=data)
-        w_data = http.json(res)
+        w_data = self._get_control_server(user_id, version)
         if w_data['status'] == 11:
             raise PluginError('The broadcaster is currently not available')
 
@@ -154,78 +434,8 @@ class FC2(Plugin):
 
     def _get_ws_data(self, ws_url):
         log.debug('_get_ws_data ...')
-        ws = create_connection(ws_url)
-        ws.send(self.payload_msg('get_media_server_information'))
-
-        def ws_ping():
-            ''' ping the WebSocket '''
-            if ws.connected is True:
-                t1 = Timer(30.0, ws_ping)
-                t1.daemon = True
-                t1.start()
-                ws.send(self.payload_msg('heartbeat'))
-
-        def ws_recv():
-            ''' print WebSocket messages '''
-            while True:
-                self.count += 1
-                data = json.loads(ws.recv())
-                time_utc = datetime.utcnow().strftime('%H:%M:%S UTC')
-                if data['name'] not in ['comment', 'ng_commentq',
-                                        'user_count', 'ng_comment']:
-                    log.debug('{0} - {1} - {2}'.format(
-                        time_utc, self.count, data['name']))
-
-                if (data['name'] == '_response_'
-                        and data['arguments'].get('host')):
-                    log.debug('Found host data')
-                    self.host_data = data
-                    self.host_found = True
-                elif data['name'] == 'media_connection':
-                    log.debug('successfully opened stream')
-                elif data['name'] == 'control_disconnection':
-                    if self.count <= 30:
-                        # User with points restricted program being broadcasted
-                        self.count = 30
-                    if data.get('arguments').get('code') == 4512:
-                        log.debug('Disconnected from Server')
-                    break
-                elif data['name'] == 'publish_stop':
-                    log.debug('Stream ended')
-                elif data['name'] == 'channel_information':
-                    if data['arguments'].get('fee') != 0:
-                        log.error('Stream requires a fee now.'.format(
-                            data['arguments'].get('fee')))
-                        break
-                elif data['name'] == 'media_disconnection':
-                    if data.get('arguments').get('code') == 104:
-                        log.warning('Disconnected. '
-                                    'Multiple connections has been detected.')
-                    elif data.get('arguments').get('code'):
-                        log.debug('error code {0}'.format(
-                            data['arguments']['code']))
-
-            ws.close()
-
-        # WebSocket background process
-        ws_ping()
-        t2 = Thread(target=ws_recv)
-        t2.daemon = True
-        t2.start()
-
-        # wait for the WebSocket
-        host_timeout = False
-        while self.host_found is False:
-            if self.host_found is True:
-                break
-            if self.count >= 30:
-                host_timeout = True
-                break
-
-        log.debug('host_timeout is {0}'.format(host_timeout))
-        if host_timeout:
-            return False
-        return True
+        client = ControlClient(ws_url).connect()
+        return client.wait(self.host_timeout)
 
     def _get_rtmp(self, data):
         log.debug('_get_rtmp ...')
@@ -265,6 +475,7 @@ class FC2(Plugin):
 
         if self.options.get('purge_credentials'):
             self.clear_cookies()
+            self.clear_member_cache()
             log.info('All credentials were successfully removed.')
 
         http.headers.update({
@@ -294,8 +505,9 @@ class FC2(Plugin):
 
         version = self._get_version(user_id)
         ws_url = self._get_ws_url(user_id, version)
-        if self._get_ws_data(ws_url):
-            return self._get_rtmp(self.host_data['arguments'])
+        host_data = self._get_ws_data(ws_url)
+        if host_data:
+            return self._get_rtmp(host_data['arguments'])
 
 
 __plugin__ = FC2
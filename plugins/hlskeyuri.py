@@ -1,24 +1,703 @@
 import logging
+import multiprocessing
 import re
+import tempfile
 
+from binascii import hexlify, unhexlify
+from collections import OrderedDict, deque
+from concurrent import futures
 from Crypto.Cipher import AES
+from functools import partial
+from threading import Condition, Event, Lock
+from time import time
 
 from streamlink import StreamError
-from streamlink.compat import urlparse
+from streamlink.cache import Cache
+from streamlink.compat import is_py3, urljoin, urlparse, urlunparse
 from streamlink.plugin import Plugin, PluginArgument, PluginArguments
 from streamlink.plugin.api import http
 from streamlink.plugin.api import useragents
 from streamlink.plugin.plugin import parse_url_params
 from streamlink.stream import HLSStream
-from streamlink.stream.hls import HLSStreamWriter, HLSStreamReader, num_to_iv
+from streamlink.stream.hls import (
+    HLSStreamReader, HLSStreamWriter, num_to_iv, pkcs7_decode,
+)
 from streamlink.utils import update_scheme
+from streamlink.utils.times import hours_minutes_seconds
 
 log = logging.getLogger(__name__)
 
 
+def key_uri_candidates(key_uri, playlist_url, unique=True):
+    '''Returns a list of (name, uri) of possible repaired Key-URIs'''
+    key = urlparse(key_uri)
+    playlist = urlparse(playlist_url)
+    basename = key.path.rsplit('/', 1)[-1]
+
+    schemes = [key.scheme or playlist.scheme]
+    schemes.append('http' if schemes[0] == 'https' else 'https')
+
+    candidates = []
+    for query_name, query in (('', key.query), (' without query', '')):
+        for scheme_name, scheme in zip(('', ' swapped scheme'), schemes):
+            candidates += [
+                ('key host' + scheme_name + query_name,
+                 urlunparse((scheme, key.netloc or playlist.netloc, key.path, '', query, ''))),
+                ('playlist host' + scheme_name + query_name,
+                 urlunparse((scheme, playlist.netloc, key.path, '', query, ''))),
+            ]
+        relative = urljoin(playlist_url, basename)
+        candidates.append(('relative to playlist' + query_name,
+                           relative + ('?{0}'.format(query) if query else '')))
+
+    if not unique:
+        return candidates
+
+    # remove duplicates, the first name is used
+    uris = set()
+    return [(name, uri) for name, uri in candidates
+            if not (uri in uris or uris.add(uri))]
+
+
+class KeyStore(Cache):
+    '''Keys of every hlskeyuri stream, stored on disk across restarts
+
+    Keys are stored by the original Key-URI with an expiration time,
+    the keys that expire first are removed if there are too many keys.
+    '''
+    lock = Lock()
+
+    def __init__(self, ttl, size):
+        Cache.__init__(self, filename='hlskeyuri-keys.json', key_prefix='hlskeyuri')
+        self.ttl = ttl
+        self.size = size
+
+    def get_key(self, key_uri):
+        with self.lock:
+            key_data = self.get(key_uri)
+        if key_data:
+            return unhexlify(key_data)
+
+    def set_key(self, key_uri, key_data):
+        with self.lock:
+            self._load()
+            self._prune()
+            self._cache['{0}:{1}'.format(self.key_prefix, key_uri)] = dict(
+                value=hexlify(key_data).decode('ascii'),
+                expires=time() + self.ttl)
+
+            keys = sorted(self._cache.items(), key=lambda item: item[1].get('expires', 0))
+            for key, value in keys[:max(len(keys) - self.size, 0)]:
+                self._cache.pop(key)
+            self._save()
+
+
+class DecryptPool(object):
+    '''Shared AES-128 decryption of every hlskeyuri stream
+
+    The threads are sized to the available cores,
+    the Crypto module releases the GIL while it decrypts.
+    Every stream waits for its oldest job if it has
+    queue_size jobs in the pool, so a busy stream can't starve the others.
+    '''
+    executor = None
+    lock = Lock()
+    # number of jobs in the pool for every writer, by KeyUriHLSStreamWriter.decrypt_pool_name
+    queue_depth = {}
+
+    @classmethod
+    def depth(cls, name):
+        with cls.lock:
+            return cls.queue_depth.get(name, 0)
+
+    @classmethod
+    def decrypt(cls, name, key_data, iv, data):
+        try:
+            return AES.new(key_data, AES.MODE_CBC, iv).decrypt(data)
+        finally:
+            with cls.lock:
+                cls.queue_depth[name] -= 1
+                if not cls.queue_depth[name]:
+                    del cls.queue_depth[name]
+
+    @classmethod
+    def submit(cls, name, key_data, iv, data):
+        '''Returns the number of jobs of name in the pool and the future'''
+        with cls.lock:
+            if cls.executor is None:
+                cls.executor = futures.ThreadPoolExecutor(
+                    max_workers=multiprocessing.cpu_count())
+            cls.queue_depth[name] = cls.queue_depth.get(name, 0) + 1
+            depth = cls.queue_depth[name]
+
+        return depth, cls.executor.submit(cls.decrypt, name, key_data, iv, data)
+
+
+class PrefetchBuffer(object):
+    '''Byte-bounded ring of reusable blocks for the segment prefetch
+
+    The downloads take their blocks from the ring and the writer
+    puts them back after they are written, the memory does not grow
+    with a slow reader. Only the segment that is written (head)
+    can take the last reserve blocks, other downloads wait
+    or spill into a temporary file.
+    '''
+    block_size = 64 * 1024
+    reserve = 2
+
+    def __init__(self, size, spill=False):
+        self.capacity = max(size // self.block_size, self.reserve + 1)
+        self.spill = spill
+        self.cond = Condition()
+        self.closed = False
+        self.free = []
+        self.head = None
+        self.used = 0
+
+        # stats
+        self.peak = 0
+        self.spilled = 0
+        self.waits = 0
+
+    def acquire(self, num, spill=False):
+        '''Returns a block for segment num,
+        None if the buffer is closed or the segment should spill.
+        '''
+        with self.cond:
+            waiting = False
+            while not self.closed:
+                if self.capacity - self.used > (0 if num == self.head else self.reserve):
+                    self.used += 1
+                    self.peak = max(self.peak, self.used)
+                    return self.free.pop() if self.free else bytearray(self.block_size)
+                if spill and num != self.head:
+                    return
+                if not waiting:
+                    waiting = True
+                    self.waits += 1
+                self.cond.wait(0.5)
+
+    def release(self, block):
+        with self.cond:
+            self.used -= 1
+            self.free.append(block)
+            self.cond.notify_all()
+
+    def set_head(self, num):
+        with self.cond:
+            self.head = num
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'size': self.capacity * self.block_size,
+                'used': self.used * self.block_size,
+                'peak': self.peak * self.block_size,
+                'spilled': self.spilled,
+                'waits': self.waits,
+            }
+
+
+class PrefetchResponse(object):
+    '''Response-like download of a segment into the PrefetchBuffer'''
+
+    def __init__(self, writer, sequence):
+        self.writer = writer
+        self.buffer = writer.prefetch_buffer
+        self.sequence = sequence
+        self.blocks = deque()
+        self.closed = False
+        self.cond = Condition()
+        self.done = False
+        self.res = None
+        self.spill_file = None
+        # IOError of the download, raised by iter_content after the last block,
+        # the writer downloads the rest of the segment again
+        self.error = None
+        self.started = Event()
+
+    def result(self, timeout=None):
+        '''Used like a future by the writer'''
+        if not self.started.wait(timeout):
+            raise futures.TimeoutError()
+        return self if self.res is not None else None
+
+    def put(self, block, length):
+        with self.cond:
+            if self.closed:
+                self.buffer.release(block)
+                return
+            self.blocks.append((block, length))
+            self.cond.notify_all()
+
+    def spill(self, data):
+        if self.spill_file is None:
+            log.debug('Spill segment {0} to disk', self.sequence.num)
+            self.spill_file = tempfile.TemporaryFile()
+        self.spill_file.write(data)
+        with self.buffer.cond:
+            self.buffer.spilled += len(data)
+
+    def run(self):
+        try:
+            self.res = self.writer.fetch(self.sequence, retries=self.writer.retries)
+        finally:
+            self.started.set()
+
+        if self.res is None:
+            return self.finish()
+
+        block, length = None, 0
+        try:
+            for chunk in self.res.iter_content(self.buffer.block_size):
+                data = memoryview(chunk)
+                while data and not (self.closed or self.writer.closed):
+                    if self.spill_file:
+                        self.spill(data)
+                        break
+                    if block is None:
+                        block = self.buffer.acquire(self.sequence.num, spill=self.buffer.spill)
+                        if block is None:
+                            if self.buffer.closed:
+                                return
+                            self.spill(data)
+                            break
+                        length = 0
+                    size = min(len(data), len(block) - length)
+                    block[length:length + size] = data[:size]
+                    length += size
+                    data = data[size:]
+                    if length == len(block):
+                        self.put(block, length)
+                        block = None
+                if self.closed or self.writer.closed:
+                    return
+        except IOError as err:
+            self.error = err
+        finally:
+            if block is not None:
+                self.put(block, length)
+            self.res.close()
+            self.finish()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+            closed = self.closed
+        if closed and self.spill_file:
+            self.spill_file.close()
+
+    def iter_content(self, chunk_size=None):
+        '''Yields the blocks while the segment is downloading,
+        every block is reused after the next block is requested.
+        '''
+        self.buffer.set_head(self.sequence.num)
+        try:
+            while True:
+                with self.cond:
+                    while not (self.blocks or self.done or self.writer.closed):
+                        self.cond.wait(0.5)
+                    if not self.blocks:
+                        break
+                    block, length = self.blocks.popleft()
+                try:
+                    yield memoryview(block)[:length] if is_py3 else block[:length]
+                finally:
+                    self.buffer.release(block)
+
+            if self.spill_file and not self.writer.closed:
+                self.spill_file.seek(0)
+                for data in iter(partial(self.spill_file.read, self.buffer.block_size), b''):
+                    yield data
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.close()
+
+    @property
+    def content(self):
+        return b''.join(bytes(chunk) for chunk in self.iter_content())
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            while self.blocks:
+                self.buffer.release(self.blocks.popleft()[0])
+            done = self.done
+        # the download closes the file if it is still running
+        if done and self.spill_file:
+            self.spill_file.close()
+
+
+class HedgedRequests(object):
+    '''Sends a duplicate request if a response takes longer than usual,
+    the first response is used and the other response is closed.
+
+    The threshold is a quantile of the recent response times,
+    only the given ratio of all requests can be a duplicate.
+    '''
+    history_size = 50
+    min_history = 10
+    quantile = 0.9
+
+    def __init__(self, ratio, threads):
+        self.ratio = ratio
+        self.executor = futures.ThreadPoolExecutor(max_workers=threads * 2)
+        self.history = deque(maxlen=self.history_size)
+        self.lock = Lock()
+
+        # stats
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+
+    def threshold(self):
+        with self.lock:
+            if len(self.history) < self.min_history:
+                return
+            times = sorted(self.history)
+        return times[min(int(len(times) * self.quantile), len(times) - 1)]
+
+    def hedge(self):
+        with self.lock:
+            if self.hedged + 1 > self.ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    @staticmethod
+    def close_response(future):
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            future.result().close()
+
+    def get(self, request):
+        '''Returns the first response of request(),
+        raises the last error if every request fails.
+        '''
+        start = time()
+        with self.lock:
+            self.requests += 1
+
+        pending = [self.executor.submit(request)]
+        threshold = self.threshold()
+        if threshold is not None:
+            done, not_done = futures.wait(pending, timeout=threshold)
+            if not_done and self.hedge():
+                log.debug('Hedged request after {0:.2f}s', threshold)
+                pending.append(self.executor.submit(request))
+
+        first = pending[0]
+        res, error = None, None
+        while pending and res is None:
+            done, not_done = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            pending = list(not_done)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as err:
+                    error = err
+                    continue
+                if result is None:
+                    continue
+                if res is None:
+                    res = result
+                    if future is not first:
+                        with self.lock:
+                            self.won += 1
+                else:
+                    result.close()
+
+        for future in pending:
+            future.add_done_callback(self.close_response)
+
+        if res is None:
+            if error is not None:
+                raise error
+            return
+
+        with self.lock:
+            self.history.append(time() - start)
+        return res
+
+    def close(self):
+        log.debug('Hedged requests: {0} of {1} requests, {2} won',
+                  self.hedged, self.requests, self.won)
+        self.executor.shutdown(wait=False)
+
+
 class KeyUriHLSStreamWriter(HLSStreamWriter):
+    # number of keys in the LRU cache
+    key_cache_size = 32
+    # min. bytes of a --hls-key-decrypt-pool job
+    decrypt_job_size = 256 * 1024
+
+    def __init__(self, *args, **kwargs):
+        HLSStreamWriter.__init__(self, *args, **kwargs)
+        self.key_cache = OrderedDict()
+        self.key_futures = {}
+        self.key_lock = Lock()
+
+        # reused for every segment
+        self.decrypt_carry = bytearray()
+        self.decrypt_output = bytearray()
+
+        # DecryptPool.queue_depth of this writer, two streams can have the same URL
+        self.decrypt_pool_name = id(self)
+        self.decrypt_queue_peak = 0
+
+        # --hls-key-uri auto
+        self.key_repair = None
+        self.key_repair_lock = Lock()
+        # Key-URI: (sequence, byte offset) of its first segment
+        self.key_samples = {}
+        # end of the last byte range of every segment URI, in playlist order
+        self.sample_offsets = {}
+
+        self.key_store = None
+        if HLSKeyUriPlugin.get_option('key_store'):
+            self.key_store = KeyStore(
+                int(HLSKeyUriPlugin.get_option('key_store_ttl') or 24 * 60 * 60),
+                HLSKeyUriPlugin.get_option('key_store_size') or 500)
+
+        self.prefetch_buffer = None
+        prefetch = HLSKeyUriPlugin.get_option('prefetch')
+        if prefetch:
+            self.prefetch_buffer = PrefetchBuffer(
+                (HLSKeyUriPlugin.get_option('prefetch_size') or 16) * 1024 * 1024,
+                HLSKeyUriPlugin.get_option('prefetch_spill') or False)
+            self.prefetch_executor = futures.ThreadPoolExecutor(max_workers=prefetch)
+
+        self.hedged_requests = None
+        if HLSKeyUriPlugin.get_option('hedge'):
+            self.hedged_requests = HedgedRequests(
+                HLSKeyUriPlugin.get_option('hedge'),
+                prefetch or self.session.options.get('hls-segment-threads'))
+
+    @property
+    def decrypt_queue_depth(self):
+        '''Jobs of this stream in the DecryptPool'''
+        return DecryptPool.depth(self.decrypt_pool_name)
+
+    def close(self):
+        if self.prefetch_buffer and not self.closed:
+            log.debug('Prefetch buffer: {peak} of {size} bytes, {spilled} bytes spilled, '
+                      '{waits} waits'.format(**self.prefetch_buffer.stats()))
+            self.prefetch_buffer.close()
+            self.prefetch_executor.shutdown(wait=False)
+        if self.hedged_requests and not self.closed:
+            self.hedged_requests.close()
+        HLSStreamWriter.close(self)
+
+    def repair_key_uri(self, key_uri):
+        '''Repair a broken key-uri with --hls-key-uri'''
+        if not HLSKeyUriPlugin.get_option('key_uri'):
+            return key_uri
+
+        if HLSKeyUriPlugin.get_option('key_uri') == 'auto':
+            if self.key_repair is None:
+                return key_uri
+            return dict(key_uri_candidates(key_uri, self.stream.url,
+                                           unique=False))[self.key_repair]
+
+        log.debug('Old Key-URI: {0}'.format(key_uri))
+        parsed_uri = urlparse(key_uri)
+        new_key_uri = HLSKeyUriPlugin.get_option('key_uri')
+        new_data_list = [
+            (r'\$\{scheme\}', '{0}://'.format(parsed_uri.scheme)),
+            (r'\$\{netloc\}', parsed_uri.netloc),
+            (r'\$\{path\}', parsed_uri.path),
+            (r'\$\{query\}', '?{0}'.format(parsed_uri.query)),
+        ]
+        for _at_re, _old_data in new_data_list:
+            new_key_uri = re.sub(_at_re, _old_data, new_key_uri)
+        log.debug('New Key-URI: {0}'.format(new_key_uri))
+        return new_key_uri
+
+    def sample_offset(self, sequence):
+        '''Returns the start of the byte range of a segment,
+        a byte range without offset continues after the last byte range of the same URI
+        '''
+        byterange = sequence.segment.byterange
+        if not byterange:
+            return 0
+
+        offset = byterange.offset
+        if offset is None:
+            offset = self.sample_offsets.get(sequence.segment.uri, 0)
+        self.sample_offsets[sequence.segment.uri] = offset + byterange.range
+        return offset
+
+    def fetch_sample(self, sequence, offset=0):
+        '''Returns the first encrypted block of a segment'''
+        request_params = dict(self.reader.request_params)
+        headers = dict(request_params.pop('headers', {}))
+        headers['Range'] = 'bytes={0}-{1}'.format(offset, offset + 15)
+
+        res = self.session.http.get(sequence.segment.uri,
+                                    exception=StreamError,
+                                    retries=self.retries,
+                                    headers=headers,
+                                    stream=True,
+                                    **request_params)
+        try:
+            return next(res.iter_content(16), b'')
+        finally:
+            res.close()
+
+    @staticmethod
+    def valid_key(key_data, block, iv):
+        '''Checks the decrypted first block for a MPEG-TS sync byte
+        or a fMP4 box type
+        '''
+        if len(key_data) != 16 or len(block) != 16:
+            return False
+
+        data = AES.new(key_data, AES.MODE_CBC, iv).decrypt(block)
+        return (bytearray(data)[0] == 0x47
+                or data[4:8] in (b'ftyp', b'styp', b'moof', b'sidx'))
+
+    def try_key_candidate(self, key_uri, block, iv):
+        try:
+            res = self.session.http.get(key_uri,
+                                        exception=StreamError,
+                                        **self.reader.request_params)
+        except StreamError as err:
+            log.debug('Invalid Key-URI {0}: {1}'.format(key_uri, err))
+            return None
+
+        if self.valid_key(res.content, block, iv):
+            return res.content
+        return None
+
+    def race_key_candidates(self, key_uri):
+        '''Fetches every Key-URI candidate at the same time,
+        the first key that decrypts a segment is used for the rest of the stream
+        '''
+        sequence, offset = self.key_samples.get(key_uri, (None, 0))
+        if sequence is None:
+            raise StreamError('No segment for Key-URI {0}'.format(key_uri))
+
+        key = sequence.segment.key
+        iv = key.iv or num_to_iv(sequence.num)
+        iv = b'\x00' * (16 - len(iv)) + iv
+        block = self.fetch_sample(sequence, offset)
+
+        candidates = key_uri_candidates(key_uri, self.stream.url)
+        log.debug('Trying {0} Key-URI candidates'.format(len(candidates)))
+        executor = futures.ThreadPoolExecutor(max_workers=len(candidates))
+        try:
+            pending = dict(
+                (executor.submit(self.try_key_candidate, uri, block, iv), (name, uri))
+                for name, uri in candidates)
+            for future in futures.as_completed(pending):
+                key_data = future.result()
+                if key_data is not None:
+                    name, uri = pending[future]
+                    log.info('Found Key-URI ({0}): {1}'.format(name, uri))
+                    self.key_repair = name
+                    return key_data
+        finally:
+            executor.shutdown(wait=False)
+
+        raise StreamError('No valid Key-URI found for {0}'.format(key_uri))
+
+    def fetch_key(self, key_uri):
+        if self.key_store:
+            key_data = self.key_store.get_key(key_uri)
+            if key_data:
+                log.debug('Found key in key store: {0}'.format(key_uri))
+                return key_data
+
+        key_data = None
+        if HLSKeyUriPlugin.get_option('key_uri') == 'auto':
+            with self.key_repair_lock:
+                if self.key_repair is None:
+                    key_data = self.race_key_candidates(key_uri)
+
+        if key_data is None:
+            res = self.session.http.get(self.repair_key_uri(key_uri),
+                                        exception=StreamError,
+                                        retries=self.retries,
+                                        **self.reader.request_params)
+            key_data = res.content
+
+        if self.key_store:
+            self.key_store.set_key(key_uri, key_data)
+        return key_data
+
+    def key_future(self, key_uri):
+        '''Returns a future of the key data, a new key is fetched in the background'''
+        with self.key_lock:
+            future = self.key_futures.get(key_uri)
+            if future is None:
+                log.debug('Fetching key: {0}'.format(key_uri))
+                future = self.executor.submit(self.fetch_key, key_uri)
+                self.key_futures[key_uri] = future
+            return future
+
+    def get_key(self, key_uri):
+        with self.key_lock:
+            key_data = self.key_cache.pop(key_uri, None)
+            if key_data is not None:
+                # most recently used
+                self.key_cache[key_uri] = key_data
+                return key_data
+
+        future = self.key_future(key_uri)
+        try:
+            key_data = future.result()
+        finally:
+            with self.key_lock:
+                self.key_futures.pop(key_uri, None)
+
+        with self.key_lock:
+            self.key_cache[key_uri] = key_data
+            while len(self.key_cache) > self.key_cache_size:
+                self.key_cache.popitem(last=False)
+        return key_data
+
+    def prefetch_key(self, key):
+        '''Fetches the key of a queued segment,
+        while the previous segments are still downloading
+        '''
+        if not key or key.method != 'AES-128' or not key.uri:
+            return
+
+        with self.key_lock:
+            if key.uri in self.key_cache:
+                return
+        self.key_future(key.uri)
+
+    def put(self, segment):
+        if segment is not None and not self.closed:
+            # put() is called in playlist order, unlike create_request_params()
+            offset = self.sample_offset(segment)
+            key = segment.segment.key
+            if key and key.uri and key.uri not in self.key_samples:
+                # the first segment of every key, used by --hls-key-uri auto
+                self.key_samples[key.uri] = (segment, offset)
+            self.prefetch_key(key)
+
+        if self.prefetch_buffer is None or segment is None or self.closed:
+            HLSStreamWriter.put(self, segment)
+            return
+
+        response = PrefetchResponse(self, segment)
+        self.prefetch_executor.submit(response.run)
+        self.queue(self.futures, (segment, response))
+
     def create_decryptor(self, key, sequence):
+        return AES.new(*self.decryptor_params(key, sequence))
 
+    def decryptor_params(self, key, sequence):
+        '''Returns (key_data, AES.MODE_CBC, iv) of a segment'''
         if key.method != 'AES-128':
             raise StreamError('Unable to decrypt cipher {0}', key.method)
 
@@ -27,25 +706,7 @@ class KeyUriHLSStreamWriter(HLSStreamWriter):
 
         if self.key_uri != key.uri:
             log.debug('Diff Key-URI')
-            new_key_uri = key.uri
-            if HLSKeyUriPlugin.get_option('key_uri'):
-                # Repair a broken key-uri
-                log.debug('Old Key-URI: {0}'.format(new_key_uri))
-                parsed_uri = urlparse(new_key_uri)
-                new_key_uri = HLSKeyUriPlugin.get_option('key_uri')
-                new_data_list = [
-                    (r'\$\{scheme\}', '{0}://'.format(parsed_uri.scheme)),
-                    (r'\$\{netloc\}', parsed_uri.netloc),
-                    (r'\$\{path\}', parsed_uri.path),
-                    (r'\$\{query\}', '?{0}'.format(parsed_uri.query)),
-                ]
-                for _at_re, _old_data in new_data_list:
-                    new_key_uri = re.sub(_at_re, _old_data, new_key_uri)
-                log.debug('New Key-URI: {0}'.format(new_key_uri))
-            res = self.session.http.get(new_key_uri, exception=StreamError,
-                                        retries=self.retries,
-                                        **self.reader.request_params)
-            self.key_data = res.content
+            self.key_data = self.get_key(key.uri)
             self.key_uri = key.uri
 
         iv = key.iv or num_to_iv(sequence)
@@ -53,7 +714,180 @@ class KeyUriHLSStreamWriter(HLSStreamWriter):
         # Pad IV if needed
         iv = b'\x00' * (16 - len(iv)) + iv
 
-        return AES.new(self.key_data, AES.MODE_CBC, iv)
+        return self.key_data, AES.MODE_CBC, iv
+
+    def fetch(self, sequence, retries=None):
+        if self.closed or not retries:
+            return
+
+        try:
+            # the same request params for a hedged request
+            request_params = self.create_request_params(sequence)
+            # skip ignored segment names
+            if self.ignore_names and self.ignore_names_re.search(sequence.segment.uri):
+                log.debug('Skipping segment {0}'.format(sequence.num))
+                return
+
+            def request():
+                return self.session.http.get(sequence.segment.uri,
+                                             timeout=self.timeout,
+                                             exception=StreamError,
+                                             retries=self.retries,
+                                             **request_params)
+
+            if self.hedged_requests:
+                return self.hedged_requests.get(request)
+            return request()
+        except StreamError as err:
+            log.error('Failed to open segment {0}: {1}', sequence.num, err)
+            return
+
+    def create_request_params(self, sequence):
+        request_params = HLSStreamWriter.create_request_params(self, sequence)
+        if self.prefetch_buffer:
+            # the segment is read by PrefetchResponse
+            request_params['stream'] = True
+        return request_params
+
+    def refetch(self, sequence, res):
+        '''Downloads the whole segment again with the byte range of res, None if it failed'''
+        # PrefetchResponse or requests.Response
+        request = getattr(getattr(res, 'res', res), 'request', None)
+        if request is not None and sequence.segment.byterange:
+            # create_request_params() would continue after the last byte range
+            request_params = dict(self.reader.request_params)
+            request_params['headers'] = dict(request_params.get('headers') or {},
+                                             Range=request.headers['Range'])
+        else:
+            request_params = HLSStreamWriter.create_request_params(self, sequence)
+        try:
+            return self.session.http.get(sequence.segment.uri,
+                                         timeout=self.timeout,
+                                         exception=StreamError,
+                                         retries=self.retries,
+                                         **request_params)
+        except StreamError as err:
+            log.error('Failed to open segment {0}: {1}'.format(sequence.num, err))
+            return None
+
+    def decrypt(self, decryptor, data, size):
+        '''Decrypts the first size bytes of data into self.decrypt_output'''
+        if len(self.decrypt_output) < size:
+            self.decrypt_output.extend(bytearray(size - len(self.decrypt_output)))
+
+        output = memoryview(self.decrypt_output)[:size]
+        try:
+            decryptor.decrypt(memoryview(data)[:size], output=output)
+        except TypeError:
+            # output is not supported by this Crypto version
+            return decryptor.decrypt(bytes(data[:size]))
+        return output
+
+    def write(self, sequence, res, chunk_size=64 * 1024):
+        if not (sequence.segment.key and sequence.segment.key.method != 'NONE'):
+            HLSStreamWriter.write(self, sequence, res, chunk_size)
+            return
+
+        try:
+            key_data, mode, iv = self.decryptor_params(sequence.segment.key,
+                                                       sequence.num)
+        except StreamError as err:
+            log.error('Failed to create decryptor: {0}', err)
+            res.close()
+            self.close()
+            return
+
+        decryptor = AES.new(key_data, mode, iv)
+        decrypt_pool = HLSKeyUriPlugin.get_option('decrypt_pool')
+        # jobs of this segment in the DecryptPool, in segment order
+        jobs = deque()
+
+        carry = self.decrypt_carry
+        del carry[:]
+        # encrypted bytes that are decrypted or in the DecryptPool
+        consumed = 0
+        chunks = res.iter_content(chunk_size)
+        retried = False
+        # the rest of the segment is dropped after a second read error
+        dropped = False
+        while True:
+            try:
+                for chunk in chunks:
+                    carry.extend(chunk)
+                    # holds back the last block and the garbage,
+                    # only the final block is unpadded
+                    size = ((len(carry) - 17) // 16) * 16
+                    if size <= 0:
+                        continue
+                    if not decrypt_pool:
+                        self.reader.buffer.write(self.decrypt(decryptor, carry, size))
+                        del carry[:size]
+                        consumed += size
+                    elif size >= self.decrypt_job_size:
+                        # CBC blocks only depend on the previous ciphertext block
+                        data = bytes(carry[:size])
+                        del carry[:size]
+                        consumed += size
+                        depth, job = DecryptPool.submit(self.decrypt_pool_name, key_data, iv, data)
+                        self.decrypt_queue_peak = max(self.decrypt_queue_peak, depth)
+                        jobs.append(job)
+                        iv = data[-16:]
+                        while jobs and (len(jobs) >= decrypt_pool or jobs[0].done()):
+                            self.reader.buffer.write(jobs.popleft().result())
+                break
+            except IOError as err:
+                res.close()
+                if retried:
+                    log.error('Failed to read segment {0}, dropping the rest '
+                              'after {1} bytes: {2}'.format(sequence.num, consumed, err))
+                    dropped = True
+                    break
+
+                # continue after the decrypted bytes, with the same CBC state
+                log.warning('Failed to read segment {0}, downloading it again: {1}'.format(
+                    sequence.num, err))
+                retried = True
+                res = self.refetch(sequence, res)
+                content = res and res.content
+                if not content or len(content) < consumed:
+                    log.error('Failed to read segment {0}, dropping the rest '
+                              'after {1} bytes'.format(sequence.num, consumed))
+                    dropped = True
+                    break
+                if consumed:
+                    iv = content[consumed - 16:consumed]
+                    decryptor = AES.new(key_data, mode, iv)
+                del carry[:]
+                chunks = (content[i:i + chunk_size]
+                          for i in range(consumed, len(content), chunk_size))
+            finally:
+                if res is not None:
+                    res.close()
+
+        if jobs:
+            log.debug('Segment {0} has {1} jobs in the decrypt pool, '
+                      'peak of this stream is {2}'.format(sequence.num, len(jobs),
+                                                          self.decrypt_queue_peak))
+            while jobs:
+                self.reader.buffer.write(jobs.popleft().result())
+        if dropped:
+            # the consumed bytes are written, the carry is not the end of the segment
+            return
+        if decrypt_pool:
+            decryptor = AES.new(key_data, mode, iv)
+
+        # If the input data is not a multiple of 16, cut off any garbage
+        garbage_len = len(carry) % 16
+        if garbage_len:
+            log.debug('Cutting off {0} bytes of garbage '
+                      'before decrypting', garbage_len)
+            del carry[-garbage_len:]
+
+        if carry:
+            decrypted_chunk = bytes(self.decrypt(decryptor, carry, len(carry)))
+            self.reader.buffer.write(pkcs7_decode(decrypted_chunk))
+
+        log.debug('Download of segment {0} complete', sequence.num)
 
 
 class KeyUriHLSStreamReader(HLSStreamReader):
@@ -89,6 +923,113 @@ class HLSKeyUriPlugin(Plugin):
 
               streamlink --hls-key-uri 'https://${netloc}${path}${query}'
 
+            Use auto to find the Key-URI, by trying different schemes,
+            the playlist host, with or without the query
+            and a path relative to the playlist:
+
+              streamlink --hls-key-uri auto
+
+            '''
+        ),
+        PluginArgument(
+            'key-store',
+            argument_name='hls-key-store',
+            action='store_true',
+            help='''
+            Store the keys on disk and reuse them after a restart,
+            the keys are stored by the original Key-URI.
+
+            Default is False.
+            '''
+        ),
+        PluginArgument(
+            'key-store-ttl',
+            argument_name='hls-key-store-ttl',
+            type=hours_minutes_seconds,
+            metavar='HH:MM:SS',
+            help='''
+            Time until a stored key expires.
+
+            Default is 24:00:00.
+            '''
+        ),
+        PluginArgument(
+            'key-store-size',
+            argument_name='hls-key-store-size',
+            type=int,
+            metavar='KEYS',
+            help='''
+            Max. number of stored keys,
+            the keys that expire first are removed.
+
+            Default is 500.
+            '''
+        ),
+        PluginArgument(
+            'decrypt-pool',
+            argument_name='hls-key-decrypt-pool',
+            type=int,
+            metavar='JOBS',
+            help='''
+            Decrypt the segments in a thread pool that is shared by
+            every stream and sized to the available cores,
+            a stream can have JOBS jobs in the pool.
+
+            Default is 0, the segments are decrypted by the stream.
+            '''
+        ),
+        PluginArgument(
+            'hedge',
+            argument_name='hls-key-hedge',
+            type=float,
+            metavar='RATIO',
+            help='''
+            Sends a duplicate segment request if the response takes longer
+            than 90% of the recent responses, the first response is used.
+
+            The ratio is the max. number of duplicate requests,
+            0.05 allows one duplicate request for 20 requests.
+
+            Default is Disabled.
+            '''
+        ),
+        PluginArgument(
+            'prefetch',
+            argument_name='hls-key-prefetch',
+            type=int,
+            metavar='DOWNLOADS',
+            help='''
+            Downloads the given number of segments at the same time
+            into a prefetch buffer of reusable blocks,
+            the memory stays the same for a slow reader.
+
+            The decrypted blocks of a segment are written while the
+            rest of the segment is still downloading, without it
+            a segment is downloaded completely before it is decrypted.
+
+            Default is Disabled.
+            '''
+        ),
+        PluginArgument(
+            'prefetch-size',
+            argument_name='hls-key-prefetch-size',
+            type=int,
+            metavar='MB',
+            help='''
+            Max. size of the prefetch buffer.
+
+            Default is 16.
+            '''
+        ),
+        PluginArgument(
+            'prefetch-spill',
+            argument_name='hls-key-prefetch-spill',
+            action='store_true',
+            help='''
+            Downloads into a temporary file if the prefetch buffer is full,
+            only the segment that is written waits for the buffer.
+
+            Default is False.
             '''
         ),
     )
@@ -1,24 +1,40 @@
 import argparse
+import calendar
 import logging
+import os
 import re
-
+import tempfile
+
+from array import array
+from bisect import bisect_right
+from collections import deque, namedtuple, OrderedDict
+from concurrent import futures
+from functools import partial
+from isodate import parse_datetime
+from threading import Condition, Event, Lock, Thread
 from time import time
 
 from streamlink import StreamError
+from streamlink.compat import is_py3, is_win32, queue, urljoin, urlparse
 from streamlink.plugin import Plugin, PluginArgument, PluginArguments
 from streamlink.plugin.api import http
 from streamlink.plugin.api import useragents
 from streamlink.plugin.plugin import parse_url_params
-from streamlink.stream import HLSStream
-from streamlink.stream.hls import HLSStreamWorker, HLSStreamReader
+from streamlink.stream import HLSStream, hls_playlist
+from streamlink.stream.hls import (
+    HLSStreamReader, HLSStreamWorker, HLSStreamWriter, Sequence,
+)
+from streamlink.stream.hls_playlist import M3U8, M3U8Parser, Segment
 from streamlink.utils import update_scheme
 from streamlink.utils.times import hours_minutes_seconds
 
-log = logging.getLogger(__name__)
-
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # python 2.7
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
-class TempData(object):
-    pass
+log = logging.getLogger(__name__)
 
 
 def num(type, min=None, max=None):
@@ -46,24 +62,1191 @@ def num(type, min=None, max=None):
     return func
 
 
+# EXT-X-PART
+Part = namedtuple('Part', 'segment independent gap')
+
+# EXT-X-SERVER-CONTROL
+ServerControl = namedtuple('ServerControl', 'can_block_reload can_skip_until '
+                                            'hold_back part_hold_back')
+
+
+class LowLatencyM3U8(M3U8):
+    def __init__(self):
+        M3U8.__init__(self)
+
+        self.part_target = None
+        self.server_control = None
+        self.skipped_segments = 0
+
+        # partial segments of a segment, by the index in self.segments
+        self.segment_parts = {}
+        # partial segments of the segment that is not completed yet
+        self.trailing_parts = []
+
+
+class LowLatencyM3U8Parser(M3U8Parser):
+    '''M3U8Parser with support for the Low-Latency HLS tags
+
+    - EXT-X-PART
+    - EXT-X-PART-INF
+    - EXT-X-SERVER-CONTROL
+    - EXT-X-SKIP
+    '''
+
+    def parse_float(self, value):
+        if value is None:
+            return None
+        return float(value)
+
+    def parse_part_byterange(self, value):
+        if not value:
+            return None
+
+        byterange = self.parse_byterange(value)
+        if byterange and '@' not in value:
+            # continue after the last byterange of the same uri
+            byterange = byterange._replace(offset=None)
+        return byterange
+
+    def parse_line(self, lineno, line):
+        if line.startswith('#EXT-X-PART-INF'):
+            attr = self.parse_tag(line, self.parse_attributes)
+            self.m3u8.part_target = self.parse_float(attr.get('PART-TARGET'))
+        elif line.startswith('#EXT-X-PART'):
+            attr = self.parse_tag(line, self.parse_attributes)
+            segment = Segment(self.uri(attr.get('URI')),
+                              self.parse_float(attr.get('DURATION')) or 0,
+                              None, self.state.get('key'), False,
+                              self.parse_part_byterange(attr.get('BYTERANGE')),
+                              None, self.state.get('map'))
+            part = Part(segment,
+                        self.parse_bool(attr.get('INDEPENDENT')),
+                        self.parse_bool(attr.get('GAP')))
+            self.state.setdefault('parts', []).append(part)
+        elif line.startswith('#EXT-X-SERVER-CONTROL'):
+            attr = self.parse_tag(line, self.parse_attributes)
+            self.m3u8.server_control = ServerControl(
+                self.parse_bool(attr.get('CAN-BLOCK-RELOAD')),
+                self.parse_float(attr.get('CAN-SKIP-UNTIL')),
+                self.parse_float(attr.get('HOLD-BACK')),
+                self.parse_float(attr.get('PART-HOLD-BACK')))
+        elif line.startswith('#EXT-X-SKIP'):
+            attr = self.parse_tag(line, self.parse_attributes)
+            self.m3u8.skipped_segments = int(attr.get('SKIPPED-SEGMENTS') or 0)
+        else:
+            segments = len(self.m3u8.segments)
+            M3U8Parser.parse_line(self, lineno, line)
+            if len(self.m3u8.segments) > segments:
+                self.m3u8.segment_parts[segments] = self.state.pop('parts', [])
+
+    def parse(self, data):
+        self.state = {}
+        self.m3u8 = LowLatencyM3U8()
+
+        for lineno, line in enumerate(filter(bool, data.splitlines())):
+            self.parse_line(lineno, line)
+
+        self.m3u8.trailing_parts = self.state.pop('parts', [])
+        # media playlists only, master playlists are not supported
+        self.m3u8.is_master = not not self.m3u8.playlists
+
+        return self.m3u8
+
+
+class CompactSegments(object):
+    '''Append-only segments of a media playlist in parallel arrays,
+    a Segment is only created when it is used.
+
+    Every view of the arrays has its own length, a playlist
+    that continues the last playlist shares the arrays of it.
+    '''
+    __slots__ = ('uris', 'durations', 'titles', 'dates', 'byteranges',
+                 'discontinuities', 'key_index', 'keys', 'map_index', 'maps',
+                 'names', 'duplicate', 'length')
+
+    def __init__(self):
+        self.uris = []
+        self.durations = array('d')
+        # values of a few segments, by index
+        self.titles = {}
+        self.dates = {}
+        self.byteranges = {}
+        self.discontinuities = set()
+        # index and value of every EXT-X-KEY and EXT-X-MAP change
+        self.key_index = [0]
+        self.keys = [None]
+        self.map_index = [0]
+        self.maps = [None]
+        # basenames of the uris and the index of the first duplicate
+        self.names = set()
+        self.duplicate = None
+        self.length = 0
+
+    def view(self):
+        view = CompactSegments.__new__(CompactSegments)
+        for name in self.__slots__:
+            setattr(view, name, getattr(self, name))
+        return view
+
+    @staticmethod
+    def basename(uri):
+        '''SegmentIndex.basename() of an uri'''
+        path = uri.split('#', 1)[0].split('?', 1)[0]
+        if ';' in path or '/' not in path.split('://', 1)[-1]:
+            return urlparse(uri).path.rsplit('/', 1)[-1]
+        return path.rsplit('/', 1)[-1]
+
+    def append(self, uri, duration, title, key, discontinuity, byterange, date, map_):
+        index = self.length
+        self.uris.append(uri)
+        self.durations.append(duration)
+        if title is not None:
+            self.titles[index] = title
+        if date is not None:
+            self.dates[index] = date
+        if byterange is not None:
+            self.byteranges[index] = byterange
+        if discontinuity:
+            self.discontinuities.add(index)
+        if key is not self.keys[-1]:
+            self.key_index.append(index)
+            self.keys.append(key)
+        if map_ is not self.maps[-1]:
+            self.map_index.append(index)
+            self.maps.append(map_)
+
+        name = self.basename(uri)
+        if self.duplicate is None and name in self.names:
+            self.duplicate = index
+        self.names.add(name)
+        self.length = index + 1
+
+    @property
+    def unique_names(self):
+        return self.duplicate is None or self.duplicate >= self.length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('segment index out of range')
+        return Segment(self.uris[index], self.durations[index],
+                       self.titles.get(index),
+                       self.keys[bisect_right(self.key_index, index) - 1],
+                       index in self.discontinuities,
+                       self.byteranges.get(index), self.dates.get(index),
+                       self.maps[bisect_right(self.map_index, index) - 1])
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+
+class CompactSequences(object):
+    '''Sequences of CompactSegments, a Sequence is only created when it is used'''
+    __slots__ = ('segments', 'first')
+
+    def __init__(self, segments, first):
+        self.segments = segments
+        self.first = first
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return Sequence(self.first + index, self.segments[index])
+
+    def __iter__(self):
+        return self.iter_from(self.first)
+
+    def __reversed__(self):
+        for index in range(len(self) - 1, -1, -1):
+            yield self[index]
+
+    def index(self, num):
+        '''Number of sequences before num'''
+        return min(max(num - self.first, 0), len(self))
+
+    def iter_from(self, num):
+        for index in range(self.index(num), len(self)):
+            yield Sequence(self.first + index, self.segments[index])
+
+    @property
+    def unique_names(self):
+        return self.segments.unique_names
+
+
+class FastM3U8Parser(M3U8Parser):
+    '''M3U8Parser for long media playlists, used for every reload
+
+    - the lines are tokenized lazily
+    - the segments are stored in CompactSegments
+    - a playlist that starts with the segments of the last playlist,
+      only parses the lines after them
+    '''
+    # max. number of cached EXTINF lines
+    extinf_cache_size = 1000
+
+    def __init__(self, base_uri=None):
+        M3U8Parser.__init__(self, base_uri)
+        self.extinf_cache = {}
+        # base_uri, text, m3u8 attributes and state of the last playlist,
+        # until the end of its last segment
+        self.prefix = None
+        self.segments = None
+        self.uri_prefix = None
+
+    @staticmethod
+    def iter_lines(data, start=0):
+        '''Yields the end and the line of every line that is not empty'''
+        length = len(data)
+        while start < length:
+            end = data.find('\n', start)
+            if end < 0:
+                end = length
+            line = data[start:end]
+            start = end + 1
+            if line.endswith('\r'):
+                line = line[:-1]
+            if line:
+                yield start, line
+
+    @staticmethod
+    def last_segment_end(data):
+        '''End of the last uri line, as yielded by iter_lines()'''
+        end = len(data)
+        while end >= 0:
+            start = data.rfind('\n', 0, end) + 1
+            line = data[start:end]
+            if line.endswith('\r'):
+                line = line[:-1]
+            if line and line[0] != '#':
+                return end + 1
+            end = start - 1
+        return 0
+
+    def segment_uri(self, uri):
+        if uri.startswith(('http://', 'https://')):
+            return uri
+        # a plain filename, same as urljoin()
+        if (self.uri_prefix and uri[0] != '?' and uri not in ('.', '..')
+                and '/' not in uri and ':' not in uri and '#' not in uri):
+            return self.uri_prefix + uri
+        return self.uri(uri)
+
+    def parse_line(self, lineno, line):
+        if lineno and line[0] != '#':
+            state = self.state
+            if state.pop('expect_segment', None):
+                extinf = state.pop('extinf', (0, None))
+                self.segments.append(self.segment_uri(line), extinf[0], extinf[1],
+                                     state.get('key'),
+                                     state.pop('discontinuity', False),
+                                     state.pop('byterange', None),
+                                     state.pop('date', None), state.get('map'))
+                return
+        elif line.startswith('#EXTINF'):
+            extinf = self.extinf_cache.get(line)
+            if extinf is None:
+                extinf = self.parse_tag(line, self.parse_extinf)
+                if len(self.extinf_cache) < self.extinf_cache_size:
+                    self.extinf_cache[line] = extinf
+            self.state['expect_segment'] = True
+            self.state['extinf'] = extinf
+            return
+        M3U8Parser.parse_line(self, lineno, line)
+
+    def parse(self, data):
+        uri_prefix = self.base_uri and urljoin(self.base_uri, 'x')[:-1]
+        self.uri_prefix = uri_prefix if urlparse(uri_prefix or '').scheme else None
+
+        start, lineno = 0, 0
+        self.m3u8 = M3U8()
+        prefix = self.prefix
+        if (prefix and prefix[0] == self.base_uri and data.startswith(prefix[1])
+                and len(self.segments) == prefix[4]):
+            start, lineno = len(prefix[1]), 1
+            for name, value in prefix[2].items():
+                setattr(self.m3u8, name, list(value) if isinstance(value, list) else value)
+            self.state = dict(prefix[3])
+        else:
+            self.state = {}
+            self.segments = CompactSegments()
+        self.prefix = None
+
+        prefix_end = self.last_segment_end(data)
+        if prefix_end <= start:
+            prefix = (self.base_uri, data[:start]) + prefix[2:] if start else None
+        for end, line in self.iter_lines(data, start):
+            self.parse_line(lineno, line)
+            lineno += 1
+            if end == prefix_end:
+                attributes = dict(self.m3u8.__dict__)
+                attributes.pop('segments')
+                prefix = (self.base_uri, data[:end], attributes,
+                          dict(self.state), self.segments.length)
+
+        self.prefix = prefix
+        self.m3u8.segments = self.segments.view()
+        # media playlists only, master playlists are not supported
+        self.m3u8.is_master = not not self.m3u8.playlists
+
+        return self.m3u8
+
+
+def parse_timestamp(value):
+    '''EXT-X-PROGRAM-DATE-TIME as a UTC timestamp'''
+    try:
+        date = parse_datetime(value)
+    except Exception:
+        return None
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+class SegmentIndex(object):
+    '''Bounded index of recently delivered segments
+
+    Segments are identified by EXT-X-PROGRAM-DATE-TIME
+    or by the basename of the segment URI,
+    sequence numbers are not used because they differ between sessions.
+    The basename is only a fallback, names can be reused by a new session
+    or after a discontinuity, which reset the index.
+    '''
+
+    def __init__(self, size=200):
+        self.size = size
+        self.keys = OrderedDict()
+        # end of the last delivered segment with a EXT-X-PROGRAM-DATE-TIME
+        self.date_end = None
+
+    @staticmethod
+    def basename(segment):
+        return urlparse(segment.uri).path.rsplit('/', 1)[-1]
+
+    def clear(self):
+        self.keys.clear()
+        self.date_end = None
+
+    def add(self, segment):
+        timestamp = segment.date and parse_timestamp(segment.date)
+        if timestamp is not None:
+            self.keys[('date', timestamp)] = True
+            self.date_end = timestamp + segment.duration
+        self.keys[('uri', self.basename(segment))] = True
+
+        while len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+
+    def contains(self, segment, basename=True):
+        timestamp = segment.date and parse_timestamp(segment.date)
+        if timestamp is not None:
+            return ('date', timestamp) in self.keys
+        return basename and ('uri', self.basename(segment)) in self.keys
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class StreamMetrics(object):
+    '''Playback metrics of one hlssession stream'''
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.lock = Lock()
+
+        self.failovers = 0
+        self.live_edge_skipped_seconds = 0.0
+        self.playlist_reloads = 0
+        self.playlist_reload_failures = 0
+        self.segments = {}
+        self.session_reloads = {}
+        self.segment_fetch = Histogram((0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+        self.live_edge_lag = Histogram((1, 2, 5, 10, 20, 30, 60))
+
+    def inc(self, key, value=None, amount=1):
+        with self.lock:
+            if value is None:
+                setattr(self, key, getattr(self, key) + amount)
+            else:
+                counter = getattr(self, key)
+                counter[value] = counter.get(value, 0) + amount
+
+    def observe(self, key, value):
+        with self.lock:
+            getattr(self, key).observe(value)
+
+
+class HLSSessionMetrics(object):
+    '''Metrics of every hlssession stream in this process,
+    exported in the Prometheus text format
+
+    - HLSSessionMetrics.streams
+    - HLSSessionMetrics.filename
+    - HLSSessionMetrics.server
+    '''
+    count = 0
+    filename = None
+    last_write = 0
+    lock = Lock()
+    server = None
+    streams = OrderedDict()
+
+    @classmethod
+    def register(cls, url):
+        with cls.lock:
+            cls.count += 1
+            metrics = StreamMetrics(str(cls.count), url)
+            cls.streams[metrics.name] = metrics
+        return metrics
+
+    @classmethod
+    def unregister(cls, metrics):
+        with cls.lock:
+            cls.streams.pop(metrics.name, None)
+
+    @staticmethod
+    def labels(metrics, **extra):
+        labels = [('stream', metrics.name), ('url', metrics.url)]
+        labels += sorted(extra.items())
+        return ','.join(
+            '{0}="{1}"'.format(key, str(value).replace('\\', '\\\\')
+                               .replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels)
+
+    @classmethod
+    def render(cls):
+        with cls.lock:
+            streams = list(cls.streams.values())
+
+        lines = []
+
+        def metric(name, type, help):
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, type))
+
+        def sample(name, metrics, value, **labels):
+            lines.append('{0}{{{1}}} {2}'.format(
+                name, cls.labels(metrics, **labels), value))
+
+        for key, help in (('playlist_reloads', 'Playlist reloads'),
+                          ('playlist_reload_failures', 'Failed playlist reloads'),
+                          ('failovers', 'Switches to a standby variant'),
+                          ('live_edge_skipped_seconds', 'Seconds skipped to the live edge')):
+            name = 'hlssession_{0}_total'.format(key)
+            metric(name, 'counter', help)
+            for metrics in streams:
+                sample(name, metrics, getattr(metrics, key))
+
+        for key, label, help in (('session_reloads', 'cause', 'Session reloads by cause'),
+                                 ('segments', 'result', 'Segments of valid_sequence by result')):
+            name = 'hlssession_{0}_total'.format(key)
+            metric(name, 'counter', help)
+            for metrics in streams:
+                with metrics.lock:
+                    counter = sorted(getattr(metrics, key).items())
+                for value, count in counter:
+                    sample(name, metrics, count, **{label: value})
+
+        for key, help in (('segment_fetch', 'Segment fetch time in seconds'),
+                          ('live_edge_lag', 'Distance of a queued segment to the live edge in seconds')):
+            name = 'hlssession_{0}_seconds'.format(key)
+            metric(name, 'histogram', help)
+            for metrics in streams:
+                with metrics.lock:
+                    histogram = getattr(metrics, key)
+                    counts = list(histogram.counts)
+                    count, sum_ = histogram.count, histogram.sum
+                for bucket, bucket_count in zip(histogram.buckets, counts):
+                    sample(name + '_bucket', metrics, bucket_count, le=bucket)
+                sample(name + '_bucket', metrics, count, le='+Inf')
+                sample(name + '_sum', metrics, sum_)
+                sample(name + '_count', metrics, count)
+
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def write(cls, interval=5):
+        '''Writes the metrics into a textfile, not more than once per interval'''
+        if not cls.filename or (time() - cls.last_write) < interval:
+            return
+        cls.last_write = time()
+
+        temp_filename = '{0}.tmp'.format(cls.filename)
+        try:
+            with open(temp_filename, 'w') as f:
+                f.write(cls.render())
+            # replace the file at once, a collector never reads a partial file
+            if hasattr(os, 'replace'):
+                os.replace(temp_filename, cls.filename)
+            else:
+                # Python 2 can't rename to an existing file on Windows
+                if is_win32 and os.path.exists(cls.filename):
+                    os.remove(cls.filename)
+                os.rename(temp_filename, cls.filename)
+        except (IOError, OSError) as err:
+            log.error('Failed to write metrics: {0}'.format(err))
+
+    @classmethod
+    def serve(cls, port):
+        '''Serves the metrics on http://127.0.0.1:PORT/metrics'''
+        with cls.lock:
+            if cls.server is not None:
+                return
+            try:
+                cls.server = HTTPServer(('127.0.0.1', port), HLSSessionMetricsHandler)
+            except (IOError, OSError) as err:
+                log.error('Failed to serve metrics on port {0}: {1}'.format(port, err))
+                cls.server = False
+                return
+
+        log.info('Metrics: http://127.0.0.1:{0}/metrics'.format(port))
+        t = Thread(target=cls.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+
+class HLSSessionMetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        data = HLSSessionMetrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug('Metrics: {0}'.format(format % args))
+
+
+class StandbyPoller(Thread):
+    '''Polls the standby variants of a stream with a low frequency,
+    the first available variant is used if the current variant fails.
+    '''
+
+    def __init__(self, worker, urls, interval):
+        self.closed = False
+        self.session = worker.session
+        self.request_params = worker.reader.request_params
+        self.urls = list(urls)
+        self.interval = interval
+        self.available = None
+        self.lock = Lock()
+
+        self._wait = Event()
+
+        Thread.__init__(self, name='Thread-{0}'.format(self.__class__.__name__))
+        self.daemon = True
+
+    def close(self):
+        self.closed = True
+        self._wait.set()
+
+    def check(self, urls):
+        for url in urls:
+            try:
+                res = self.session.http.get(url,
+                                            exception=StreamError,
+                                            retries=1,
+                                            **self.request_params)
+                playlist = hls_playlist.load(res.text, res.url)
+            except (StreamError, ValueError) as err:
+                log.debug('Standby variant is not available: {0}'.format(err))
+                continue
+
+            if playlist.segments:
+                return url
+        return None
+
+    def set_urls(self, urls):
+        '''Replaces the standby variants, used for a new session'''
+        with self.lock:
+            self.urls = list(urls)
+            self.available = None
+        self._wait.set()
+
+    def take(self, url):
+        '''Returns the available standby variant and replaces it with url,
+        None if no standby variant is available.
+        '''
+        with self.lock:
+            standby_url = self.available
+            if standby_url is None or standby_url not in self.urls:
+                return None
+            self.urls.remove(standby_url)
+            self.urls.append(url)
+            self.available = None
+        self._wait.set()
+        return standby_url
+
+    def run(self):
+        while not self.closed:
+            self._wait.clear()
+            with self.lock:
+                urls = list(self.urls)
+            available = self.check(urls)
+            with self.lock:
+                # the variants can change while they are checked
+                self.available = available if available in self.urls else None
+            self._wait.wait(self.interval)
+
+
+class PrefetchBuffer(object):
+    '''Byte-bounded ring of reusable blocks for the segment prefetch
+
+    The downloads take their blocks from the ring and the writer
+    puts them back after they are written, the memory does not grow
+    with a slow reader. Only the segment that is written (head)
+    can take the last reserve blocks, other downloads wait
+    or spill into a temporary file.
+    '''
+    block_size = 64 * 1024
+    reserve = 2
+
+    def __init__(self, size, spill=False):
+        self.capacity = max(size // self.block_size, self.reserve + 1)
+        self.spill = spill
+        self.cond = Condition()
+        self.closed = False
+        self.free = []
+        self.head = None
+        self.used = 0
+
+        # stats
+        self.peak = 0
+        self.spilled = 0
+        self.waits = 0
+
+    def acquire(self, num, spill=False):
+        '''Returns a block for segment num,
+        None if the buffer is closed or the segment should spill.
+        '''
+        with self.cond:
+            waiting = False
+            while not self.closed:
+                if self.capacity - self.used > (0 if num == self.head else self.reserve):
+                    self.used += 1
+                    self.peak = max(self.peak, self.used)
+                    return self.free.pop() if self.free else bytearray(self.block_size)
+                if spill and num != self.head:
+                    return
+                if not waiting:
+                    waiting = True
+                    self.waits += 1
+                self.cond.wait(0.5)
+
+    def release(self, block):
+        with self.cond:
+            self.used -= 1
+            self.free.append(block)
+            self.cond.notify_all()
+
+    def set_head(self, num):
+        with self.cond:
+            self.head = num
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'size': self.capacity * self.block_size,
+                'used': self.used * self.block_size,
+                'peak': self.peak * self.block_size,
+                'spilled': self.spilled,
+                'waits': self.waits,
+            }
+
+
+class PrefetchResponse(object):
+    '''Response-like download of a segment into the PrefetchBuffer'''
+
+    def __init__(self, writer, sequence):
+        self.writer = writer
+        self.buffer = writer.prefetch_buffer
+        self.sequence = sequence
+        self.blocks = deque()
+        self.closed = False
+        self.cond = Condition()
+        self.done = False
+        self.res = None
+        self.spill_file = None
+        # IOError of the download, raised by iter_content after the last block,
+        # the writer downloads the rest of the segment again
+        self.error = None
+        self.started = Event()
+
+    def result(self, timeout=None):
+        '''Used like a future by the writer'''
+        if not self.started.wait(timeout):
+            raise futures.TimeoutError()
+        return self if self.res is not None else None
+
+    def put(self, block, length):
+        with self.cond:
+            if self.closed:
+                self.buffer.release(block)
+                return
+            self.blocks.append((block, length))
+            self.cond.notify_all()
+
+    def spill(self, data):
+        if self.spill_file is None:
+            log.debug('Spill segment {0} to disk', self.sequence.num)
+            self.spill_file = tempfile.TemporaryFile()
+        self.spill_file.write(data)
+        with self.buffer.cond:
+            self.buffer.spilled += len(data)
+
+    def run(self):
+        try:
+            self.res = self.writer.fetch(self.sequence, retries=self.writer.retries)
+        finally:
+            self.started.set()
+
+        if self.res is None:
+            return self.finish()
+
+        block, length = None, 0
+        try:
+            for chunk in self.res.iter_content(self.buffer.block_size):
+                data = memoryview(chunk)
+                while data and not (self.closed or self.writer.closed):
+                    if self.spill_file:
+                        self.spill(data)
+                        break
+                    if block is None:
+                        block = self.buffer.acquire(self.sequence.num, spill=self.buffer.spill)
+                        if block is None:
+                            if self.buffer.closed:
+                                return
+                            self.spill(data)
+                            break
+                        length = 0
+                    size = min(len(data), len(block) - length)
+                    block[length:length + size] = data[:size]
+                    length += size
+                    data = data[size:]
+                    if length == len(block):
+                        self.put(block, length)
+                        block = None
+                if self.closed or self.writer.closed:
+                    return
+        except IOError as err:
+            self.error = err
+        finally:
+            if block is not None:
+                self.put(block, length)
+            self.res.close()
+            self.finish()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+            closed = self.closed
+        if closed and self.spill_file:
+            self.spill_file.close()
+
+    def iter_content(self, chunk_size=None):
+        '''Yields the blocks while the segment is downloading,
+        every block is reused after the next block is requested.
+        '''
+        self.buffer.set_head(self.sequence.num)
+        try:
+            while True:
+                with self.cond:
+                    while not (self.blocks or self.done or self.writer.closed):
+                        self.cond.wait(0.5)
+                    if not self.blocks:
+                        break
+                    block, length = self.blocks.popleft()
+                try:
+                    yield memoryview(block)[:length] if is_py3 else block[:length]
+                finally:
+                    self.buffer.release(block)
+
+            if self.spill_file and not self.writer.closed:
+                self.spill_file.seek(0)
+                for data in iter(partial(self.spill_file.read, self.buffer.block_size), b''):
+                    yield data
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.close()
+
+    @property
+    def content(self):
+        return b''.join(bytes(chunk) for chunk in self.iter_content())
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            while self.blocks:
+                self.buffer.release(self.blocks.popleft()[0])
+            done = self.done
+        # the download closes the file if it is still running
+        if done and self.spill_file:
+            self.spill_file.close()
+
+
+class HedgedRequests(object):
+    '''Sends a duplicate request if a response takes longer than usual,
+    the first response is used and the other response is closed.
+
+    The threshold is a quantile of the recent response times,
+    only the given ratio of all requests can be a duplicate.
+    '''
+    history_size = 50
+    min_history = 10
+    quantile = 0.9
+
+    def __init__(self, ratio, threads):
+        self.ratio = ratio
+        self.executor = futures.ThreadPoolExecutor(max_workers=threads * 2)
+        self.history = deque(maxlen=self.history_size)
+        self.lock = Lock()
+
+        # stats
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+
+    def threshold(self):
+        with self.lock:
+            if len(self.history) < self.min_history:
+                return
+            times = sorted(self.history)
+        return times[min(int(len(times) * self.quantile), len(times) - 1)]
+
+    def hedge(self):
+        with self.lock:
+            if self.hedged + 1 > self.ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    @staticmethod
+    def close_response(future):
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            future.result().close()
+
+    def get(self, request):
+        '''Returns the first response of request(),
+        raises the last error if every request fails.
+        '''
+        start = time()
+        with self.lock:
+            self.requests += 1
+
+        pending = [self.executor.submit(request)]
+        threshold = self.threshold()
+        if threshold is not None:
+            done, not_done = futures.wait(pending, timeout=threshold)
+            if not_done and self.hedge():
+                log.debug('Hedged request after {0:.2f}s', threshold)
+                pending.append(self.executor.submit(request))
+
+        first = pending[0]
+        res, error = None, None
+        while pending and res is None:
+            done, not_done = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            pending = list(not_done)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as err:
+                    error = err
+                    continue
+                if result is None:
+                    continue
+                if res is None:
+                    res = result
+                    if future is not first:
+                        with self.lock:
+                            self.won += 1
+                else:
+                    result.close()
+
+        for future in pending:
+            future.add_done_callback(self.close_response)
+
+        if res is None:
+            if error is not None:
+                raise error
+            return
+
+        with self.lock:
+            self.history.append(time() - start)
+        return res
+
+    def close(self):
+        log.debug('Hedged requests: {0} of {1} requests, {2} won',
+                  self.hedged, self.requests, self.won)
+        self.executor.shutdown(wait=False)
+
+
+class HLSSessionHLSStreamWriter(HLSStreamWriter):
+    def __init__(self, *args, **kwargs):
+        HLSStreamWriter.__init__(self, *args, **kwargs)
+        self.segment_failures = 0
+
+        self.prefetch_buffer = None
+        prefetch = self.stream.session_options.get('prefetch')
+        if prefetch:
+            self.prefetch_buffer = PrefetchBuffer(
+                (self.stream.session_options.get('prefetch_size') or 16) * 1024 * 1024,
+                self.stream.session_options.get('prefetch_spill') or False)
+            self.prefetch_executor = futures.ThreadPoolExecutor(max_workers=prefetch)
+
+        self.hedged_requests = None
+        if self.stream.session_options.get('hedge'):
+            self.hedged_requests = HedgedRequests(
+                self.stream.session_options.get('hedge'),
+                prefetch or self.session.options.get('hls-segment-threads'))
+
+    def close(self):
+        if self.prefetch_buffer and not self.closed:
+            log.debug('Prefetch buffer: {peak} of {size} bytes, {spilled} bytes spilled, '
+                      '{waits} waits'.format(**self.prefetch_buffer.stats()))
+            self.prefetch_buffer.close()
+            self.prefetch_executor.shutdown(wait=False)
+        if self.hedged_requests and not self.closed:
+            self.hedged_requests.close()
+        HLSStreamWriter.close(self)
+
+    def create_request_params(self, sequence):
+        request_params = HLSStreamWriter.create_request_params(self, sequence)
+        if self.prefetch_buffer:
+            # the segment is read by PrefetchResponse
+            request_params['stream'] = True
+        return request_params
+
+    def queued_duration(self):
+        '''Duration of the segments in the queue that are not written yet'''
+        with self.futures.mutex:
+            return sum(segment.segment.duration
+                       for segment, future in self.futures.queue
+                       if segment is not None)
+
+    def drop_queued(self, duration):
+        '''Drops the oldest segments of the queue,
+        until the given duration is dropped.
+
+        Returns the dropped sequences.
+        '''
+        dropped = []
+        while sum(s.segment.duration for s in dropped) < duration:
+            with self.futures.mutex:
+                if not self.futures.queue or self.futures.queue[0][0] is None:
+                    break
+            try:
+                segment, future = self.futures.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(future, PrefetchResponse):
+                future.close()
+            elif not future.cancel():
+                future.add_done_callback(HedgedRequests.close_response)
+            dropped.append(segment)
+        return dropped
+
+    def refetch(self, sequence, res):
+        '''Downloads the whole segment again with the byte range of res, None if it failed'''
+        # PrefetchResponse or requests.Response
+        request = getattr(getattr(res, 'res', res), 'request', None)
+        if request is not None and sequence.segment.byterange:
+            # create_request_params() would continue after the last byte range
+            request_params = dict(self.reader.request_params)
+            request_params['headers'] = dict(request_params.get('headers') or {},
+                                             Range=request.headers['Range'])
+        else:
+            request_params = HLSStreamWriter.create_request_params(self, sequence)
+        try:
+            return self.session.http.get(sequence.segment.uri,
+                                         timeout=self.timeout,
+                                         exception=StreamError,
+                                         retries=self.retries,
+                                         **request_params)
+        except StreamError as err:
+            log.error('Failed to open segment {0}: {1}'.format(sequence.num, err))
+            return None
+
+    def write(self, sequence, res, chunk_size=8192):
+        '''HLSStreamWriter.write, a segment with a read error
+        is downloaded again and continues after the written bytes
+        '''
+        if sequence.segment.key and sequence.segment.key.method != 'NONE':
+            # the segment is decrypted at once, nothing is written yet
+            try:
+                HLSStreamWriter.write(self, sequence, res, chunk_size)
+                return
+            except IOError as err:
+                log.warning('Failed to read segment {0}, downloading it again: {1}'.format(
+                    sequence.num, err))
+            res = self.refetch(sequence, res)
+            if res is None:
+                log.error('Failed to read segment {0}, dropping it'.format(sequence.num))
+                return
+            HLSStreamWriter.write(self, sequence, res, chunk_size)
+            return
+
+        written = 0
+        try:
+            for chunk in res.iter_content(chunk_size):
+                self.reader.buffer.write(chunk)
+                written += len(chunk)
+        except IOError as err:
+            log.warning('Failed to read segment {0}, downloading it again: {1}'.format(
+                sequence.num, err))
+            res = self.refetch(sequence, res)
+            content = res and res.content
+            if not content or len(content) < written:
+                log.error('Failed to read segment {0}, dropping the rest '
+                          'after {1} bytes'.format(sequence.num, written))
+                return
+            self.reader.buffer.write(content[written:])
+
+        log.debug('Download of segment {0} complete'.format(sequence.num))
+
+    def put(self, sequence):
+        if self.prefetch_buffer is None or sequence is None or self.closed:
+            HLSStreamWriter.put(self, sequence)
+            return
+
+        response = PrefetchResponse(self, sequence)
+        self.prefetch_executor.submit(response.run)
+        self.queue(self.futures, (sequence, response))
+
+    def fetch_segment(self, sequence, retries=None):
+        if self.closed or not retries:
+            return
+
+        try:
+            # the same request params for a hedged request
+            request_params = self.create_request_params(sequence)
+            # skip ignored segment names
+            if self.ignore_names and self.ignore_names_re.search(sequence.segment.uri):
+                log.debug('Skipping segment {0}'.format(sequence.num))
+                return
+
+            def request():
+                return self.session.http.get(sequence.segment.uri,
+                                             timeout=self.timeout,
+                                             exception=StreamError,
+                                             retries=self.retries,
+                                             **request_params)
+
+            if self.hedged_requests:
+                return self.hedged_requests.get(request)
+            return request()
+        except StreamError as err:
+            log.error('Failed to open segment {0}: {1}', sequence.num, err)
+            return
+
+    def fetch(self, sequence, retries=None):
+        start = time()
+        res = self.fetch_segment(sequence, retries)
+        if res is not None:
+            self.reader.metrics.observe('segment_fetch', time() - start)
+        elif (not self.closed
+                and not (self.ignore_names and self.ignore_names_re.search(sequence.segment.uri))):
+            self.segment_failures += 1
+        return res
+
+
 class HLSSessionHLSStreamWorker(HLSStreamWorker):
-    def reload_session(self):
+    def __init__(self, reader, *args, **kwargs):
+        # self.stream is replaced by reload_session(),
+        # the session data of the first stream is used for every session
+        stream = reader.stream
+        self.session_url = stream.session_url
+        self.session_stream_name = stream.session_stream_name
+        self.session_timestamp = int(time())
+
+        self.low_latency = stream.session_options.get('low_latency') or False
+        self.sequence_ignore_number = stream.session_options.get('ignore_number') or 0
+        self.session_reload_segment = stream.session_options.get('segment') or False
+        self.session_reload_segment_status = False
+        self.session_reload_time = int(stream.session_options.get('time') or 0)
+
+        self.standby = None
+        self.standby_urls = stream.session_standby_urls
+        self.standby_interval = stream.session_options.get('standby')
+        self.segment_failures = 0
+
+        self.latency_target = stream.session_options.get('latency') or 0
+        self.latency_drain = stream.session_options.get('latency_drain') or False
+        self.latency_skipped = 0.0
+
+        self.metrics = reader.metrics
+        # distance of every sequence to the live edge, only used for metrics
+        self.playlist_edge = {}
+
+        # segments of every session
+        self.segment_index = SegmentIndex()
+        # undelivered duration, reload time and sequence of the last playlist,
+        # used to align the first playlist of a new session
+        self.session_align = None
+        self.playlist_unique_names = False
+
+        # used for every reload_playlist() without Low-Latency HLS
+        self.playlist_parser = FastM3U8Parser()
+
+        # Low-Latency HLS, must be set before the first reload_playlist()
+        self.playlist_part = 0
+        self.playlist_parts = {}
+        self.playlist_part_target = None
+        self.playlist_reload_timestamp = 0
+        self.playlist_server_control = None
+        self.playlist_target_duration = None
+        self.playlist_trailing_parts = 0
+        HLSStreamWorker.__init__(self, reader, *args, **kwargs)
+
+    def reload_session(self, cause=None):
         '''Replaces the current stream with a new stream'''
-        TempData.cached_data.update({'timestamp': int(time())})
-
-        cache_stream_name = TempData.cached_data.get('stream_name')
-        cache_stream_url = TempData.cached_data.get('url')
+        self.session_timestamp = int(time())
+        self.metrics.inc('session_reloads', cause or 'unknown')
 
-        if not (cache_stream_name and cache_stream_url):
-            log.warning('Missing cached data for hlssession,'
+        if not (self.session_stream_name and self.session_url):
+            log.warning('Missing session data for hlssession,'
                         'your Streamlink Application is not setup correctly.')
             return
 
         log.debug('Current stream: {0} - {1}'.format(
-            cache_stream_name, cache_stream_url))
+            self.session_stream_name, self.session_url))
         log.debug('Reloading session playlist')
         streams = self.session.streams(
-            cache_stream_url, stream_types=['hls'])
+            self.session_url, stream_types=['hls'])
 
         if not streams:
             log.debug('No stream found for hls-session-reload,'
@@ -71,17 +1254,228 @@ class HLSSessionHLSStreamWorker(HLSStreamWorker):
             return
 
         # overwrite the stream
-        self.stream = streams[cache_stream_name]
+        self.switch_stream(streams[self.session_stream_name])
         log.debug('New stream_url: {0}'.format(self.stream.url))
 
+        if self.standby:
+            # the standby variants of the new session,
+            # from the master playlist of the session URL
+            standby_urls = HLSSessionPlugin._get_standby_urls(
+                self.session, self.session_url, self.reader.request_params)
+            self.standby.set_urls(standby_urls.get(self.stream.url, []))
+
+    def switch_stream(self, stream, variant=False):
+        '''Replaces self.stream at the next segment boundary,
+        a variant of the same master playlist uses the same sequence numbers.
+        '''
+        backlog = sum(s.segment.duration for s in self.undelivered_sequences())
+        self.session_align = (backlog, self.playlist_reload_timestamp,
+                              self.playlist_sequence if variant else None)
+        self.stream = stream
+
+        # the new playlist can't answer blocking or delta requests
+        # of the old playlist, the next reload is a full reload
+        self.playlist_part = 0
+        self.playlist_parts = {}
+        self.playlist_reload_timestamp = 0
+        self.playlist_server_control = None
+
+    def failover(self):
+        '''Switches to an available standby variant'''
+        url = self.standby and self.standby.take(self.stream.url)
+        if not url:
+            return False
+
+        self.metrics.inc('failovers')
+        log.warning('Switching to standby variant: {0}'.format(url))
+        self.switch_stream(HLSStream(self.session, url, **self.reader.request_params),
+                           variant=True)
+        return True
+
     def reload_session_invalid_sequence_check(self):
         # only allows reload_session(),
         # if the last reload is older than 10 seconds
-        if TempData.session_reload_segment and (int(time() - TempData.cached_data['timestamp']) >= 10):
+        if self.session_reload_segment and (int(time() - self.session_timestamp) >= 10):
             # if a reload_playlist() fails because of invalid sequences,
             # it will allow the usage of reload_session() on the next
             # failed try of reload_playlist()
-            TempData.session_reload_segment_status = True
+            self.session_reload_segment_status = True
+
+    def low_latency_params(self):
+        '''Delivery directives for the next Low-Latency HLS playlist request'''
+        server_control = self.playlist_server_control
+        if (not server_control or not self.playlist_sequences
+                or self.playlist_end is not None):
+            return {}
+
+        params = {}
+        next_num = self.playlist_sequences[-1].num + 1
+        if server_control.can_block_reload:
+            params['_HLS_msn'] = next_num
+            if self.playlist_part_target:
+                params['_HLS_part'] = len(self.playlist_parts.get(next_num, []))
+
+        # a delta update is only valid, if the last playlist
+        # is not older than half of the skip boundary
+        if (server_control.can_skip_until
+                and (time() - self.playlist_reload_timestamp) < (server_control.can_skip_until / 2)):
+            params['_HLS_skip'] = 'YES'
+
+        return params
+
+    def low_latency_sequences(self, playlist):
+        '''Creates the sequences and partial segments of a Low-Latency HLS playlist,
+        the skipped segments of a delta update are taken from the last playlist
+        '''
+        media_sequence = playlist.media_sequence or 0
+        first_num = media_sequence + playlist.skipped_segments
+        sequences = [Sequence(first_num + i, s)
+                     for i, s in enumerate(playlist.segments)]
+
+        parts = {}
+        if playlist.skipped_segments:
+            skipped = [s for s in self.playlist_sequences
+                       if media_sequence <= s.num < first_num]
+            if len(skipped) != playlist.skipped_segments:
+                return None, None
+            for sequence in skipped:
+                parts[sequence.num] = self.playlist_parts.get(sequence.num, [])
+            sequences = skipped + sequences
+
+        for index, segment_parts in playlist.segment_parts.items():
+            parts[first_num + index] = segment_parts
+        if playlist.trailing_parts:
+            parts[first_num + len(playlist.segments)] = playlist.trailing_parts
+
+        return sequences, parts
+
+    def reload_playlist(self):
+        if self.closed:
+            return
+
+        self.reader.buffer.wait_free()
+        log.debug('Reloading playlist')
+        self.metrics.inc('playlist_reloads')
+
+        request_params = dict(self.reader.request_params)
+        parser = M3U8Parser
+        if self.low_latency:
+            parser = LowLatencyM3U8Parser
+            params = self.low_latency_params()
+            if params:
+                log.debug('Low-Latency HLS params: {0}'.format(params))
+                params.update(request_params.get('params') or {})
+                request_params['params'] = params
+                if '_HLS_msn' in params:
+                    # the server holds the request until the segment is available
+                    request_params['timeout'] = 3 * (self.playlist_target_duration or 6)
+
+        res = self.session.http.get(self.stream.url,
+                                    exception=StreamError,
+                                    retries=self.playlist_reload_retries,
+                                    **request_params)
+        try:
+            if parser is LowLatencyM3U8Parser:
+                playlist = hls_playlist.load(res.text, res.url, parser=parser)
+            else:
+                self.playlist_parser.base_uri = res.url
+                playlist = self.playlist_parser.parse(res.text)
+        except ValueError as err:
+            raise StreamError(err)
+
+        if playlist.is_master:
+            raise StreamError('Attempted to play a variant playlist, use '
+                              '\'hls://{0}\' instead'.format(self.stream.url))
+
+        if playlist.iframes_only:
+            raise StreamError('Streams containing I-frames only is not playable')
+
+        if parser is LowLatencyM3U8Parser:
+            sequences, parts = self.low_latency_sequences(playlist)
+            if sequences is None:
+                log.debug('Delta update does not match the last playlist')
+                self.playlist_reload_timestamp = 0
+                return self.reload_playlist()
+            self.playlist_parts = parts
+            self.playlist_part_target = playlist.part_target
+            self.playlist_server_control = playlist.server_control
+        else:
+            sequences = CompactSequences(playlist.segments,
+                                         playlist.media_sequence or 0)
+
+        self.playlist_reload_timestamp = time()
+        if sequences:
+            self.process_sequences(playlist, sequences)
+
+    def low_latency_edge(self, sequences):
+        '''Returns the sequence number and the part index of the
+        first partial segment after PART-HOLD-BACK from the live edge
+        '''
+        positions = []
+        for num in [s.num for s in sequences] + [sequences[-1].num + 1]:
+            for index, part in enumerate(self.playlist_parts.get(num, [])):
+                positions.append((num, index, part))
+
+        if not positions:
+            return None
+
+        hold_back = ((self.playlist_server_control
+                      and self.playlist_server_control.part_hold_back)
+                     or 3 * (self.playlist_part_target or 1))
+        duration = 0
+        position = len(positions)
+        while position > 0 and duration < hold_back:
+            position -= 1
+            duration += positions[position][2].segment.duration
+
+        # start with an independent partial segment
+        independent = [i for i in range(position + 1) if positions[i][2].independent]
+        if independent:
+            position = independent[-1]
+
+        num, index, part = positions[position]
+        return num, index
+
+    def align_sequence(self, sequences):
+        '''Returns the first sequence number of a new session,
+        that follows the last delivered segment of the old session.
+
+        The playlists are aligned by
+        - EXT-X-PROGRAM-DATE-TIME
+        - sequence number of a variant
+        - segment URI basename
+        - cumulative duration
+        '''
+        backlog, reload_timestamp, variant_sequence = self.session_align
+        date_end = self.segment_index.date_end
+        timestamps = [s.segment.date and parse_timestamp(s.segment.date)
+                      for s in sequences]
+
+        if date_end is not None and None not in timestamps:
+            for sequence, timestamp in zip(sequences, timestamps):
+                if timestamp + (sequence.segment.duration / 2) > date_end:
+                    log.debug('Aligned new session by date')
+                    return sequence.num
+            return sequences[-1].num + 1
+
+        if variant_sequence is not None:
+            log.debug('Aligned new session by sequence number')
+            return variant_sequence
+
+        if self.playlist_unique_names:
+            for sequence in reversed(sequences):
+                if self.segment_index.contains(sequence.segment):
+                    log.debug('Aligned new session by URI')
+                    return sequence.num + 1
+
+        if reload_timestamp:
+            # undelivered duration of the old playlist
+            # and everything that was added since its last reload
+            duration = backlog + (time() - reload_timestamp)
+            log.debug('Aligned new session by duration')
+            return self.duration_to_sequence(-duration, sequences)
+
+        return None
 
     def process_sequences(self, playlist, sequences):
         first_sequence, last_sequence = sequences[0], sequences[-1]
@@ -89,26 +1483,67 @@ class HLSSessionHLSStreamWorker(HLSStreamWorker):
         if first_sequence.segment.key and first_sequence.segment.key.method != 'NONE':
             log.debug('Segments in this playlist are encrypted')
 
-        self.playlist_changed = ([s.num for s in self.playlist_sequences]
-                                 != [s.num for s in sequences])
+        trailing_parts = len(self.playlist_parts.get(last_sequence.num + 1, []))
+        # sequence numbers are consecutive
+        self.playlist_changed = (not self.playlist_sequences
+                                 or self.playlist_sequences[0].num != first_sequence.num
+                                 or self.playlist_sequences[-1].num != last_sequence.num
+                                 or self.playlist_trailing_parts != trailing_parts)
+        self.playlist_trailing_parts = trailing_parts
+        if isinstance(sequences, CompactSequences):
+            self.playlist_unique_names = sequences.unique_names
+        else:
+            self.playlist_unique_names = (len(set(SegmentIndex.basename(s.segment) for s in sequences))
+                                          == len(sequences))
+        self.playlist_target_duration = playlist.target_duration
         self.playlist_reload_time = (playlist.target_duration
                                      or last_sequence.segment.duration)
         self.playlist_sequences = sequences
 
-        if not self.playlist_changed:
+        if self.playlist_part_target:
+            # poll for new partial segments, if blocking reloads are not supported
+            self.playlist_reload_time = self.playlist_part_target
+            if not self.playlist_changed:
+                self.playlist_reload_time = self.playlist_part_target / 2
+        elif not self.playlist_changed:
             self.playlist_reload_time = max(self.playlist_reload_time / 2, 1)
             # uses reload_session() on the 2nd reload_playlist()
             # if the playlist did not change
-            if TempData.session_reload_segment and TempData.session_reload_segment_status is True:
+            if self.session_reload_segment and self.session_reload_segment_status is True:
                 log.debug('Expected reload_session() - invalid sequences')
-                self.reload_session()
-                TempData.session_reload_segment_status = False
+                self.reload_session('invalid sequences')
+                self.session_reload_segment_status = False
 
         if playlist.is_endlist:
             self.playlist_end = last_sequence.num
 
+        if self.playlist_end is None and HLSSessionMetrics.streams:
+            edge = 0
+            self.playlist_edge = {}
+            for sequence in reversed(sequences):
+                edge += sequence.segment.duration
+                self.playlist_edge[sequence.num] = edge
+                if sequence.num < self.playlist_sequence:
+                    break
+
+        if self.session_align:
+            align_sequence = self.align_sequence(sequences)
+            self.session_align = None
+            # segment names of the old session are not used for the new session
+            self.segment_index.clear()
+            if align_sequence is not None:
+                log.debug('New session starts with sequence {0}'.format(align_sequence))
+                self.playlist_sequence = align_sequence
+            else:
+                self.playlist_sequence = -1
+
         if self.playlist_sequence < 0:
-            if self.playlist_end is None and not self.hls_live_restart:
+            low_latency_edge = (self.playlist_end is None
+                                and not self.hls_live_restart
+                                and self.low_latency_edge(sequences))
+            if low_latency_edge:
+                self.playlist_sequence, self.playlist_part = low_latency_edge
+            elif self.playlist_end is None and not self.hls_live_restart:
                 edge_index = -(min(len(sequences), max(int(self.live_edge), 1)))
                 edge_sequence = sequences[edge_index]
                 self.playlist_sequence = edge_sequence.num
@@ -117,15 +1552,35 @@ class HLSSessionHLSStreamWorker(HLSStreamWorker):
 
     def valid_sequence(self, sequence):
         if sequence.num >= self.playlist_sequence:
+            if sequence.segment.discontinuity:
+                # segment names can restart after a discontinuity
+                self.segment_index.clear()
+            elif self.delivered_sequence(sequence, basename=False):
+                return False
+            self.metrics.inc('segments', 'added')
             return True
-        elif TempData.sequence_ignore_number and sequence.num <= (self.playlist_sequence - TempData.sequence_ignore_number):
-            log.warning('Added invalid segment number.')
+        elif self.sequence_ignore_number and sequence.num <= (self.playlist_sequence - self.sequence_ignore_number):
             self.reload_session_invalid_sequence_check()
+            if self.delivered_sequence(sequence):
+                return False
+            log.warning('Added invalid segment number.')
+            self.metrics.inc('segments', 'added invalid')
             return True
         else:
             self.reload_session_invalid_sequence_check()
+            self.metrics.inc('segments', 'skipped invalid')
             return False
 
+    def delivered_sequence(self, sequence, basename=True):
+        '''never download a segment twice,
+        the basename is only used if the sequence number is not valid
+        '''
+        if self.segment_index.contains(sequence.segment, basename and self.playlist_unique_names):
+            log.debug('Skipping delivered segment {0}'.format(sequence.num))
+            self.metrics.inc('segments', 'skipped delivered')
+            return True
+        return False
+
     def duration_to_sequence(self, duration, sequences):
         d = 0
         default = -1
@@ -141,16 +1596,139 @@ class HLSSessionHLSStreamWorker(HLSStreamWorker):
         # could not skip far enough, so return the default
         return default
 
+    def playlist_blocking_reload(self):
+        '''The server holds the next playlist request until it changed'''
+        return bool(self.playlist_end is None
+                    and self.playlist_changed
+                    and self.playlist_server_control
+                    and self.playlist_server_control.can_block_reload)
+
+    def undelivered_sequences(self):
+        '''Sequences of the playlist from playlist_sequence'''
+        if isinstance(self.playlist_sequences, CompactSequences):
+            return list(self.playlist_sequences.iter_from(self.playlist_sequence))
+        return [s for s in self.playlist_sequences
+                if s.num >= self.playlist_sequence]
+
+    def valid_sequences(self):
+        '''filter(self.valid_sequence, self.playlist_sequences),
+        the sequences before playlist_sequence of a long playlist
+        are skipped at once.
+        '''
+        sequences = self.playlist_sequences
+        if self.sequence_ignore_number or not isinstance(sequences, CompactSequences):
+            return filter(self.valid_sequence, sequences)
+
+        skipped = sequences.index(self.playlist_sequence)
+        if skipped:
+            self.reload_session_invalid_sequence_check()
+            self.metrics.inc('segments', 'skipped invalid', amount=skipped)
+        return filter(self.valid_sequence, sequences.iter_from(self.playlist_sequence))
+
+    def iter_playlist_sequences(self):
+        '''Yields the valid segments of the playlist,
+        and the partial segments of a segment that is not completed yet.
+
+        A segment that was started with partial segments,
+        will be completed with its remaining partial segments.
+        '''
+        for sequence in self.valid_sequences():
+            parts = (self.playlist_part
+                     and sequence.num == self.playlist_sequence
+                     and self.playlist_parts.get(sequence.num))
+            if parts:
+                for part in parts[self.playlist_part:]:
+                    if not part.gap:
+                        yield Sequence(sequence.num, part.segment)
+            else:
+                yield sequence
+
+            self.segment_index.add(sequence.segment)
+            self.playlist_sequence = sequence.num + 1
+            self.playlist_part = 0
+
+        if not self.playlist_sequences:
+            return
+
+        num = self.playlist_sequences[-1].num + 1
+        if num != self.playlist_sequence:
+            return
+
+        parts = self.playlist_parts.get(num, [])
+        for index in range(self.playlist_part, len(parts)):
+            if not parts[index].gap:
+                yield Sequence(num, parts[index].segment)
+            self.playlist_part = index + 1
+
+    def live_edge_catch_up(self):
+        '''Skips forward to the latency target,
+        if the stream is too far behind the live edge.
+
+        With --hlssession-latency-drain the oldest segments
+        in the writer queue are dropped first.
+        '''
+        if not self.latency_target or self.playlist_end is not None:
+            return
+
+        sequences = self.undelivered_sequences()
+        latency = sum(s.segment.duration for s in sequences)
+        queued = self.writer.queued_duration() if self.latency_drain else 0
+        if latency + queued <= self.latency_target:
+            return
+
+        skipped = []
+        if queued:
+            skipped += self.writer.drop_queued(latency + queued - self.latency_target)
+
+        if latency > self.latency_target:
+            num = self.duration_to_sequence(-self.latency_target, sequences) + 1
+            for sequence in sequences:
+                if sequence.num < num:
+                    self.segment_index.add(sequence.segment)
+                    skipped.append(sequence)
+            self.playlist_sequence = num
+            self.playlist_part = 0
+
+        if not skipped:
+            return
+
+        duration = sum(s.segment.duration for s in skipped)
+        self.latency_skipped += duration
+        self.metrics.inc('segments', 'skipped live edge', amount=len(skipped))
+        self.metrics.inc('live_edge_skipped_seconds', amount=duration)
+        log.info('Skipped {0:.1f}s to the live edge, {1} segments, '
+                 '{2:.1f}s in total'.format(duration, len(skipped), self.latency_skipped))
+
+    def close(self):
+        HLSStreamWorker.close(self)
+        if self.standby:
+            self.standby.close()
+
+    def run(self):
+        if self.standby_interval and self.standby_urls:
+            self.standby = StandbyPoller(self, self.standby_urls,
+                                         self.standby_interval)
+            self.standby.start()
+        HLSStreamWorker.run(self)
+
     def iter_segments(self):
         total_duration = 0
         while not self.closed:
-            if TempData.session_reload_time and (
-                    (TempData.cached_data['timestamp']
-                     + TempData.session_reload_time) < int(time())):
+            if self.writer.segment_failures > self.segment_failures:
+                self.segment_failures = self.writer.segment_failures
+                log.debug('Failed segments: {0}'.format(self.segment_failures))
+                self.failover()
+
+            if self.session_reload_time and (
+                    (self.session_timestamp
+                     + self.session_reload_time) < int(time())):
                 log.debug('Expected reload_session() - time')
-                self.reload_session()
-            for sequence in filter(self.valid_sequence, self.playlist_sequences):
+                self.reload_session('time')
+            self.live_edge_catch_up()
+            for sequence in self.iter_playlist_sequences():
                 log.debug('Adding segment {0} to queue', sequence.num)
+                if sequence.num in self.playlist_edge:
+                    self.metrics.observe('live_edge_lag', self.playlist_edge[sequence.num])
                 yield sequence
                 total_duration += sequence.segment.duration
                 if self.duration_limit and total_duration >= self.duration_limit:
@@ -162,23 +1740,46 @@ class HLSSessionHLSStreamWorker(HLSStreamWorker):
                 if self.closed or stream_end:
                     return
 
-                self.playlist_sequence = sequence.num + 1
-
-            if self.wait(self.playlist_reload_time):
+            if self.playlist_blocking_reload() or self.wait(self.playlist_reload_time):
                 try:
                     self.reload_playlist()
                 except StreamError as err:
                     log.warning('Failed to reload playlist: {0}', err)
-                    if (TempData.session_reload_time or TempData.session_reload_segment):
+                    self.metrics.inc('playlist_reload_failures')
+                    if self.failover():
+                        continue
+                    elif (self.session_reload_time or self.session_reload_segment):
                         log.warning('Unexpected reload_session() - StreamError')
-                        self.reload_session()
+                        self.reload_session('StreamError')
+                finally:
+                    HLSSessionMetrics.write()
 
 
 class HLSSessionHLSStreamReader(HLSStreamReader):
     __worker__ = HLSSessionHLSStreamWorker
+    __writer__ = HLSSessionHLSStreamWriter
+
+    def __init__(self, stream, *args, **kwargs):
+        HLSStreamReader.__init__(self, stream, *args, **kwargs)
+        if stream.session_options.get('metrics_file') or stream.session_options.get('metrics_port'):
+            self.metrics = HLSSessionMetrics.register(stream.session_url or stream.url)
+        else:
+            self.metrics = StreamMetrics('', stream.url)
+
+    def close(self):
+        HLSStreamReader.close(self)
+        HLSSessionMetrics.unregister(self.metrics)
 
 
 class HLSSessionHLSStream(HLSStream):
+    def __init__(self, *args, **kwargs):
+        HLSStream.__init__(self, *args, **kwargs)
+        # used for a new session, set by HLSSessionPlugin
+        self.session_url = None
+        self.session_stream_name = 'best'
+        self.session_options = {}
+        self.session_standby_urls = []
+
     def open(self):
         reader = HLSSessionHLSStreamReader(self)
         reader.open()
@@ -190,6 +1791,20 @@ class HLSSessionPlugin(Plugin):
     _url_re = re.compile(r'(hlssession://)(.+(?:\.m3u8)?.*)')
 
     arguments = PluginArguments(
+        PluginArgument(
+            'hedge',
+            type=num(float, min=0, max=1),
+            metavar='RATIO',
+            help='''
+            Sends a duplicate segment request if the response takes longer
+            than 90% of the recent responses, the first response is used.
+
+            The ratio is the max. number of duplicate requests,
+            0.05 allows one duplicate request for 20 requests.
+
+            Default is Disabled.
+            '''
+        ),
         PluginArgument(
             'ignore_number',
             # dest='hls-segment-ignore-number',
@@ -207,6 +1822,94 @@ class HLSSessionPlugin(Plugin):
             Default is Disabled.
             '''
         ),
+        PluginArgument(
+            'latency',
+            type=num(int, min=0),
+            metavar='SECONDS',
+            help='''
+            Skips forward to the live edge if the stream is more than
+            the given seconds behind the live edge, after a stall
+            or a new session. The skipped time is logged.
+
+            Default is Disabled.
+            '''
+        ),
+        PluginArgument(
+            'latency-drain',
+            action='store_true',
+            help='''
+            Drops the oldest segments that are not written yet
+            before it skips forward in the playlist,
+            the latency is reduced at once.
+
+            Default is False.
+            '''
+        ),
+        PluginArgument(
+            'low-latency',
+            action='store_true',
+            help='''
+            Enables Low-Latency HLS for playlists that support it.
+
+            Uses blocking playlist reloads, delta updates
+            and partial segments instead of timed playlist reloads.
+
+            Default is False.
+            '''
+        ),
+        PluginArgument(
+            'metrics-file',
+            metavar='FILENAME',
+            help='''
+            Writes playback metrics of every hlssession stream
+            in the Prometheus text format into this file.
+
+            Default is Disabled.
+            '''
+        ),
+        PluginArgument(
+            'metrics-port',
+            type=num(int, min=0, max=65535),
+            metavar='PORT',
+            help='''
+            Serves playback metrics of every hlssession stream
+            in the Prometheus text format on http://127.0.0.1:PORT/metrics
+
+            Default is Disabled.
+            '''
+        ),
+        PluginArgument(
+            'prefetch',
+            type=num(int, min=0),
+            metavar='DOWNLOADS',
+            help='''
+            Downloads the given number of segments at the same time
+            into a prefetch buffer of reusable blocks,
+            the memory stays the same for a slow reader.
+
+            Default is Disabled.
+            '''
+        ),
+        PluginArgument(
+            'prefetch-size',
+            type=num(int, min=0),
+            metavar='MB',
+            help='''
+            Max. size of the prefetch buffer.
+
+            Default is 16.
+            '''
+        ),
+        PluginArgument(
+            'prefetch-spill',
+            action='store_true',
+            help='''
+            Downloads into a temporary file if the prefetch buffer is full,
+            only the segment that is written waits for the buffer.
+
+            Default is False.
+            '''
+        ),
         PluginArgument(
             'segment',
             # dest='hls-session-reload-segment',
@@ -220,6 +1923,23 @@ class HLSSessionPlugin(Plugin):
             if the time is set incorrectly, it might not work for every stream.
             '''
         ),
+        PluginArgument(
+            'standby',
+            type=num(int, min=0),
+            metavar='SECONDS',
+            default=None,
+            help='''
+            Polls a standby variant after the given seconds,
+            a redundant variant with the same bandwidth
+            or the variant with the next-lower bandwidth.
+
+            The stream switches to the standby variant if the playlist
+            or the segments fail, a new session is only used
+            if the standby variant is not available.
+
+            Default is Disabled.
+            '''
+        ),
         PluginArgument(
             'time',
             # dest='hls-session-reload-time',
@@ -243,6 +1963,33 @@ class HLSSessionPlugin(Plugin):
     def can_handle_url(cls, url):
         return cls._url_re.match(url)
 
+    @staticmethod
+    def _get_standby_urls(session, url, params):
+        '''Standby variants of every variant,
+        redundant variants with the same bandwidth
+        and variants with the next-lower bandwidth.
+        '''
+        try:
+            res = session.http.get(url, exception=IOError, **params)
+            playlist = hls_playlist.load(res.text, base_uri=res.url)
+        except (IOError, ValueError) as err:
+            log.debug('No standby variants: {0}'.format(err))
+            return {}
+
+        variants = [p for p in playlist.playlists
+                    if not p.is_iframe and p.stream_info.bandwidth]
+        standby_urls = {}
+        for variant in variants:
+            bandwidth = variant.stream_info.bandwidth
+            redundant = [p.uri for p in variants
+                         if p.stream_info.bandwidth == bandwidth and p.uri != variant.uri]
+            lower = [p.stream_info.bandwidth for p in variants
+                     if p.stream_info.bandwidth < bandwidth]
+            lower = [p.uri for p in variants
+                     if lower and p.stream_info.bandwidth == max(lower)]
+            standby_urls[variant.uri] = redundant + lower
+        return standby_urls
+
     def _get_streams(self):
         http.headers.update({'User-Agent': useragents.FIREFOX})
         log.debug('Version 2018-07-01')
@@ -253,32 +2000,6 @@ class HLSSessionPlugin(Plugin):
         urlnoproto = self._url_re.match(url).group(2)
         urlnoproto = update_scheme('http://', urlnoproto)
 
-        if not hasattr(TempData, 'sequence_ignore_number'):
-            TempData.sequence_ignore_number = (
-                HLSSessionPlugin.get_option('ignore_number')
-                or 0)
-
-        if not hasattr(TempData, 'session_reload_segment'):
-            TempData.session_reload_segment = (
-                HLSSessionPlugin.get_option('segment')
-                or False)
-        if not hasattr(TempData, 'session_reload_segment_status'):
-            TempData.session_reload_segment_status = False
-
-        if not hasattr(TempData, 'session_reload_time'):
-            TempData.session_reload_time = int(
-                HLSSessionPlugin.get_option('time')
-                or 0)
-
-        if not hasattr(TempData, 'cached_data'):
-            TempData.cached_data = {}
-            # set a timestamp, if it was not set previously
-            if not TempData.cached_data.get('timestamp'):
-                TempData.cached_data.update({'timestamp': int(time())})
-
-            TempData.cached_data.update({'stream_name': 'best'})
-            TempData.cached_data.update({'url': urlnoproto})
-
         streams = self.session.streams(
             urlnoproto, stream_types=['hls'])
 
@@ -287,15 +2008,37 @@ class HLSSessionPlugin(Plugin):
                       ' stream is not available.')
             return
 
+        session_url = urlnoproto
         stream = streams['best']
         urlnoproto = stream.url
 
         self.logger.debug('URL={0}; params={1}', urlnoproto, params)
         streams = HLSSessionHLSStream.parse_variant_playlist(self.session, urlnoproto, **params)
         if not streams:
-            return {'live': HLSSessionHLSStream(self.session, urlnoproto, **params)}
-        else:
-            return streams
+            streams = {'live': HLSSessionHLSStream(self.session, urlnoproto, **params)}
+
+        # every stream has its own session data,
+        # multiple streams can be used in the same process
+        session_options = dict(
+            (key, self.get_option(key))
+            for key in ('hedge', 'ignore_number', 'latency', 'latency_drain',
+                        'low_latency', 'metrics_file', 'metrics_port',
+                        'prefetch', 'prefetch_size', 'prefetch_spill',
+                        'segment', 'standby', 'time'))
+        if session_options['metrics_file']:
+            HLSSessionMetrics.filename = session_options['metrics_file']
+        if session_options['metrics_port']:
+            HLSSessionMetrics.serve(session_options['metrics_port'])
+        standby_urls = {}
+        if session_options['standby']:
+            # urlnoproto is the media playlist of the best variant
+            standby_urls = self._get_standby_urls(self.session, session_url, params)
+        for stream in streams.values():
+            if isinstance(stream, HLSSessionHLSStream):
+                stream.session_url = session_url
+                stream.session_options = session_options
+                stream.session_standby_urls = standby_urls.get(stream.url, [])
+        return streams
 
 
 __plugin__ = HLSSessionPlugin
@@ -4,18 +4,383 @@ import random
 import re
 import uuid
 
+from concurrent import futures
+from functools import partial
+from threading import Event, Lock, Thread
+from time import sleep, time
+
 from streamlink.compat import unquote
-from streamlink.exceptions import NoStreamsError
-from streamlink.plugin import Plugin
+from streamlink.exceptions import NoStreamsError, PluginError
+from streamlink.plugin import Plugin, PluginArgument, PluginArguments
 from streamlink.plugin.api import http
 from streamlink.plugin.api import useragents
 from streamlink.stream import HLSStream
 
-from websocket import create_connection
+from websocket import WebSocketTimeoutException, create_connection
 
 log = logging.getLogger(__name__)
 
 
+class FCSFrameParser(object):
+    '''Incremental parser of the FCS messages of the WebSocket
+
+    Every message starts with its length as 4 digits,
+    followed by `FCTYPE FROM TO ARG1 ARG2 DATA`.
+    The buffer is read with a cursor, an incomplete message
+    stays in the buffer until the next feed.
+    '''
+    header_size = 4
+    separators = bytearray(b' \r\n\0')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        '''Yields (fctype, message) of every complete message'''
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode('utf-8')
+
+        buffer = self.buffer
+        # remove the messages of the last feed at once
+        if self.pos:
+            del buffer[:self.pos]
+            self.pos = 0
+        buffer.extend(data)
+
+        separators = self.separators
+        header_size = self.header_size
+        pos = self.pos
+        size = len(buffer)
+        while True:
+            while pos < size and buffer[pos] in separators:
+                pos += 1
+            self.pos = pos
+
+            header = bytes(buffer[pos:pos + header_size])
+            if len(header) < header_size:
+                return
+            if not header.isdigit():
+                log.debug('Invalid FCS message: {0!r}'.format(bytes(buffer[pos:pos + 20])))
+                self.pos = size
+                return
+
+            start = pos + header_size
+            pos = start + int(header)
+            if pos > size:
+                return
+
+            message = buffer[start:pos].decode('utf-8', 'replace')
+            self.pos = pos
+            fctype = message.partition(' ')[0]
+            if fctype.isdigit():
+                yield int(fctype), message
+
+
+class ChatServers(object):
+    '''Connects to the fastest of `race` chat servers
+
+    The handshake is started with `race` servers at the same time,
+    the first server is used and the other WebSockets are closed.
+    A handshake returns the WebSocket and the first frame of the server,
+    a server that accepts the connection but stalls can't win the race.
+    The latency and the failures of every server are remembered,
+    fast servers without failures are chosen more often.
+    '''
+    race = 3
+    tries = 3
+    # weight of a new latency
+    alpha = 0.3
+
+    lock = Lock()
+    # server: {'latency': seconds, 'failures': int}
+    stats = {}
+
+    @classmethod
+    def record(cls, server, latency=None):
+        '''latency of a handshake, None for a failure'''
+        with cls.lock:
+            stats = cls.stats.setdefault(server, {'latency': None, 'failures': 0})
+            if latency is None:
+                stats['failures'] += 1
+            else:
+                if stats['latency'] is None:
+                    stats['latency'] = latency
+                else:
+                    stats['latency'] += cls.alpha * (latency - stats['latency'])
+                stats['failures'] //= 2
+
+    @classmethod
+    def choose(cls, servers, k):
+        '''weighted random sample of k servers'''
+        with cls.lock:
+            latencies = [s['latency'] for s in cls.stats.values() if s['latency'] is not None]
+            # unknown servers are chosen like an average server
+            default = sum(latencies) / len(latencies) if latencies else 1.0
+            keys = []
+            for server in servers:
+                stats = cls.stats.get(server, {})
+                latency = max(stats.get('latency') or default, 0.001)
+                weight = 1.0 / (latency * (1 + stats.get('failures', 0)))
+                keys.append((random.random() ** (1.0 / weight), server))
+        return [server for key, server in sorted(keys, reverse=True)[:k]]
+
+    @staticmethod
+    def timed(handshake, server):
+        start = time()
+        ws, frame = handshake(server)
+        return ws, frame, time() - start
+
+    @classmethod
+    def discard(cls, server, future):
+        '''record and close a WebSocket that lost the race'''
+        try:
+            ws, frame, latency = future.result()
+        except Exception:
+            cls.record(server)
+            return
+        cls.record(server, latency)
+        ws.close()
+
+    @classmethod
+    def connect(cls, servers, handshake):
+        '''Returns the server, the WebSocket and the first frame of handshake(server)'''
+        if not servers:
+            raise PluginError('No chat servers found')
+
+        error = None
+        for attempt in range(1, cls.tries + 1):
+            candidates = cls.choose(servers, cls.race)
+            executor = futures.ThreadPoolExecutor(max_workers=len(candidates))
+            jobs = dict((executor.submit(cls.timed, handshake, server), server)
+                        for server in candidates)
+            winner = None
+            pending = set(jobs)
+            while pending and winner is None:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    server = jobs[future]
+                    try:
+                        ws, frame, latency = future.result()
+                    except Exception as e:
+                        error = e
+                        cls.record(server)
+                        log.debug('Failed to connect to WS server: {0} - {1}'.format(server, e))
+                        continue
+                    cls.record(server, latency)
+                    if winner is None:
+                        winner = server, ws, frame
+                    else:
+                        ws.close()
+
+            for future in pending:
+                future.add_done_callback(partial(cls.discard, jobs[future]))
+            executor.shutdown(wait=False)
+            if winner is not None:
+                return winner
+            log.debug('Failed to connect to WS servers: {0} - try {1}'.format(
+                ', '.join(candidates), attempt))
+
+        log.error('can\'t connect to the websocket')
+        raise PluginError('Failed to connect to a chat server: {0}'.format(error))
+
+
+class ModelIndex(object):
+    '''Models of one long-lived guest session, for --myfreecams-daemon
+
+    The index is loaded from the PHP roster of the login
+    and updated with the session states of the WebSocket.
+    Lookups are only answered after the roster was loaded.
+    '''
+    heartbeat_interval = 15.0
+    reconnect_delay = 10.0
+
+    lock = Lock()
+    thread = None
+    ready = Event()
+    # uid: data like the WebSocket user lookup
+    models = {}
+    # lower username: uid
+    names = {}
+    # sid: uid
+    sids = {}
+    php_message = ''
+
+    @classmethod
+    def start(cls, chat_servers):
+        with cls.lock:
+            if cls.thread is None:
+                cls.thread = Thread(target=cls.run, args=(chat_servers,), name='MyFreeCamsModelIndex')
+                cls.thread.daemon = True
+                cls.thread.start()
+
+    @classmethod
+    def get(cls, username=None, uid=None):
+        '''data of a model, None if the index is cold or doesn't know the model'''
+        if not cls.ready.is_set():
+            return None
+        with cls.lock:
+            if uid is None and username:
+                uid = cls.names.get(username.lower())
+            model = cls.models.get(int(uid)) if uid is not None else None
+            # a session state without the room data
+            if model is None or 'vs' not in model or 'camserv' not in model['u']:
+                return None
+            data = dict(model)
+            data['u'] = dict(model['u'])
+        return data
+
+    @classmethod
+    def clear(cls):
+        cls.ready.clear()
+        with cls.lock:
+            cls.models.clear()
+            cls.names.clear()
+            cls.sids.clear()
+            cls.php_message = ''
+
+    @classmethod
+    def update(cls, data):
+        '''merge a session state or a roster entry'''
+        with cls.lock:
+            uid = data.get('uid')
+            if uid is None:
+                uid = cls.sids.get(data.get('sid'))
+            if uid is None:
+                return
+            uid = int(uid)
+            model = cls.models.setdefault(uid, {'uid': uid, 'u': {}})
+            for key in ('nm', 'sid', 'vs'):
+                if data.get(key) is not None:
+                    model[key] = data[key]
+            camserv = (data.get('u') or {}).get('camserv')
+            if camserv is not None:
+                model['u']['camserv'] = camserv
+            if model.get('nm'):
+                cls.names[model['nm'].lower()] = uid
+            if model.get('sid'):
+                cls.sids[model['sid']] = uid
+
+    @classmethod
+    def load_roster(cls, php_message):
+        for data in MyFreeCams._php_models(php_message):
+            cls.update(data)
+        with cls.lock:
+            cls.php_message = php_message
+            count = len(cls.models)
+        log.debug('Model index: {0} models'.format(count))
+        cls.ready.set()
+
+    @classmethod
+    def run(cls, chat_servers):
+        while True:
+            try:
+                cls.session(chat_servers)
+            except Exception as e:
+                log.debug('Model index: {0}'.format(e))
+            cls.clear()
+            sleep(cls.reconnect_delay)
+
+    @classmethod
+    def session(cls, chat_servers):
+        xchat, ws, frame = ChatServers.connect([str(x) for x in chat_servers], MyFreeCams._chat_handshake)
+        try:
+            log.debug('Model index: WebSocket server {0} connected'.format(xchat))
+            ws.settimeout(cls.heartbeat_interval)
+            heartbeat = time() + cls.heartbeat_interval
+            parser = FCSFrameParser()
+            while True:
+                for fctype, message in parser.feed(frame):
+                    message = unquote(message)
+                    if fctype == 20:
+                        data = MyFreeCams._dict_re.search(message)
+                        if data is not None:
+                            cls.update(json.loads(data.group('data')))
+                    elif fctype == 81:
+                        cls.load_roster(message)
+
+                if time() >= heartbeat:
+                    ws.send('0 0 0 0 0 -\n')
+                    heartbeat = time() + cls.heartbeat_interval
+                try:
+                    frame = ws.recv()
+                except WebSocketTimeoutException:
+                    frame = ''
+                    continue
+                if not ws.connected:
+                    return
+        finally:
+            ws.close()
+
+
+class VideoServers(object):
+    '''Playlist latency of the video servers
+
+    If a model is on more than one video server, the playlist
+    of every server is fetched in the background,
+    the next resolves use the fastest server.
+
+    serverconfig.js maps every camserv to a single h5video server,
+    this is never used with it. It is only used if the site
+    sends a list of servers for a camserv.
+    '''
+    # weight of a new latency
+    alpha = 0.3
+    max_workers = 4
+    timeout = 10.0
+
+    lock = Lock()
+    executor = None
+    # server: seconds, None after a failure
+    stats = {}
+    measuring = set()
+
+    @classmethod
+    def record(cls, server, latency=None):
+        with cls.lock:
+            last = cls.stats.get(server)
+            if latency is not None and last is not None:
+                latency = last + cls.alpha * (latency - last)
+            cls.stats[server] = latency
+
+    @classmethod
+    def rank(cls, servers):
+        '''measured servers by latency, then unknown and failed servers'''
+        with cls.lock:
+            def key(item):
+                index, server = item
+                if server not in cls.stats:
+                    return 1, 0, index
+                if cls.stats[server] is None:
+                    return 2, 0, index
+                return 0, cls.stats[server], index
+            return [server for index, server in sorted(enumerate(servers), key=key)]
+
+    @classmethod
+    def fetch(cls, server, url):
+        try:
+            start = time()
+            http.get(url, timeout=cls.timeout)
+            cls.record(server, time() - start)
+        except Exception as e:
+            log.debug('Video server {0} failed: {1}'.format(server, e))
+            cls.record(server)
+        finally:
+            with cls.lock:
+                cls.measuring.discard(server)
+
+    @classmethod
+    def measure(cls, servers, url):
+        '''fetch url(server) of every server in the background'''
+        with cls.lock:
+            if cls.executor is None:
+                cls.executor = futures.ThreadPoolExecutor(max_workers=cls.max_workers)
+            servers = [server for server in servers if server not in cls.measuring]
+            cls.measuring.update(servers)
+        for server in servers:
+            cls.executor.submit(cls.fetch, server, url(server))
+
+
 class MyFreeCams(Plugin):
     '''streamlink Plugin for MyFreeCams
 
@@ -35,12 +400,66 @@ class MyFreeCams(Plugin):
 
     _url_re = re.compile(r'''https?://(?:\w+\.)?myfreecams\.com/(?:(?:models/)?#?(?P<username>\w+)|\?id=(?P<user_id>\d+))''')
     _dict_re = re.compile(r'''(?P<data>{.*})''')
-    _socket_re = re.compile(r'''(\w+) (\w+) (\w+) (\w+) (\w+)''')
+    _php_models_re = re.compile(
+        r'''\[["'](?P<username>[^"']+)["'],(?P<sid>\d+),'''
+        + r'''(?P<uid>\d+),(?P<vs>\d+),[^,]+,[^,]+,(?P<camserv>\d+)[^\]]+\]''')
+
+    php_index_ttl = 60.0
+    # expires, names and uids of the php roster
+    php_index = {}
+    php_index_lock = Lock()
+
+    server_config_ttl = 600.0
+    # servers, expires, etag and last_modified of serverconfig.js
+    server_config = {}
+    server_config_lock = Lock()
+
+    arguments = PluginArguments(
+        PluginArgument(
+            'daemon',
+            action='store_true',
+            help='''
+        Keep one guest session for every resolve of this process
+        and look up the models in an index of its room list.
+        The first resolve starts the session and doesn't use the index.
+        '''
+        ),
+    )
 
     @classmethod
     def can_handle_url(cls, url):
         return cls._url_re.match(url)
 
+    @classmethod
+    def _php_models(cls, php_message):
+        '''Models of the php website, the roster of a login'''
+        php_data = cls._dict_re.search(php_message)
+        if php_data is None:
+            return
+
+        php_data = json.loads(php_data.group('data'))
+        php_url = cls.PHP_URL.format(
+            opts=php_data['opts'],
+            respkey=php_data['respkey'],
+            serv=php_data['serv'],
+            type=php_data['type']
+        )
+        php_params = {
+            'cid': 3149,
+            'gw': 1
+        }
+        res = http.get(php_url, params=php_params)
+        for match in cls._php_models_re.finditer(res.text):
+            yield {
+                'nm': str(match.group('username')),
+                'sid': int(match.group('sid')),
+                'uid': int(match.group('uid')),
+                'vs': int(match.group('vs')),
+                'u': {
+                    'camserv': int(match.group('camserv'))
+                }
+            }
+
     def _php_fallback(self, username, user_id, php_message):
         '''Use the php website as a fallback when
             - UserId was used
@@ -55,50 +474,64 @@ class MyFreeCams(Plugin):
             message: data to create a video url.
         '''
         log.debug('Trying to use php fallback')
-        php_data = self._dict_re.search(php_message)
-        if php_data is None:
+        if not (username or user_id):
             raise NoStreamsError(self.url)
 
-        php_data = json.loads(php_data.group('data'))
-        php_url = self.PHP_URL.format(
-            opts=php_data['opts'],
-            respkey=php_data['respkey'],
-            serv=php_data['serv'],
-            type=php_data['type']
-        )
-        php_params = {
-            'cid': 3149,
-            'gw': 1
-        }
-        res = http.get(php_url, params=php_params)
-
-        if username:
-            _username_php_re = str(username)
-            _uid_php_re = r'''\d+'''
-        elif user_id:
-            _username_php_re = r'''[^"']+'''
-            _uid_php_re = str(user_id)
-        else:
+        with self.php_index_lock:
+            cached_index = self.php_index
+        index = self._php_index(php_message)
+        data = self._php_model(index, username, user_id)
+        if data is None and index is cached_index:
+            # the model can be newer than the cached index
+            log.debug('Model is not in the cached php index, reloading it')
+            index = self._php_index(php_message, refresh=True)
+            data = self._php_model(index, username, user_id)
+        if data is None:
             raise NoStreamsError(self.url)
 
-        _data_php_re = re.compile(
-            r'''\[["'](?P<username>{0})["'],(?P<sid>\d+),'''.format(_username_php_re)
-            + r'''(?P<uid>{0}),(?P<vs>\d+),[^,]+,[^,]+,(?P<camserv>\d+)[^\]]+\]'''.format(_uid_php_re))
+        data = dict(data)
+        data['u'] = dict(data['u'])
+        return data
 
-        match = _data_php_re.search(res.text)
-        if match is None:
-            raise NoStreamsError(self.url)
+    @staticmethod
+    def _php_model(index, username, user_id):
+        if username:
+            return index['names'].get(username.lower())
+        return index['uids'].get(int(user_id))
 
-        data = {
-            'nm': str(match.group('username')),
-            'sid': int(match.group('sid')),
-            'uid': int(match.group('uid')),
-            'vs': int(match.group('vs')),
-            'u': {
-                'camserv': int(match.group('camserv'))
-            }
-        }
-        return data
+    @classmethod
+    def _php_index(cls, php_message, refresh=False):
+        '''Models of the php website by username and uid, cached for php_index_ttl'''
+        with cls.php_index_lock:
+            index = cls.php_index
+        if not refresh and index and index['expires'] > time():
+            return index
+
+        names = {}
+        uids = {}
+        for data in cls._php_models(php_message):
+            names[data['nm'].lower()] = data
+            uids[data['uid']] = data
+        index = {'expires': time() + cls.php_index_ttl, 'names': names, 'uids': uids}
+        # an empty roster is not cached
+        if uids:
+            with cls.php_index_lock:
+                cls.php_index = index
+        return index
+
+    @staticmethod
+    def _chat_handshake(xchat):
+        '''Guest login, returns the WebSocket and the first frame of the server'''
+        ws = create_connection('wss://{0}.myfreecams.com/fcsl'.format(xchat))
+        try:
+            ws.send('hello fcserver\n\0')
+            r_id = str(uuid.uuid4().hex[0:32])
+            ws.send('1 0 0 20071025 0 {0}@guest:guest\n'.format(r_id))
+            frame = ws.recv()
+        except Exception:
+            ws.close()
+            raise
+        return ws, frame
 
     def _websocket_data(self, username, chat_servers):
         '''Get data from the websocket.
@@ -111,76 +544,86 @@ class MyFreeCams(Plugin):
             message: data to create a video url.
             php_message: data for self._php_fallback
         '''
-        try_to_connect = 0
-        while (try_to_connect < 3):
-            try:
-                xchat = str(random.choice(chat_servers))
-                host = 'wss://{0}.myfreecams.com/fcsl'.format(xchat)
-                ws = create_connection(host)
-                ws.send('hello fcserver\n\0')
-                r_id = str(uuid.uuid4().hex[0:32])
-                ws.send('1 0 0 20071025 0 {0}@guest:guest\n'.format(r_id))
-                log.debug('Websocket server {0} connected'.format(xchat))
-                try_to_connect = 3
-            except Exception:
-                try_to_connect = try_to_connect + 1
-                log.debug('Failed to connect to WS server: {0} - try {1}'.format(xchat, try_to_connect))
-                if try_to_connect == 5:
-                    log.error('can\'t connect to the websocket')
-                    raise
+        xchat, ws, frame = ChatServers.connect([str(x) for x in chat_servers], self._chat_handshake)
+        log.debug('Websocket server {0} connected'.format(xchat))
 
-        buff = ''
+        parser = FCSFrameParser()
+        message = ''
         php_message = ''
-        ws_close = 0
-        while ws_close == 0:
-            socket_buffer = ws.recv()
-            socket_buffer = buff + socket_buffer
-            buff = ''
-            while True:
-                ws_answer = self._socket_re.search(socket_buffer)
-                if bool(ws_answer) == 0:
-                    break
-
-                FC = ws_answer.group(1)
-                FCTYPE = int(FC[4:])
-
-                message_length = int(FC[0:4])
-                message = socket_buffer[4:4 + message_length]
-
-                if len(message) < message_length:
-                    buff = ''.join(socket_buffer)
-                    break
-
+        ws_close = False
+        # the first frame was received by the handshake
+        while True:
+            for fctype, message in parser.feed(frame):
                 message = unquote(message)
 
-                if FCTYPE == 1 and username:
+                if fctype == 1 and username:
                     ws.send('10 0 0 20 0 {0}\n'.format(username))
-                elif FCTYPE == 81:
+                elif fctype == 81:
                     php_message = message
                     if username is None:
-                        ws_close = 1
-                elif FCTYPE == 10:
-                    ws_close = 1
-
-                socket_buffer = socket_buffer[4 + message_length:]
-
-                if len(socket_buffer) == 0:
+                        ws_close = True
+                        break
+                elif fctype == 10:
+                    ws_close = True
                     break
+            if ws_close:
+                break
+            frame = ws.recv()
 
         ws.send('99 0 0 0 0')
         ws.close()
         return message, php_message
 
-    def _get_servers(self):
-        '''Gets all servers.'''
-        res = http.get(self.JS_SERVER_URL)
-        servers = json.loads(res.text)
+    @classmethod
+    def _get_servers(cls):
+        '''Gets all servers, cached for server_config_ttl.'''
+        with cls.server_config_lock:
+            config = dict(cls.server_config)
+
+        servers = config.get('servers')
+        if servers is None or config['expires'] <= time():
+            headers = {}
+            if config.get('etag'):
+                headers['If-None-Match'] = config['etag']
+            if config.get('last_modified'):
+                headers['If-Modified-Since'] = config['last_modified']
+
+            try:
+                res = http.get(cls.JS_SERVER_URL, headers=headers)
+            except PluginError as e:
+                if servers is None:
+                    raise
+                log.debug('Using the old server config: {0}'.format(e))
+            else:
+                if res.status_code != 304 or servers is None:
+                    servers = json.loads(res.text)
+                with cls.server_config_lock:
+                    cls.server_config = {
+                        'servers': servers,
+                        'expires': time() + cls.server_config_ttl,
+                        'etag': res.headers.get('ETag') or config.get('etag'),
+                        'last_modified': res.headers.get('Last-Modified') or config.get('last_modified'),
+                    }
 
         chat_servers = servers.get('chat_servers')
         h5video_servers = servers.get('h5video_servers')
 
         return chat_servers, h5video_servers
 
+    @staticmethod
+    def _video_servers(video_servers, camserver):
+        '''video servers of a camserv
+
+        serverconfig.js has one server for a camserv,
+        a list of servers is not sent by the site.
+        '''
+        servers = video_servers.get(str(camserver))
+        if not servers:
+            return []
+        if not isinstance(servers, list):
+            return [servers]
+        return servers
+
     def _get_streams(self):
         http.headers.update({'User-Agent': useragents.FIREFOX})
         log.debug('Version 2018-07-01')
@@ -192,16 +635,25 @@ class MyFreeCams(Plugin):
 
         chat_servers, video_servers = self._get_servers()
 
-        message, php_message = self._websocket_data(username, chat_servers)
+        data = None
+        if self.get_option('daemon'):
+            ModelIndex.start(chat_servers)
+            data = ModelIndex.get(username=username, uid=user_id)
+            php_message = ModelIndex.php_message
 
-        if user_id and not username:
-            data = self._php_fallback(username, user_id, php_message)
+        if data is not None:
+            log.debug('Using the model index')
         else:
-            log.debug('Trying to use WebSocket data')
-            data = self._dict_re.search(message)
-            if data is None:
-                raise NoStreamsError(self.url)
-            data = json.loads(data.group('data'))
+            message, php_message = self._websocket_data(username, chat_servers)
+
+            if user_id and not username:
+                data = self._php_fallback(username, user_id, php_message)
+            else:
+                log.debug('Trying to use WebSocket data')
+                data = self._dict_re.search(message)
+                if data is None:
+                    raise NoStreamsError(self.url)
+                data = json.loads(data.group('data'))
 
         vs = data.get('vs')
         ok_vs = [0, 90]
@@ -222,12 +674,18 @@ class MyFreeCams(Plugin):
         uid = data.get('uid')
         uid_video = uid + 100000000
         camserver = data['u']['camserv']
-        server = video_servers.get(str(camserver))
+        servers = self._video_servers(video_servers, camserver)
 
-        if server is None and not user_id:
+        if not servers and not user_id:
             fallback_data = self._php_fallback(username, user_id, php_message)
             camserver = fallback_data['u']['camserv']
-            server = video_servers.get(str(camserver))
+            servers = self._video_servers(video_servers, camserver)
+
+        # only with a list of servers for a camserv, see VideoServers
+        if len(servers) > 1:
+            VideoServers.measure(servers, lambda server: self.HLS_VIDEO_URL.format(server, uid_video))
+            servers = VideoServers.rank(servers)
+        server = servers[0] if servers else None
 
         log.info('Username: {0}'.format(nm))
         log.info('User ID:  {0}'.format(uid))
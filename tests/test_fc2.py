@@ -1,6 +1,54 @@
+import json
+import requests_mock
+import socket
+import threading
+import time
 import unittest
 
-from plugins.fc2 import FC2
+from threading import Event
+from websocket import ABNF, WebSocket
+
+from streamlink.plugin.api import HTTPSession
+
+from plugins.fc2 import ControlClient, ControlScheduler, FC2
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    # python 2.7
+    from mock import patch
+
+
+class FakeWebSocket(object):
+    '''WebSocket with a list of messages, select() sees the unread messages'''
+
+    def __init__(self, messages):
+        self.sock, self.server = socket.socketpair()
+        self.connected = True
+        self.messages = []
+        self.sent = []
+        for message in messages:
+            self.add_message(message)
+
+    def add_message(self, message):
+        self.messages.append(json.dumps(message).encode('utf-8'))
+        self.server.send(b'.')
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def send(self, payload):
+        self.sent.append(json.loads(payload)['name'])
+
+    def recv_data(self, control_frame=False):
+        self.sock.recv(1)
+        return ABNF.OPCODE_TEXT, self.messages.pop(0)
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            self.sock.close()
+            self.server.close()
 
 
 class TestPluginFC2(unittest.TestCase):
@@ -18,3 +66,236 @@ class TestPluginFC2(unittest.TestCase):
         ]
         for url in should_not_match:
             self.assertFalse(FC2.can_handle_url(url))
+
+
+def member_data(version):
+    return {
+        'status': 1,
+        'data': {
+            'channel_data': {
+                'channelid': '1', 'userid': '1', 'adult': 0, 'login_only': 0,
+                'version': version, 'fee': 0,
+            },
+            'user_data': {
+                'is_login': 0, 'userid': 0, 'fc2id': 0, 'name': '', 'point': 0,
+                'adult_access': 0, 'recauth': 0,
+            },
+        },
+    }
+
+
+class TestFC2ChannelStatus(unittest.TestCase):
+    def setUp(self):
+        FC2.clear_member_cache()
+
+    def tearDown(self):
+        FC2.clear_member_cache()
+
+    def control_server(self, request, context):
+        if 'channel_id=3' in request.text:
+            context.status_code = 500
+            return {}
+        if 'channel_id=2' in request.text:
+            return {'status': 11}
+        return {'status': 0, 'url': 'wss://test.se/control', 'control_token': 'a'}
+
+    @patch('plugins.fc2.http', HTTPSession())
+    def test_channel_status(self):
+        with requests_mock.Mocker() as mock:
+            member_api = mock.post(FC2.url_member_api, json=member_data('v1'))
+            mock.post(FC2.url_server, json=self.control_server)
+
+            self.assertEqual(FC2.channel_status(['1', '2', '3'], threads=2),
+                             {'1': 'live', '2': 'offline', '3': 'error'})
+            self.assertEqual(member_api.call_count, 3)
+
+            self.assertEqual(FC2.channel_status(['1', '2']), {'1': 'live', '2': 'offline'})
+            self.assertEqual(member_api.call_count, 3)
+
+            # a resolve uses the cached member data
+            plugin = FC2('https://live.fc2.com/1/')
+            self.assertEqual(plugin._get_version('1'), 'v1')
+            self.assertEqual(member_api.call_count, 3)
+
+    @patch('plugins.fc2.http', HTTPSession())
+    def test_member_cache_ttl(self):
+        with requests_mock.Mocker() as mock, patch.object(FC2, 'member_cache_ttl', -1):
+            member_api = mock.post(FC2.url_member_api, [
+                {'json': member_data('v1')}, {'json': member_data('v2')}])
+
+            self.assertEqual(FC2._get_member_data('1')[0]['version'], 'v1')
+            self.assertEqual(FC2._get_member_data('1')[0]['version'], 'v2')
+            self.assertEqual(member_api.call_count, 2)
+
+
+class TestFC2WebSocket(unittest.TestCase):
+    def setUp(self):
+        self.plugin = FC2('https://live.fc2.com/12345678/')
+
+    def get_ws_data(self, messages):
+        ws = FakeWebSocket(messages)
+        with patch('plugins.fc2.create_connection', return_value=ws):
+            result = self.plugin._get_ws_data('wss://test.se/control')
+        return ws, result
+
+    def test_host_data(self):
+        host_data = {'name': '_response_', 'arguments': {'host': 'test.se'}}
+        ws, result = self.get_ws_data([
+            {'name': 'user_count', 'arguments': {}},
+            host_data,
+        ])
+        self.assertEqual(result, host_data)
+        self.assertEqual(ws.sent[:2], ['get_media_server_information', 'heartbeat'])
+        ws.close()
+
+    def test_control_disconnection(self):
+        self.plugin.host_timeout = 10.0
+        ws, result = self.get_ws_data([
+            {'name': 'control_disconnection', 'arguments': {'code': 4512}},
+        ])
+        self.assertIsNone(result)
+        self.assertFalse(ws.connected)
+
+    def test_host_timeout(self):
+        self.plugin.host_timeout = 0.1
+        ws, result = self.get_ws_data([
+            {'name': 'user_count', 'arguments': {}},
+        ])
+        self.assertIsNone(result)
+        self.assertFalse(ws.connected)
+
+    def test_clients(self):
+        sockets = [
+            FakeWebSocket([{'name': '_response_', 'arguments': {'host': 'a.test.se'}}]),
+            FakeWebSocket([
+                {'name': 'user_count', 'arguments': {}},
+                {'name': '_response_', 'arguments': {'host': 'b.test.se'}},
+            ]),
+        ]
+        with patch('plugins.fc2.create_connection', side_effect=sockets):
+            clients = [ControlClient('wss://test.se/{0}'.format(i)).connect() for i in range(2)]
+
+        self.assertEqual([c.wait(5)['arguments']['host'] for c in clients],
+                         ['a.test.se', 'b.test.se'])
+        self.assertEqual([c.count for c in clients], [1, 2])
+        for client in clients:
+            client.close()
+        self.assertFalse(any(ws.connected for ws in sockets))
+
+
+class TestControlScheduler(unittest.TestCase):
+    def test_connections(self):
+        messages = {}
+        threads = None
+        sockets = []
+        for i in range(3):
+            ws = FakeWebSocket([{'name': 'user_count', 'id': i}])
+            sockets.append(ws)
+            ControlScheduler.add(
+                ws, lambda i=i: json.dumps({'name': 'heartbeat', 'id': i}),
+                lambda message: messages.setdefault(json.loads(message)['id'], message),
+                lambda: None)
+            if threads is None:
+                threads = threading.active_count()
+
+        for i in range(50):
+            if len(messages) == 3:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(sorted(messages), [0, 1, 2])
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual([ws.sent for ws in sockets], [['heartbeat']] * 3)
+
+        for ws in sockets:
+            ws.close()
+
+    def test_close(self):
+        closed = Event()
+        ws = FakeWebSocket([])
+        ControlScheduler.add(ws, lambda: json.dumps({'name': 'heartbeat'}),
+                             lambda message: False, closed.set)
+        ws.add_message({'name': 'control_disconnection'})
+        self.assertTrue(closed.wait(5))
+        self.assertFalse(ws.connected)
+
+
+def text_frame(message):
+    '''unmasked text frame of the server'''
+    payload = json.dumps(message).encode('utf-8')
+    return bytes(bytearray([0x81, len(payload)])) + payload
+
+
+class SocketPairWebSocket(WebSocket):
+    '''WebSocket with the client end of a socketpair'''
+
+    def __init__(self):
+        WebSocket.__init__(self)
+        self.sock, self.server = socket.socketpair()
+        self.connected = True
+
+    def close(self, *args, **kwargs):
+        if self.connected:
+            self.connected = False
+            self.sock.close()
+            self.server.close()
+
+
+class TestControlSchedulerStall(unittest.TestCase):
+    def test_partial_frame(self):
+        heartbeats = []
+        messages = []
+        stalled = SocketPairWebSocket()
+        ws = SocketPairWebSocket()
+        with patch.object(ControlScheduler, 'heartbeat_interval', 0.2):
+            ControlScheduler.add(stalled, lambda: json.dumps({'name': 'heartbeat'}),
+                                 messages.append, lambda: None)
+            ControlScheduler.add(ws, lambda: heartbeats.append(time.time()) or json.dumps({'name': 'heartbeat'}),
+                                 messages.append, lambda: None)
+            try:
+                # the server stalls after a part of the frame
+                frame = text_frame({'name': 'user_count'})
+                stalled.server.send(frame[:5])
+                time.sleep(1.0)
+                # the other WebSocket has its heartbeats on time
+                self.assertGreaterEqual(len(heartbeats), 4)
+                self.assertLess(max(b - a for a, b in zip(heartbeats, heartbeats[1:])), 0.6)
+
+                # the rest of the frame
+                stalled.server.send(frame[5:])
+                for i in range(50):
+                    if messages:
+                        break
+                    time.sleep(0.05)
+                self.assertEqual(messages, ['{"name": "user_count"}'])
+                self.assertTrue(stalled.connected)
+            finally:
+                stalled.close()
+                ws.close()
+
+    def test_partial_frame_timeout(self):
+        closed = Event()
+        stalled = SocketPairWebSocket()
+        with patch.object(ControlScheduler, 'recv_timeout', 0.3):
+            ControlScheduler.add(stalled, lambda: json.dumps({'name': 'heartbeat'}),
+                                 lambda message: None, closed.set)
+            stalled.server.send(text_frame({'name': 'user_count'})[:5])
+            self.assertTrue(closed.wait(5))
+        self.assertFalse(stalled.connected)
+
+
+class TestControlClient(unittest.TestCase):
+    def test_ignored_messages(self):
+        client = ControlClient('wss://test.se/control')
+        with patch('plugins.fc2.json.loads', wraps=json.loads) as loads:
+            # not decoded, even with broken JSON
+            client.on_message('{"name":"comment","arguments":{"comment":"a')
+            client.on_message('{ "name" : "user_count", "arguments": {}}')
+            self.assertEqual(loads.call_count, 0)
+
+            # the name is not at the start
+            client.on_message('{"arguments":{"name":"user_count","host":"test.se"},"name":"_response_"}')
+            self.assertEqual(loads.call_count, 1)
+
+        self.assertEqual(client.count, 3)
+        self.assertEqual(client.host_data['arguments']['host'], 'test.se')
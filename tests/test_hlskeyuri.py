@@ -0,0 +1,489 @@
+import re
+import requests
+import requests_mock
+import shutil
+import tempfile
+import time
+import unittest
+
+from Crypto.Cipher import AES
+
+from streamlink import Streamlink
+from streamlink.buffers import RingBuffer
+from streamlink.stream.hls import Sequence
+from streamlink.stream.hls_playlist import ByteRange, Key, Segment
+
+from plugins.hlskeyuri import (
+    DecryptPool, HedgedRequests, HLSKeyUriPlugin, KeyStore, KeyUriHLSStream, KeyUriHLSStreamReader,
+    KeyUriHLSStreamWriter, PrefetchResponse, key_uri_candidates,
+)
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    # python 2.7
+    from mock import patch
+
+text_encrypted_hls = '''#EXTM3U
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:1
+#EXT-X-KEY:METHOD=AES-128,URI="http://test.se/key",IV=0x{iv}
+#EXTINF:2.000,
+1.ts
+#EXTINF:2.000,
+2.ts
+#EXT-X-ENDLIST
+'''
+
+
+class BrokenResponse(object):
+    '''Response that fails after size bytes of the body'''
+
+    def __init__(self, content, size, request=None):
+        self.content = content
+        self.size = size
+        self.request = request
+
+    def iter_content(self, chunk_size):
+        for i in range(0, self.size, chunk_size):
+            yield self.content[i:min(i + chunk_size, self.size)]
+        raise IOError('Connection broken')
+
+    def close(self):
+        pass
+
+
+def read_all(fd):
+    '''Reads the stream until the end'''
+    data = b''
+    while True:
+        chunk = fd.read(8192)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def iv_hex(iv):
+    return ''.join('{0:02x}'.format(c) for c in bytearray(iv))
+
+
+def encrypt(data, key, iv):
+    padding = 16 - len(data) % 16
+    data += bytes(bytearray([padding] * padding))
+    return AES.new(key, AES.MODE_CBC, iv).encrypt(data)
+
+
+class TestPluginHLSKeyUri(unittest.TestCase):
+    def test_can_handle_url(self):
+        should_match = [
+            'hlskeyuri://https://example.com/index.m3u8',
+            'hlskeyuri://example.com/live',
+        ]
+        for url in should_match:
+            self.assertTrue(HLSKeyUriPlugin.can_handle_url(url))
+
+        should_not_match = [
+            'https://example.com/index.m3u8',
+            'hlssession://https://example.com/index.m3u8',
+        ]
+        for url in should_not_match:
+            self.assertFalse(HLSKeyUriPlugin.can_handle_url(url))
+
+
+class TestKeyStore(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_set_key(self):
+        with patch('streamlink.cache.cache_dir', self.cache_dir):
+            KeyStore(60, 2).set_key('http://test.se/key/1', b'1' * 16)
+            store = KeyStore(60, 2)
+
+        self.assertEqual(store.get_key('http://test.se/key/1'), b'1' * 16)
+        self.assertIsNone(store.get_key('http://test.se/key/2'))
+
+    def test_size(self):
+        with patch('streamlink.cache.cache_dir', self.cache_dir):
+            store = KeyStore(60, 2)
+        for i in range(3):
+            store.set_key('http://test.se/key/{0}'.format(i), str(i).encode() * 16)
+
+        self.assertIsNone(store.get_key('http://test.se/key/0'))
+        self.assertEqual(store.get_key('http://test.se/key/2'), b'2' * 16)
+
+    def test_ttl(self):
+        with patch('streamlink.cache.cache_dir', self.cache_dir):
+            store = KeyStore(-1, 2)
+        store.set_key('http://test.se/key/1', b'1' * 16)
+
+        self.assertIsNone(store.get_key('http://test.se/key/1'))
+
+
+class TestHedgedRequests(unittest.TestCase):
+    class Response(object):
+        def __init__(self, name):
+            self.name = name
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    def test_get(self):
+        hedged = HedgedRequests(0.5, 2)
+        for i in range(hedged.min_history):
+            self.assertEqual(hedged.get(lambda: self.Response('fast')).name, 'fast')
+        self.assertLess(hedged.threshold(), 0.1)
+
+        responses = []
+
+        def request():
+            # the first request is slow
+            response = self.Response('slow' if not responses else 'hedged')
+            responses.append(response)
+            if response.name == 'slow':
+                time.sleep(0.5)
+            return response
+
+        self.assertEqual(hedged.get(request).name, 'hedged')
+        self.assertEqual((hedged.requests, hedged.hedged, hedged.won), (11, 1, 1))
+        hedged.executor.shutdown(wait=True)
+        # the slow response is closed
+        self.assertTrue(responses[0].closed)
+        self.assertFalse(responses[1].closed)
+
+    def test_ratio(self):
+        hedged = HedgedRequests(0.1, 1)
+        hedged.requests = 9
+        self.assertFalse(hedged.hedge())
+        hedged.requests = 10
+        self.assertTrue(hedged.hedge())
+        self.assertFalse(hedged.hedge())
+        hedged.close()
+
+
+class TestKeyUriHLSStreamWriter(unittest.TestCase):
+    def setUp(self):
+        self.session = Streamlink()
+        stream = KeyUriHLSStream(self.session, 'http://test.se/index.m3u8')
+        self.writer = KeyUriHLSStreamWriter(KeyUriHLSStreamReader(stream))
+
+    def tearDown(self):
+        self.writer.executor.shutdown(wait=True)
+        HLSKeyUriPlugin.set_option('key_uri', None)
+        HLSKeyUriPlugin.set_option('key_store', None)
+        HLSKeyUriPlugin.set_option('decrypt_pool', None)
+        HLSKeyUriPlugin.set_option('prefetch', None)
+
+    def test_repair_key_uri(self):
+        HLSKeyUriPlugin.set_option('key_uri', 'https://${netloc}${path}${query}')
+        self.assertEqual(
+            self.writer.repair_key_uri('http://test.se/key/1?token=a'),
+            'https://test.se/key/1?token=a')
+
+    def test_key_uri_candidates(self):
+        candidates = dict(key_uri_candidates('http://key.se/k/1.key?t=a',
+                                             'https://test.se/live/index.m3u8'))
+        self.assertEqual(candidates['key host'], 'http://key.se/k/1.key?t=a')
+        self.assertEqual(candidates['playlist host swapped scheme'], 'https://test.se/k/1.key?t=a')
+        self.assertEqual(candidates['relative to playlist without query'], 'https://test.se/live/1.key')
+        self.assertEqual(len(candidates), 10)
+
+    def test_key_uri_auto(self):
+        HLSKeyUriPlugin.set_option('key_uri', 'auto')
+        key = b'k' * 16
+        iv = b'i' * 16
+        playlist = text_encrypted_hls.format(iv=iv_hex(iv)).replace('http://test.se/key', 'https://key.se/key')
+
+        self.session.set_option('hls-segment-threads', 1)
+        stream = KeyUriHLSStream(self.session, 'http://test.se/index.m3u8')
+        with requests_mock.Mocker() as mock:
+            mock.get(requests_mock.ANY, status_code=404)
+            mock.get('http://test.se/index.m3u8', text=playlist)
+            # invalid key
+            mock.get('https://key.se/key', content=b'x' * 16)
+            mock.get('https://test.se/key', content=key)
+            mock.get('http://test.se/1.ts', content=encrypt(b'\x47' * 188, key, iv))
+            mock.get('http://test.se/2.ts', content=encrypt(b'\x47' * 188, key, iv))
+
+            fd = stream.open()
+            data = read_all(fd)
+            fd.close()
+
+        self.assertEqual(fd.writer.key_repair, 'playlist host')
+        self.assertEqual(data, b'\x47' * 188 * 2)
+
+    def test_key_uri_auto_byterange(self):
+        HLSKeyUriPlugin.set_option('key_uri', 'auto')
+        key = b'k' * 16
+        iv = b'i' * 16
+        content = b'\x47' * 188 + encrypt(b'\x47' * 188, key, iv)
+        # the first segment of the key continues after the last byte range
+        sequences = [
+            Sequence(1, Segment('http://test.se/all.ts', 2.0, None, None, False,
+                                ByteRange(188, 0), None, None)),
+            Sequence(2, Segment('http://test.se/all.ts', 2.0, None,
+                                Key('AES-128', 'https://key.se/key', iv, None, None),
+                                False, ByteRange(192, None), None, None)),
+        ]
+
+        def ranged(request, context):
+            start, end = request.headers['Range'].split('=')[1].split('-')
+            context.status_code = 206
+            return content[int(start):int(end) + 1]
+
+        with requests_mock.Mocker() as mock:
+            mock.get(requests_mock.ANY, status_code=404)
+            mock.get('https://key.se/key', content=b'x' * 16)
+            mock.get('https://test.se/key', content=key)
+            mock.get('http://test.se/all.ts', content=ranged)
+            for sequence in sequences:
+                self.writer.put(sequence)
+            self.assertEqual(self.writer.fetch_key('https://key.se/key'), key)
+
+        self.assertEqual(self.writer.key_samples['https://key.se/key'], (sequences[1], 188))
+        self.assertEqual(self.writer.key_repair, 'playlist host')
+
+    def test_key_cache(self):
+        self.writer.key_cache_size = 2
+        with requests_mock.Mocker() as mock:
+            for i in range(3):
+                mock.get('http://test.se/key/{0}'.format(i), content=str(i).encode() * 16)
+
+            self.assertEqual(self.writer.get_key('http://test.se/key/0'), b'0' * 16)
+            self.assertEqual(self.writer.get_key('http://test.se/key/1'), b'1' * 16)
+            self.assertEqual(self.writer.get_key('http://test.se/key/0'), b'0' * 16)
+            self.assertEqual(self.writer.get_key('http://test.se/key/2'), b'2' * 16)
+            self.assertEqual(mock.call_count, 3)
+
+        self.assertEqual(list(self.writer.key_cache.keys()),
+                         ['http://test.se/key/0', 'http://test.se/key/2'])
+
+    def test_key_store(self):
+        HLSKeyUriPlugin.set_option('key_uri', 'https://${netloc}${path}')
+        self.writer.key_store = KeyStore(60, 2)
+        with patch.object(self.writer.key_store, 'get_key', return_value=None), \
+                patch.object(self.writer.key_store, 'set_key') as set_key, \
+                requests_mock.Mocker() as mock:
+            mock.get('https://test.se/key/1', content=b'1' * 16)
+            self.assertEqual(self.writer.fetch_key('http://test.se/key/1'), b'1' * 16)
+
+        # stored by the original Key-URI
+        set_key.assert_called_once_with('http://test.se/key/1', b'1' * 16)
+
+        with patch.object(self.writer.key_store, 'get_key', return_value=b'2' * 16), \
+                requests_mock.Mocker() as mock:
+            self.assertEqual(self.writer.fetch_key('http://test.se/key/1'), b'2' * 16)
+            self.assertEqual(mock.call_count, 0)
+
+    def test_fetch_hedged(self):
+        self.writer.hedged_requests = HedgedRequests(1, 1)
+        self.writer.hedged_requests.history.extend([0.0] * 10)
+        sequence = Sequence(1, Segment('http://test.se/1.ts', 2.0, None, None, False, None, None, None))
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/1.ts', content=lambda request, context: time.sleep(0.1) or b'\x47' * 188)
+            res = self.writer.fetch(sequence, retries=1)
+            self.writer.hedged_requests.executor.shutdown(wait=True)
+
+        self.assertEqual(res.content, b'\x47' * 188)
+        self.assertEqual(self.writer.hedged_requests.hedged, 1)
+        self.assertEqual(mock.call_count, 2)
+
+    def test_prefetch_key(self):
+        key = Key('AES-128', 'http://test.se/key/1', None, None, None)
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/key/1', content=b'1' * 16)
+            self.writer.prefetch_key(key)
+            self.writer.prefetch_key(key)
+            self.assertEqual(self.writer.get_key(key.uri), b'1' * 16)
+            self.assertEqual(mock.call_count, 1)
+
+        self.assertEqual(self.writer.key_futures, {})
+
+    def write_broken(self, segment, size, status_code=200):
+        key = b'k' * 16
+        iv = b'i' * 16
+        content = encrypt(segment, key, iv)
+        sequence = Sequence(1, Segment('http://test.se/1.ts', 2.0, None,
+                                       Key('AES-128', 'http://test.se/key', iv, None, None),
+                                       False, None, None, None))
+        self.writer.reader.buffer = RingBuffer(len(segment) * 2)
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/key', content=key)
+            segment_url = mock.get('http://test.se/1.ts', content=content, status_code=status_code)
+            self.writer.write(sequence, BrokenResponse(content, size), chunk_size=1000)
+
+        buffer = self.writer.reader.buffer
+        return buffer.read(buffer.length), segment_url.call_count
+
+    def test_write_read_error(self):
+        segment = bytes(bytearray(i % 251 for i in range(30000)))
+        data, call_count = self.write_broken(segment, 12345)
+        self.assertEqual(data, segment)
+        self.assertEqual(call_count, 1)
+
+    def test_write_read_error_byterange(self):
+        key = b'k' * 16
+        iv = b'i' * 16
+        segment = bytes(bytearray(i % 251 for i in range(30000)))
+        content = encrypt(segment, key, iv)
+        data = b'\x47' * 1000 + content
+        sequence = Sequence(2, Segment('http://test.se/all.ts', 2.0, None,
+                                       Key('AES-128', 'http://test.se/key', iv, None, None),
+                                       False, ByteRange(len(content), None), None, None))
+        request = requests.Request('GET', 'http://test.se/all.ts', headers={
+            'Range': 'bytes=1000-{0}'.format(len(data) - 1)}).prepare()
+        # the next byte range of the file was requested already
+        self.writer.byterange_offsets['http://test.se/all.ts'] = len(data)
+
+        def ranged(request, context):
+            start, end = request.headers['Range'].split('=')[1].split('-')
+            context.status_code = 206
+            return data[int(start):int(end) + 1]
+
+        self.writer.reader.buffer = RingBuffer(len(segment) * 2)
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/key', content=key)
+            mock.get('http://test.se/all.ts', content=ranged)
+            self.writer.write(sequence, BrokenResponse(content, 12345, request), chunk_size=1000)
+
+        buffer = self.writer.reader.buffer
+        self.assertEqual(buffer.read(buffer.length), segment)
+
+    def test_write_read_error_decrypt_pool(self):
+        HLSKeyUriPlugin.set_option('decrypt_pool', 2)
+        segment = bytes(bytearray(i % 251 for i in range(30000)))
+        with patch.object(self.writer, 'decrypt_job_size', 1024):
+            data, call_count = self.write_broken(segment, 12345)
+        self.assertEqual(data, segment)
+
+    def test_write_read_error_failed_decrypt_pool(self):
+        HLSKeyUriPlugin.set_option('decrypt_pool', 4)
+        self.writer.retries = 1
+        segment = bytes(bytearray(i % 251 for i in range(30000)))
+        with patch.object(self.writer, 'decrypt_job_size', 4096), \
+                self.assertLogs('plugins.hlskeyuri', 'ERROR') as logs:
+            data, call_count = self.write_broken(segment, 20000, status_code=404)
+        # the jobs in the pool are written before the rest is dropped
+        consumed = int(re.search(r'after (\d+) bytes', logs.output[-1]).group(1))
+        self.assertEqual(data, segment[:consumed])
+        # every complete block before the last one
+        self.assertEqual(consumed, 19968)
+
+    def test_write_read_error_failed(self):
+        self.writer.retries = 1
+        segment = bytes(bytearray(i % 251 for i in range(30000)))
+        data, call_count = self.write_broken(segment, 12345, status_code=404)
+        # only the decrypted part, without a spliced segment
+        self.assertEqual(data, segment[:len(data)])
+        self.assertLess(len(data), 12345)
+
+    def test_write_stream_decrypt(self):
+        key = b'k' * 16
+        iv = b'i' * 16
+        segment_1 = bytes(bytearray(i % 251 for i in range(30000)))
+        segment_2 = b'\x47' * 100
+        playlist = text_encrypted_hls.format(iv=iv_hex(iv))
+
+        self.session.set_option('hls-segment-threads', 1)
+        stream = KeyUriHLSStream(self.session, 'http://test.se/index.m3u8')
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/index.m3u8', text=playlist)
+            mock.get('http://test.se/key', content=key)
+            mock.get('http://test.se/1.ts', content=encrypt(segment_1, key, iv))
+            # with garbage
+            mock.get('http://test.se/2.ts', content=encrypt(segment_2, key, iv) + b'garbage')
+
+            fd = stream.open()
+            data = read_all(fd)
+            fd.close()
+
+        self.assertEqual(data, segment_1 + segment_2)
+
+    def test_write_decrypt_pool(self):
+        HLSKeyUriPlugin.set_option('decrypt_pool', 2)
+        key = b'k' * 16
+        iv = b'i' * 16
+        segment_1 = bytes(bytearray(i % 251 for i in range(300000)))
+        segment_2 = b'\x47' * 100
+        playlist = text_encrypted_hls.format(iv=iv_hex(iv))
+
+        self.session.set_option('hls-segment-threads', 1)
+        stream = KeyUriHLSStream(self.session, 'http://test.se/index.m3u8')
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/index.m3u8', text=playlist)
+            mock.get('http://test.se/key', content=key)
+            mock.get('http://test.se/1.ts', content=encrypt(segment_1, key, iv))
+            mock.get('http://test.se/2.ts', content=encrypt(segment_2, key, iv))
+
+            # set before the writer thread starts
+            with patch.object(KeyUriHLSStreamWriter, 'decrypt_job_size', 1024):
+                fd = stream.open()
+                data = read_all(fd)
+            fd.close()
+
+        self.assertEqual(data, segment_1 + segment_2)
+        self.assertGreater(fd.writer.decrypt_queue_peak, 0)
+        self.assertEqual(fd.writer.decrypt_queue_depth, 0)
+        self.assertEqual(DecryptPool.queue_depth, {})
+
+    def test_decrypt_pool_depth(self):
+        key = b'k' * 16
+        iv = b'i' * 16
+        data = encrypt(b'\x47' * 1024, key, iv)
+        depth_a, job_a = DecryptPool.submit('a', key, iv, data)
+        depth_b, job_b = DecryptPool.submit('b', key, iv, data)
+        # two streams with the same URL have their own depth
+        self.assertEqual((depth_a, depth_b), (1, 1))
+        self.assertEqual(job_a.result(), job_b.result())
+        self.assertEqual(DecryptPool.depth('a'), 0)
+
+    def test_write_prefetch_read_error(self):
+        HLSKeyUriPlugin.set_option('prefetch', 1)
+        key = b'k' * 16
+        iv = b'i' * 16
+        segment = bytes(bytearray(i % 251 for i in range(300000)))
+        content = encrypt(segment, key, iv)
+        sequence = Sequence(1, Segment('http://test.se/1.ts', 2.0, None,
+                                       Key('AES-128', 'http://test.se/key', iv, None, None),
+                                       False, None, None, None))
+        writer = KeyUriHLSStreamWriter(self.writer.reader)
+        writer.reader.buffer = RingBuffer(len(segment) * 2)
+        try:
+            response = PrefetchResponse(writer, sequence)
+            with patch.object(writer, 'fetch', return_value=BrokenResponse(content, 100000)):
+                response.run()
+            with requests_mock.Mocker() as mock:
+                mock.get('http://test.se/key', content=key)
+                mock.get('http://test.se/1.ts', content=content)
+                writer.write(sequence, response)
+        finally:
+            writer.close()
+
+        self.assertEqual(writer.reader.buffer.read(writer.reader.buffer.length), segment)
+
+    def test_write_prefetch(self):
+        HLSKeyUriPlugin.set_option('prefetch', 2)
+        key = b'k' * 16
+        iv = b'i' * 16
+        segment_1 = bytes(bytearray(i % 251 for i in range(300000)))
+        segment_2 = b'\x47' * 100
+        playlist = text_encrypted_hls.format(iv=iv_hex(iv))
+
+        self.session.set_option('ringbuffer-size', 65536)
+        stream = KeyUriHLSStream(self.session, 'http://test.se/index.m3u8')
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/index.m3u8', text=playlist)
+            mock.get('http://test.se/key', content=key)
+            mock.get('http://test.se/1.ts', content=encrypt(segment_1, key, iv))
+            mock.get('http://test.se/2.ts', content=encrypt(segment_2, key, iv))
+
+            fd = stream.open()
+            data = read_all(fd)
+            stats = fd.writer.prefetch_buffer.stats()
+            fd.close()
+
+        self.assertEqual(data, segment_1 + segment_2)
+        self.assertEqual(stats['used'], 0)
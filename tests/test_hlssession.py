@@ -0,0 +1,762 @@
+import inspect
+import os
+import requests_mock
+import shutil
+import tempfile
+import time
+import unittest
+
+from streamlink import Streamlink
+from streamlink.buffers import RingBuffer
+from streamlink.compat import parse_qsl, urlparse
+from streamlink.stream import HLSStream, hls_playlist
+from streamlink.stream.hls import Sequence
+from streamlink.stream.hls_playlist import Segment
+
+from plugins import hlskeyuri
+from plugins.hlssession import (
+    FastM3U8Parser, HedgedRequests, HLSSessionHLSStream,
+    HLSSessionHLSStreamReader, HLSSessionHLSStreamWorker,
+    HLSSessionHLSStreamWriter, HLSSessionMetrics, HLSSessionPlugin,
+    LowLatencyM3U8Parser, PrefetchBuffer, PrefetchResponse, SegmentIndex, StandbyPoller,
+)
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    # python 2.7
+    from mock import patch
+
+text_hls = '''#EXTM3U
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:1
+#EXTINF:2.000,
+1.ts
+'''
+
+text_master_hls = '''#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=2000000
+http://a.test.se/720p.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2000000
+http://b.test.se/720p.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=1000000
+http://a.test.se/480p.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=500000
+http://a.test.se/360p.m3u8
+'''
+
+text_vod_hls = '''#EXTM3U
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:1
+#EXTINF:2.000,
+1.ts
+#EXTINF:2.000,
+2.ts
+#EXTINF:2.000,
+3.ts
+#EXT-X-ENDLIST
+'''
+
+text_live_hls = '''#EXTM3U
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:1
+''' + ''.join('#EXTINF:2.000,\n{0}.ts\n'.format(i) for i in range(1, 11))
+
+text_event_hls = '''#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-PLAYLIST-TYPE:EVENT
+#EXT-X-KEY:METHOD=AES-128,URI="key1",IV=0x00000000000000000000000000000001
+#EXT-X-PROGRAM-DATE-TIME:2020-01-01T00:00:00.000Z
+#EXTINF:4.000,title
+1.ts
+#EXT-X-BYTERANGE:1000@0
+#EXTINF:3.500,
+http://cdn.se/live/2.ts?token=a
+#EXT-X-DISCONTINUITY
+#EXT-X-MAP:URI="init.mp4"
+#EXT-X-KEY:METHOD=AES-128,URI="key2"
+#EXTINF:4.000,
+../3.ts
+'''
+
+text_low_latency = '''#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-VERSION:6
+#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK=1.0,CAN-SKIP-UNTIL=24.0
+#EXT-X-PART-INF:PART-TARGET=0.33334
+#EXT-X-MEDIA-SEQUENCE:10
+#EXT-X-SKIP:SKIPPED-SEGMENTS=1
+#EXT-X-PART:DURATION=0.33334,URI="p11.0.ts",INDEPENDENT=YES
+#EXT-X-PART:DURATION=0.33334,URI="p11.1.ts"
+#EXTINF:4.0,
+s11.ts
+#EXT-X-PART:DURATION=0.33334,URI="p12.0.ts",INDEPENDENT=YES
+#EXT-X-PART:DURATION=0.33334,URI="s12.ts",BYTERANGE="1000@0"
+#EXT-X-PART:DURATION=0.33334,URI="s12.ts",BYTERANGE="1000",GAP=YES
+'''
+
+
+text_low_latency_live = '''#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-VERSION:6
+#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK=3.0,CAN-SKIP-UNTIL=24.0
+#EXT-X-PART-INF:PART-TARGET=1.0
+#EXT-X-MEDIA-SEQUENCE:10
+#EXT-X-PART:DURATION=1.0,URI="p10.0.ts",INDEPENDENT=YES
+#EXT-X-PART:DURATION=1.0,URI="p10.1.ts"
+#EXT-X-PART:DURATION=1.0,URI="p10.2.ts"
+#EXTINF:3.0,
+s10.ts
+#EXT-X-PART:DURATION=1.0,URI="p11.0.ts",INDEPENDENT=YES
+#EXT-X-PART:DURATION=1.0,URI="p11.1.ts",INDEPENDENT=YES
+#EXT-X-PART:DURATION=1.0,URI="p11.2.ts"
+#EXTINF:3.0,
+s11.ts
+#EXT-X-PART:DURATION=1.0,URI="p12.0.ts",INDEPENDENT=YES
+#EXT-X-PART:DURATION=1.0,URI="p12.1.ts"
+'''
+
+text_low_latency_delta = '''#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-VERSION:6
+#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK=3.0,CAN-SKIP-UNTIL=24.0
+#EXT-X-PART-INF:PART-TARGET=1.0
+#EXT-X-MEDIA-SEQUENCE:{0}
+#EXT-X-SKIP:SKIPPED-SEGMENTS={1}
+#EXTINF:3.0,
+s11.ts
+#EXT-X-PART:DURATION=1.0,URI="p12.0.ts",INDEPENDENT=YES
+#EXT-X-PART:DURATION=1.0,URI="p12.1.ts"
+#EXT-X-PART:DURATION=1.0,URI="p12.2.ts"
+#EXTINF:3.0,
+s12.ts
+#EXT-X-PART:DURATION=1.0,URI="p13.0.ts",INDEPENDENT=YES
+'''
+
+
+class BrokenResponse(object):
+    '''Response that fails after size bytes of the body'''
+
+    def __init__(self, content, size):
+        self.content = content
+        self.size = size
+
+    def iter_content(self, chunk_size):
+        for i in range(0, self.size, chunk_size):
+            yield self.content[i:min(i + chunk_size, self.size)]
+        raise IOError('Connection broken')
+
+    def close(self):
+        pass
+
+
+def read_all(fd):
+    '''Reads the stream until the end'''
+    data = b''
+    while True:
+        chunk = fd.read(8192)
+        if not chunk:
+            return data
+        data += chunk
+
+
+class TestPluginHLSSession(unittest.TestCase):
+    def test_can_handle_url(self):
+        should_match = [
+            'hlssession://https://example.com/index.m3u8',
+            'hlssession://example.com/live',
+        ]
+        for url in should_match:
+            self.assertTrue(HLSSessionPlugin.can_handle_url(url))
+
+        should_not_match = [
+            'https://example.com/index.m3u8',
+            'hlskeyuri://https://example.com/index.m3u8',
+        ]
+        for url in should_not_match:
+            self.assertFalse(HLSSessionPlugin.can_handle_url(url))
+
+
+class TestPluginHLSSession_get_streams(unittest.TestCase):
+    @patch('plugins.hlssession.http')
+    def test_session_data(self, mock_http):
+        session = Streamlink()
+        HLSSessionPlugin.bind(session, 'test.hlssession')
+
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/a.m3u8', text=text_hls)
+            mock.get('http://test.se/b.m3u8', text=text_hls)
+
+            HLSSessionPlugin.set_option('time', 300)
+            stream_a = HLSSessionPlugin('hlssession://http://test.se/a.m3u8')._get_streams()['live']
+            HLSSessionPlugin.set_option('time', None)
+            stream_b = HLSSessionPlugin('hlssession://http://test.se/b.m3u8')._get_streams()['live']
+
+        self.assertEqual(stream_a.session_url, 'http://test.se/a.m3u8')
+        self.assertEqual(stream_a.session_options['time'], 300)
+        self.assertEqual(stream_b.session_url, 'http://test.se/b.m3u8')
+        self.assertIsNone(stream_b.session_options['time'])
+
+    @patch('plugins.hlssession.http')
+    def test_session_standby_urls(self, mock_http):
+        session = Streamlink()
+        HLSSessionPlugin.bind(session, 'test.hlssession')
+
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/master.m3u8', text=text_master_hls)
+            mock.get('http://a.test.se/720p.m3u8', text=text_live_hls)
+
+            HLSSessionPlugin.set_option('standby', 10)
+            try:
+                streams = HLSSessionPlugin('hlssession://http://test.se/master.m3u8')._get_streams()
+            finally:
+                HLSSessionPlugin.set_option('standby', None)
+
+        # the standby variants of the media playlist, from the master playlist
+        self.assertEqual(streams['live'].url, 'http://a.test.se/720p.m3u8')
+        self.assertEqual(streams['live'].session_url, 'http://test.se/master.m3u8')
+        self.assertEqual(streams['live'].session_standby_urls,
+                         ['http://b.test.se/720p.m3u8', 'http://a.test.se/480p.m3u8'])
+
+    def test_standby_urls(self):
+        session = Streamlink()
+        HLSSessionPlugin.bind(session, 'test.hlssession')
+        plugin = HLSSessionPlugin('hlssession://http://test.se/master.m3u8')
+
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/master.m3u8', text=text_master_hls)
+            standby_urls = plugin._get_standby_urls(session, 'http://test.se/master.m3u8', {})
+
+        self.assertEqual(standby_urls, {
+            'http://a.test.se/720p.m3u8': ['http://b.test.se/720p.m3u8',
+                                           'http://a.test.se/480p.m3u8'],
+            'http://b.test.se/720p.m3u8': ['http://a.test.se/720p.m3u8',
+                                           'http://a.test.se/480p.m3u8'],
+            'http://a.test.se/480p.m3u8': ['http://a.test.se/360p.m3u8'],
+            'http://a.test.se/360p.m3u8': [],
+        })
+
+
+class TestLowLatencyM3U8Parser(unittest.TestCase):
+    def test_parse(self):
+        playlist = hls_playlist.load(text_low_latency,
+                                     'http://test.se/index.m3u8',
+                                     parser=LowLatencyM3U8Parser)
+
+        self.assertEqual(playlist.part_target, 0.33334)
+        self.assertTrue(playlist.server_control.can_block_reload)
+        self.assertEqual(playlist.server_control.can_skip_until, 24.0)
+        self.assertEqual(playlist.server_control.part_hold_back, 1.0)
+        self.assertEqual(playlist.skipped_segments, 1)
+
+        self.assertEqual(len(playlist.segments), 1)
+        self.assertEqual(
+            [p.segment.uri for p in playlist.segment_parts[0]],
+            ['http://test.se/p11.0.ts', 'http://test.se/p11.1.ts'])
+        self.assertEqual(
+            [p.independent for p in playlist.segment_parts[0]],
+            [True, False])
+
+        self.assertEqual(len(playlist.trailing_parts), 3)
+        byterange_part, gap_part = playlist.trailing_parts[1:]
+        self.assertEqual(byterange_part.segment.byterange.offset, 0)
+        self.assertIsNone(gap_part.segment.byterange.offset)
+        self.assertTrue(gap_part.gap)
+
+
+class TestFastM3U8Parser(unittest.TestCase):
+    base_uri = 'http://test.se/live/index.m3u8?token=a'
+
+    def assertSegments(self, playlist, text):
+        stock = hls_playlist.load(text, self.base_uri)
+        self.assertEqual(list(playlist.segments), stock.segments)
+        self.assertEqual(playlist.media_sequence, stock.media_sequence)
+        self.assertEqual(playlist.is_endlist, stock.is_endlist)
+
+    def test_parse(self):
+        parser = FastM3U8Parser(self.base_uri)
+        playlist = parser.parse(text_event_hls)
+
+        self.assertSegments(playlist, text_event_hls)
+        self.assertEqual(playlist.segments[0].uri, 'http://test.se/live/1.ts')
+        self.assertEqual(playlist.segments[-1].uri, 'http://test.se/3.ts')
+        self.assertFalse(playlist.segments[0].discontinuity)
+        self.assertTrue(playlist.segments.unique_names)
+
+    def test_prefix(self):
+        parser = FastM3U8Parser(self.base_uri)
+        playlist_1 = parser.parse(text_event_hls)
+
+        text = text_event_hls + '#EXTINF:4.000,\n4.ts\n#EXTINF:4.000,\n1.ts\n#EXT-X-ENDLIST\n'
+        with patch.object(parser, 'parse_line', wraps=parser.parse_line) as parse_line:
+            playlist_2 = parser.parse(text)
+        # only the new lines
+        self.assertEqual(parse_line.call_count, 5)
+
+        self.assertSegments(playlist_2, text)
+        self.assertFalse(playlist_2.segments.unique_names)
+        # the first playlist is not changed
+        self.assertSegments(playlist_1, text_event_hls)
+        self.assertTrue(playlist_1.segments.unique_names)
+
+        # a different playlist is parsed again
+        playlist_3 = parser.parse(text_vod_hls)
+        self.assertSegments(playlist_3, text_vod_hls)
+
+
+class TestSegmentIndex(unittest.TestCase):
+    def segment(self, uri, date=None):
+        return Segment(uri, 2.0, None, None, False, None, date, None)
+
+    def test_date(self):
+        index = SegmentIndex()
+        index.add(self.segment('http://a.se/1.ts', '2020-01-01T00:00:00.000Z'))
+
+        self.assertEqual(index.date_end, 1577836802.0)
+        self.assertTrue(index.contains(
+            self.segment('http://b.se/other.ts', '2020-01-01T00:00:00+00:00')))
+        self.assertFalse(index.contains(
+            self.segment('http://a.se/1.ts', '2020-01-01T00:00:02.000Z')))
+
+    def test_basename(self):
+        index = SegmentIndex()
+        index.add(self.segment('http://a.se/live/1.ts?token=a'))
+
+        self.assertTrue(index.contains(self.segment('http://b.se/1.ts?token=b')))
+        self.assertFalse(index.contains(self.segment('http://b.se/1.ts'), basename=False))
+        self.assertFalse(index.contains(self.segment('http://b.se/2.ts')))
+
+    def test_size(self):
+        index = SegmentIndex(size=2)
+        for i in range(3):
+            index.add(self.segment('http://a.se/{0}.ts'.format(i)))
+
+        self.assertFalse(index.contains(self.segment('http://a.se/0.ts')))
+        self.assertTrue(index.contains(self.segment('http://a.se/2.ts')))
+
+
+class TestHLSSessionMetrics(unittest.TestCase):
+    def test_render(self):
+        metrics = HLSSessionMetrics.register('http://test.se/"live"')
+        try:
+            metrics.inc('playlist_reloads')
+            metrics.inc('session_reloads', 'time')
+            metrics.inc('segments', 'added')
+            metrics.inc('segments', 'added')
+            metrics.observe('segment_fetch', 0.3)
+            text = HLSSessionMetrics.render()
+        finally:
+            HLSSessionMetrics.unregister(metrics)
+
+        labels = 'stream="{0}",url="http://test.se/\\"live\\""'.format(metrics.name)
+        self.assertIn('hlssession_playlist_reloads_total{{{0}}} 1'.format(labels), text)
+        self.assertIn('hlssession_session_reloads_total{{{0},cause="time"}} 1'.format(labels), text)
+        self.assertIn('hlssession_segments_total{{{0},result="added"}} 2'.format(labels), text)
+        self.assertIn('hlssession_segment_fetch_seconds_bucket{{{0},le="0.25"}} 0'.format(labels), text)
+        self.assertIn('hlssession_segment_fetch_seconds_bucket{{{0},le="0.5"}} 1'.format(labels), text)
+        self.assertIn('hlssession_segment_fetch_seconds_count{{{0}}} 1'.format(labels), text)
+        self.assertNotIn(metrics.name, HLSSessionMetrics.streams)
+
+    def test_write(self):
+        metrics = HLSSessionMetrics.register('http://test.se/live')
+        filename = os.path.join(tempfile.mkdtemp(), 'hlssession.prom')
+        try:
+            with patch.object(HLSSessionMetrics, 'filename', filename), \
+                    patch.object(HLSSessionMetrics, 'last_write', 0):
+                metrics.inc('playlist_reloads')
+                HLSSessionMetrics.write()
+                # the old file is replaced
+                metrics.inc('playlist_reloads')
+                HLSSessionMetrics.last_write = 0
+                HLSSessionMetrics.write()
+            with open(filename) as f:
+                text = f.read()
+        finally:
+            HLSSessionMetrics.unregister(metrics)
+            shutil.rmtree(os.path.dirname(filename))
+
+        self.assertIn('hlssession_playlist_reloads_total{{stream="{0}",url="http://test.se/live"}} 2'.format(
+            metrics.name), text)
+
+
+class TestLiveEdgeCatchUp(unittest.TestCase):
+    def setUp(self):
+        session = Streamlink()
+        stream = HLSSessionHLSStream(session, 'http://test.se/index.m3u8')
+        stream.session_options = {'latency': 6}
+        self.reader = HLSSessionHLSStreamReader(stream)
+        self.reader.buffer = RingBuffer()
+        self.reader.writer = HLSSessionHLSStreamWriter(self.reader)
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/index.m3u8', text=text_live_hls)
+            self.worker = HLSSessionHLSStreamWorker(self.reader)
+
+    def tearDown(self):
+        self.reader.writer.close()
+
+    def test_skip(self):
+        # live edge
+        self.assertEqual(self.worker.playlist_sequence, 8)
+        self.worker.live_edge_catch_up()
+        self.assertEqual(self.worker.playlist_sequence, 8)
+
+        # after a stall
+        self.worker.playlist_sequence = 2
+        self.worker.live_edge_catch_up()
+        self.assertEqual(self.worker.playlist_sequence, 8)
+        self.assertEqual(self.worker.latency_skipped, 12.0)
+        self.assertEqual(self.reader.metrics.segments['skipped live edge'], 6)
+
+    def test_drain(self):
+        self.worker.latency_drain = True
+        writer = self.reader.writer
+        for sequence in self.worker.playlist_sequences[4:7]:
+            writer.futures.put((sequence, writer.executor.submit(lambda: None)))
+
+        self.worker.live_edge_catch_up()
+        self.assertEqual(self.worker.playlist_sequence, 8)
+        self.assertEqual(self.worker.latency_skipped, 6.0)
+        self.assertEqual(writer.queued_duration(), 0)
+
+
+class TestLowLatencyWorker(unittest.TestCase):
+    url = 'http://test.se/index.m3u8'
+
+    def setUp(self):
+        session = Streamlink()
+        stream = HLSSessionHLSStream(session, self.url)
+        stream.session_options = {'low_latency': True}
+        self.reader = HLSSessionHLSStreamReader(stream)
+        self.reader.buffer = RingBuffer()
+        self.reader.writer = HLSSessionHLSStreamWriter(self.reader)
+        with requests_mock.Mocker() as mock:
+            mock.get(self.url, text=text_low_latency_live)
+            self.worker = HLSSessionHLSStreamWorker(self.reader)
+
+    def tearDown(self):
+        self.reader.writer.close()
+
+    def uris(self):
+        return [s.segment.uri.rsplit('/', 1)[-1] for s in self.worker.iter_playlist_sequences()]
+
+    def params(self, request):
+        return dict(parse_qsl(urlparse(request.url).query))
+
+    def test_low_latency_edge(self):
+        # 3 partial segments from the live edge is p11.2,
+        # the playback starts with the independent p11.1
+        self.assertEqual((self.worker.playlist_sequence, self.worker.playlist_part), (11, 1))
+        self.assertEqual(self.uris(), ['p11.1.ts', 'p11.2.ts', 'p12.0.ts', 'p12.1.ts'])
+        self.assertEqual((self.worker.playlist_sequence, self.worker.playlist_part), (12, 2))
+
+    def test_blocking_reload_params(self):
+        self.uris()
+        with requests_mock.Mocker() as mock:
+            mock.get(self.url, text=text_low_latency_delta.format(10, 1))
+            self.worker.reload_playlist()
+            self.assertEqual(self.params(mock.last_request),
+                             {'_HLS_msn': '12', '_HLS_part': '2', '_HLS_skip': 'YES'})
+            self.assertEqual(mock.last_request.timeout, 12)
+
+    def test_delta_update(self):
+        self.uris()
+        with requests_mock.Mocker() as mock:
+            mock.get(self.url, text=text_low_latency_delta.format(10, 1))
+            self.worker.reload_playlist()
+
+        # s10 and its partial segments are taken from the last playlist
+        self.assertEqual([s.num for s in self.worker.playlist_sequences], [10, 11, 12])
+        self.assertEqual(self.worker.playlist_sequences[0].segment.uri, 'http://test.se/s10.ts')
+        self.assertEqual(len(self.worker.playlist_parts[10]), 3)
+        # the rest of s12 and the partial segments of s13
+        self.assertEqual(self.uris(), ['p12.2.ts', 'p13.0.ts'])
+
+    def test_delta_update_mismatch(self):
+        self.uris()
+        with requests_mock.Mocker() as mock:
+            mock.get(self.url, [{'text': text_low_latency_delta.format(9, 2)},
+                                {'text': text_low_latency_live}])
+            self.worker.reload_playlist()
+            self.assertEqual(mock.call_count, 2)
+            # a full reload of the playlist
+            self.assertNotIn('_HLS_skip', self.params(mock.last_request))
+
+    def test_no_server_control(self):
+        self.worker.playlist_server_control = None
+        self.assertEqual(self.worker.low_latency_params(), {})
+
+
+class TestAlignSequence(unittest.TestCase):
+    def setUp(self):
+        session = Streamlink()
+        stream = HLSSessionHLSStream(session, 'http://test.se/index.m3u8')
+        stream.session_options = {}
+        self.reader = HLSSessionHLSStreamReader(stream)
+        self.reader.buffer = RingBuffer()
+        self.reader.writer = HLSSessionHLSStreamWriter(self.reader)
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/index.m3u8', text=text_live_hls)
+            self.worker = HLSSessionHLSStreamWorker(self.reader)
+
+    def tearDown(self):
+        self.reader.writer.close()
+
+    def sequences(self, first, names, date=None, discontinuity=None):
+        sequences = []
+        for index, name in enumerate(names):
+            segment_date = None
+            if date is not None:
+                segment_date = '2020-01-01T00:00:{0:02d}.000Z'.format(date + index * 2)
+            segment = Segment('http://test.se/{0}.ts'.format(name), 2.0, None, None,
+                              first + index == discontinuity, None, segment_date, None)
+            sequences.append(Sequence(first + index, segment))
+        return sequences
+
+    def deliver(self, sequences):
+        for sequence in sequences:
+            self.worker.segment_index.add(sequence.segment)
+
+    def test_date_overlap(self):
+        self.deliver(self.sequences(100, ['a0', 'a1', 'a2'], date=0))
+        self.worker.session_align = (0, 0, None)
+        # segments of 4s and 6s were delivered
+        self.assertEqual(self.worker.align_sequence(self.sequences(500, ['b0', 'b1', 'b2', 'b3'], date=2)), 502)
+
+    def test_date_gap(self):
+        self.deliver(self.sequences(100, ['a0', 'a1', 'a2'], date=0))
+        self.worker.session_align = (0, 0, None)
+        self.assertEqual(self.worker.align_sequence(self.sequences(500, ['b0', 'b1'], date=20)), 500)
+
+    def test_uri_restarted_numbering(self):
+        self.deliver(self.sequences(100, ['s100', 's101', 's102']))
+        self.worker.playlist_unique_names = True
+        self.worker.session_align = (0, 0, None)
+        self.assertEqual(self.worker.align_sequence(self.sequences(0, ['s101', 's102', 's103'])), 2)
+
+    def test_uri_gap(self):
+        self.deliver(self.sequences(100, ['s100', 's101', 's102']))
+        self.worker.playlist_unique_names = True
+        self.worker.session_align = (3.0, time.time(), None)
+        # aligned by the undelivered duration
+        self.assertEqual(self.worker.align_sequence(self.sequences(0, ['s110', 's111', 's112', 's113'])), 1)
+
+    def test_variant(self):
+        self.deliver(self.sequences(100, ['a0', 'a1', 'a2']))
+        self.worker.session_align = (0, 0, 103)
+        self.assertEqual(self.worker.align_sequence(self.sequences(100, ['b1', 'b2', 'b3', 'b4'])), 103)
+
+    def test_reused_names(self):
+        # a new session with the segment names of the old session
+        self.deliver(self.sequences(100, ['0', '1', '2']))
+        self.worker.playlist_sequence = 103
+        self.worker.playlist_unique_names = True
+        for sequence in self.sequences(103, ['0', '1']):
+            self.assertTrue(self.worker.valid_sequence(sequence))
+
+    def test_discontinuity(self):
+        self.worker.sequence_ignore_number = 10
+        self.worker.playlist_unique_names = True
+        self.deliver(self.sequences(100, ['0', '1', '2']))
+        self.worker.playlist_sequence = 103
+        self.assertTrue(self.worker.valid_sequence(self.sequences(103, ['0'], discontinuity=103)[0]))
+        # names after the discontinuity are new, even with an invalid number
+        self.assertTrue(self.worker.valid_sequence(self.sequences(1, ['1'])[0]))
+
+    def test_session_change(self):
+        self.deliver(self.sequences(100, ['0', '1', '2']))
+        self.worker.session_align = (0, 0, None)
+        self.worker.process_sequences(hls_playlist.load(text_live_hls, 'http://test.se/index.m3u8'),
+                                      self.sequences(0, ['0', '1', '2', '3']))
+        self.assertFalse(self.worker.segment_index.keys)
+
+
+class TestFailover(unittest.TestCase):
+    def setUp(self):
+        self.session = Streamlink()
+        stream = HLSSessionHLSStream(self.session, 'http://a.test.se/720p.m3u8',
+                                     headers={'Referer': 'http://test.se/'})
+        stream.session_url = 'http://test.se/live'
+        stream.session_stream_name = 'best'
+        stream.session_options = {}
+        self.reader = HLSSessionHLSStreamReader(stream)
+        self.reader.buffer = RingBuffer()
+        self.reader.writer = HLSSessionHLSStreamWriter(self.reader)
+        with requests_mock.Mocker() as mock:
+            mock.get('http://a.test.se/720p.m3u8', text=text_live_hls)
+            self.worker = HLSSessionHLSStreamWorker(self.reader)
+        self.worker.standby = StandbyPoller(
+            self.worker, ['http://b.test.se/720p.m3u8', 'http://a.test.se/480p.m3u8'], 60)
+
+    def tearDown(self):
+        self.reader.writer.close()
+
+    def test_failover(self):
+        # nothing available
+        self.assertFalse(self.worker.failover())
+
+        self.worker.standby.available = 'http://b.test.se/720p.m3u8'
+        self.assertTrue(self.worker.failover())
+        self.assertEqual(self.worker.stream.url, 'http://b.test.se/720p.m3u8')
+        self.assertEqual(self.worker.stream.args['headers'], {'Referer': 'http://test.se/'})
+        self.assertEqual(self.worker.standby.urls,
+                         ['http://a.test.se/480p.m3u8', 'http://a.test.se/720p.m3u8'])
+        self.assertIsNone(self.worker.standby.available)
+        self.assertEqual(self.worker.metrics.failovers, 1)
+        self.assertFalse(self.worker.failover())
+
+    def test_failover_old_variant(self):
+        # checked before set_urls() replaced the variants
+        self.worker.standby.set_urls(['http://c.test.se/720p.m3u8'])
+        self.worker.standby.available = 'http://b.test.se/720p.m3u8'
+        self.assertFalse(self.worker.failover())
+        self.assertEqual(self.worker.stream.url, 'http://a.test.se/720p.m3u8')
+
+    def test_reload_session(self):
+        # the new session has other variants
+        streams = {'best': HLSStream(self.session, 'http://c.test.se/720p.m3u8')}
+        with patch.object(self.session, 'streams', return_value=streams), \
+                requests_mock.Mocker() as mock:
+            mock.get('http://test.se/live', text=text_master_hls.replace('a.test.se', 'c.test.se'))
+            mock.get('http://c.test.se/720p.m3u8', text=text_live_hls)
+            self.worker.reload_session('time')
+            self.assertEqual(mock.request_history[0].headers['Referer'], 'http://test.se/')
+        self.assertEqual(self.worker.stream.url, 'http://c.test.se/720p.m3u8')
+        self.assertEqual(self.worker.standby.urls,
+                         ['http://b.test.se/720p.m3u8', 'http://c.test.se/480p.m3u8'])
+
+
+class TestPrefetchBuffer(unittest.TestCase):
+    def test_acquire(self):
+        buffer = PrefetchBuffer(4 * PrefetchBuffer.block_size, spill=True)
+        buffer.set_head(1)
+
+        # the last reserve blocks are only used by the head
+        blocks = [buffer.acquire(2, spill=True) for i in range(2)]
+        self.assertIsNone(buffer.acquire(2, spill=True))
+        blocks += [buffer.acquire(1), buffer.acquire(1)]
+        self.assertEqual(buffer.stats()['peak'], 4 * PrefetchBuffer.block_size)
+
+        for block in blocks:
+            buffer.release(block)
+        self.assertIs(buffer.acquire(2), blocks[-1])
+        self.assertEqual(buffer.stats()['used'], PrefetchBuffer.block_size)
+
+    def test_stream(self):
+        segments = [bytes(bytearray((i + n) % 251 for i in range(600000))) for n in range(3)]
+
+        session = Streamlink()
+        session.set_option('ringbuffer-size', 65536)
+        stream = HLSSessionHLSStream(session, 'http://test.se/index.m3u8')
+        stream.session_options = {'prefetch': 3, 'prefetch_size': 1, 'prefetch_spill': True}
+        with patch.object(PrefetchBuffer, 'block_size', 1024), requests_mock.Mocker() as mock:
+            mock.get('http://test.se/index.m3u8', text=text_vod_hls)
+            for n, segment in enumerate(segments):
+                mock.get('http://test.se/{0}.ts'.format(n + 1), content=segment)
+
+            fd = stream.open()
+            data = read_all(fd)
+            stats = fd.writer.prefetch_buffer.stats()
+            fd.close()
+
+        self.assertEqual(data, b''.join(segments))
+        self.assertEqual(stats['used'], 0)
+        self.assertLessEqual(stats['peak'], stats['size'])
+
+
+class TestPrefetchResponse(unittest.TestCase):
+    segment = bytes(bytearray(i % 251 for i in range(300000)))
+
+    def setUp(self):
+        session = Streamlink()
+        stream = HLSSessionHLSStream(session, 'http://test.se/index.m3u8')
+        stream.session_options = {'prefetch': 1, 'prefetch_size': 1}
+        self.reader = HLSSessionHLSStreamReader(stream)
+        self.reader.buffer = RingBuffer(len(self.segment) * 2)
+        self.writer = HLSSessionHLSStreamWriter(self.reader)
+        self.sequence = Sequence(1, Segment('http://test.se/1.ts', 2.0, None, None, False, None, None, None))
+
+    def tearDown(self):
+        self.writer.close()
+
+    def broken_response(self, size):
+        response = PrefetchResponse(self.writer, self.sequence)
+        with patch.object(self.writer, 'fetch', return_value=BrokenResponse(self.segment, size)):
+            response.run()
+        return response
+
+    def test_read_error(self):
+        data = b''
+        with self.assertRaises(IOError):
+            for chunk in self.broken_response(100000).iter_content():
+                data += bytes(chunk)
+        self.assertEqual(data, self.segment[:100000])
+
+    def test_write_read_error(self):
+        response = self.broken_response(100000)
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/1.ts', content=self.segment)
+            self.writer.write(self.sequence, response)
+
+        self.assertEqual(self.reader.buffer.read(self.reader.buffer.length), self.segment)
+
+    def test_write_read_error_failed(self):
+        self.writer.retries = 1
+        response = self.broken_response(100000)
+        with requests_mock.Mocker() as mock:
+            mock.get('http://test.se/1.ts', status_code=404)
+            self.writer.write(self.sequence, response)
+
+        # only the part before the read error
+        self.assertEqual(self.reader.buffer.read(self.reader.buffer.length), self.segment[:100000])
+
+
+class TestStandaloneCopies(unittest.TestCase):
+    '''The plugins are standalone, the shared classes are copied into both plugins'''
+
+    def test_identical(self):
+        for name in ('HedgedRequests', 'PrefetchBuffer', 'PrefetchResponse'):
+            self.assertEqual(inspect.getsource(getattr(hlskeyuri, name)),
+                             inspect.getsource(globals()[name]), name)
+
+
+class TestHedgedRequests(unittest.TestCase):
+    class Response(object):
+        def __init__(self, name):
+            self.name = name
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    def test_get(self):
+        hedged = HedgedRequests(0.5, 2)
+        for i in range(hedged.min_history):
+            self.assertEqual(hedged.get(lambda: self.Response('fast')).name, 'fast')
+        self.assertLess(hedged.threshold(), 0.1)
+
+        responses = []
+
+        def request():
+            # the first request is slow
+            response = self.Response('slow' if not responses else 'hedged')
+            responses.append(response)
+            if response.name == 'slow':
+                time.sleep(0.5)
+            return response
+
+        self.assertEqual(hedged.get(request).name, 'hedged')
+        self.assertEqual((hedged.requests, hedged.hedged, hedged.won), (11, 1, 1))
+        hedged.executor.shutdown(wait=True)
+        # the slow response is closed
+        self.assertTrue(responses[0].closed)
+        self.assertFalse(responses[1].closed)
+
+    def test_ratio(self):
+        hedged = HedgedRequests(0.1, 1)
+        hedged.requests = 9
+        self.assertFalse(hedged.hedge())
+        hedged.requests = 10
+        self.assertTrue(hedged.hedge())
+        self.assertFalse(hedged.hedge())
+        hedged.close()
@@ -1,6 +1,24 @@
+import json
+import requests_mock
+import time
 import unittest
 
-from plugins.myfreecams import MyFreeCams
+from threading import Event
+
+from streamlink.exceptions import NoStreamsError, PluginError
+from streamlink.plugin.api import HTTPSession
+
+from plugins.myfreecams import ChatServers, FCSFrameParser, ModelIndex, MyFreeCams, VideoServers
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    # python 2.7
+    from mock import patch
+
+text_php_models = '''{"rdata":[["UserName",100001,20000001,0,0,0,501,0,0,"",""],
+["Other_Name",100002,20000002,90,0,0,502,0,0,"",""]]}'''
+php_message = '81 0 0 0 0 {"opts":256,"respkey":123,"serv":1111,"type":14}'
 
 
 class TestPluginMyFreeCams(unittest.TestCase):
@@ -21,3 +39,315 @@ class TestPluginMyFreeCams(unittest.TestCase):
         ]
         for url in should_not_match:
             self.assertFalse(MyFreeCams.can_handle_url(url))
+
+
+def fcs_message(fctype, data=''):
+    message = '{0} 0 0 0 0 {1}'.format(fctype, data)
+    return '{0:04d}{1}'.format(len(message), message)
+
+
+class TestFCSFrameParser(unittest.TestCase):
+    def test_feed(self):
+        traffic = ''.join([
+            fcs_message(1, 'guest'),
+            fcs_message(20, '%7B%22nm%22%3A%22UserName%22%7D'),
+            '\n',
+            fcs_message(10, '{"nm":"UserName"}'),
+        ])
+        parser = FCSFrameParser()
+        messages = []
+        for i in range(0, len(traffic), 7):
+            messages.extend(parser.feed(traffic[i:i + 7]))
+
+        self.assertEqual([fctype for fctype, message in messages], [1, 20, 10])
+        self.assertEqual(messages[2][1], '10 0 0 0 0 {"nm":"UserName"}')
+        self.assertEqual(parser.buffer[parser.pos:], bytearray())
+
+    def test_incomplete(self):
+        parser = FCSFrameParser()
+        message = fcs_message(81, '{"opts":1}')
+        self.assertEqual(list(parser.feed(message[:-1])), [])
+        self.assertEqual(list(parser.feed(message[-1:] + message[:2])), [(81, message[4:])])
+        self.assertEqual(bytes(parser.buffer[parser.pos:]), message[:2].encode())
+
+
+class FakeWebSocket(object):
+    def __init__(self, server, stall=False):
+        self.server = server
+        self.closed = Event()
+        self.sent = []
+        # a stalled server accepts the connection, but doesn't answer
+        self.answer = Event()
+        if not stall:
+            self.answer.set()
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def recv(self):
+        self.answer.wait()
+        return '00271 0 1234567 0 0 guest:guest'
+
+    def close(self):
+        self.closed.set()
+
+
+class TestChatServers(unittest.TestCase):
+    def setUp(self):
+        ChatServers.stats.clear()
+
+    def tearDown(self):
+        ChatServers.stats.clear()
+
+    def test_connect(self):
+        sockets = {}
+
+        def handshake(server):
+            if server == 'xchat1':
+                raise ValueError('handshake failed')
+            if server == 'xchat2':
+                time.sleep(0.2)
+            sockets[server] = FakeWebSocket(server)
+            return sockets[server], None
+
+        server, ws, frame = ChatServers.connect(['xchat1', 'xchat2', 'xchat3'], handshake)
+        self.assertEqual(server, 'xchat3')
+        self.assertFalse(ws.closed.is_set())
+
+        # the slow server is closed after its handshake
+        for i in range(50):
+            if 'xchat2' in sockets:
+                break
+            time.sleep(0.05)
+        self.assertTrue(sockets['xchat2'].closed.wait(5))
+
+        self.assertEqual(ChatServers.stats['xchat1'], {'latency': None, 'failures': 1})
+        self.assertGreater(ChatServers.stats['xchat2']['latency'],
+                           ChatServers.stats['xchat3']['latency'])
+
+    def test_connect_failed(self):
+        calls = []
+
+        def handshake(server):
+            calls.append(server)
+            raise ValueError('handshake failed')
+
+        with self.assertRaises(PluginError):
+            ChatServers.connect(['xchat1', 'xchat2'], handshake)
+        self.assertEqual(len(calls), 2 * ChatServers.tries)
+        self.assertEqual(ChatServers.stats['xchat1']['failures'], ChatServers.tries)
+
+    def test_connect_first_frame(self):
+        sockets = {}
+
+        def create_connection(url):
+            server = url.split('//')[1].split('.')[0]
+            sockets[server] = FakeWebSocket(server, stall=server == 'xchat1')
+            return sockets[server]
+
+        with patch('plugins.myfreecams.create_connection', create_connection):
+            server, ws, frame = ChatServers.connect(['xchat1', 'xchat2'], MyFreeCams._chat_handshake)
+            for i in range(50):
+                if 'xchat1' in sockets:
+                    break
+                time.sleep(0.05)
+        self.assertEqual(server, 'xchat2')
+        self.assertEqual(frame, '00271 0 1234567 0 0 guest:guest')
+        self.assertEqual(ws.sent[0], 'hello fcserver\n\0')
+        self.assertTrue(ws.sent[1].startswith('1 0 0 20071025 0 '))
+
+        # the stalled server is closed after its first frame
+        sockets['xchat1'].answer.set()
+        self.assertTrue(sockets['xchat1'].closed.wait(5))
+
+    def test_choose(self):
+        ChatServers.record('xchat1', 0.05)
+        ChatServers.record('xchat2', 5.0)
+        ChatServers.record('xchat2')
+        chosen = [ChatServers.choose(['xchat1', 'xchat2'], 1)[0] for i in range(200)]
+        self.assertGreater(chosen.count('xchat1'), 190)
+
+
+class TestModelIndex(unittest.TestCase):
+    def setUp(self):
+        ModelIndex.clear()
+
+    def tearDown(self):
+        ModelIndex.clear()
+
+    @patch('plugins.myfreecams.http')
+    def test_load_roster(self, mock_http):
+        mock_http.get.return_value.text = text_php_models
+        ModelIndex.update({'nm': 'UserName', 'sid': 100001, 'uid': 20000001, 'vs': 0, 'u': {'camserv': 501}})
+        # cold index
+        self.assertIsNone(ModelIndex.get(username='UserName'))
+
+        ModelIndex.load_roster(php_message)
+        self.assertEqual(ModelIndex.get(username='other_name'), {
+            'nm': 'Other_Name', 'sid': 100002, 'uid': 20000002, 'vs': 90, 'u': {'camserv': 502}})
+        self.assertEqual(ModelIndex.get(uid='20000001')['nm'], 'UserName')
+        self.assertIsNone(ModelIndex.get(username='Unknown'))
+        self.assertEqual(ModelIndex.php_message, php_message)
+        self.assertIn('respkey=123', mock_http.get.call_args[0][0])
+
+    def test_update(self):
+        ModelIndex.ready.set()
+        ModelIndex.update({'nm': 'UserName', 'sid': 100001, 'uid': 20000001, 'vs': 0, 'u': {'camserv': 501}})
+        # session state with the sid only
+        ModelIndex.update({'sid': 100001, 'vs': 127})
+        self.assertEqual(ModelIndex.get(username='UserName')['vs'], 127)
+
+        # no room data
+        ModelIndex.update({'nm': 'New', 'sid': 100003, 'uid': 20000003, 'vs': 0})
+        self.assertIsNone(ModelIndex.get(username='New'))
+
+
+class TestServerConfig(unittest.TestCase):
+    def setUp(self):
+        MyFreeCams.server_config = {}
+
+    def tearDown(self):
+        MyFreeCams.server_config = {}
+
+    @patch('plugins.myfreecams.http', HTTPSession())
+    def test_get_servers(self):
+        config = {'chat_servers': ['xchat1'], 'h5video_servers': {'501': 'video1'}}
+        with requests_mock.Mocker() as mock:
+            js = mock.get(MyFreeCams.JS_SERVER_URL, [
+                {'text': json.dumps(config), 'headers': {'ETag': '"a"'}},
+                {'status_code': 304},
+                {'status_code': 500},
+            ])
+            self.assertEqual(MyFreeCams._get_servers(), (['xchat1'], {'501': 'video1'}))
+            # cached
+            self.assertEqual(MyFreeCams._get_servers(), (['xchat1'], {'501': 'video1'}))
+            self.assertEqual(js.call_count, 1)
+
+            # not modified
+            MyFreeCams.server_config['expires'] = 0
+            self.assertEqual(MyFreeCams._get_servers(), (['xchat1'], {'501': 'video1'}))
+            self.assertEqual(js.last_request.headers['If-None-Match'], '"a"')
+
+            # failed refresh
+            MyFreeCams.server_config['expires'] = 0
+            self.assertEqual(MyFreeCams._get_servers(), (['xchat1'], {'501': 'video1'}))
+            self.assertEqual(js.call_count, 3)
+
+
+# h5video_servers of serverconfig.js, one server for a camserv
+video_servers = {'501': 'video1', '502': 'video2'}
+# SYNTHETIC, not sent by the site: a list of servers for camserv 502,
+# only for the ranking of VideoServers
+synthetic_video_servers = {'501': 'video1', '502': ['video2', 'video3']}
+
+
+class TestVideoServers(unittest.TestCase):
+    def setUp(self):
+        VideoServers.stats.clear()
+
+    def tearDown(self):
+        VideoServers.stats.clear()
+
+    def test_video_servers(self):
+        self.assertEqual(MyFreeCams._video_servers(video_servers, 501), ['video1'])
+        self.assertEqual(MyFreeCams._video_servers(video_servers, 502), ['video2'])
+        self.assertEqual(MyFreeCams._video_servers(video_servers, 503), [])
+
+    def test_video_servers_synthetic(self):
+        self.assertEqual(MyFreeCams._video_servers(synthetic_video_servers, 502), ['video2', 'video3'])
+
+    def get_streams(self, servers):
+        message = json.dumps({'nm': 'UserName', 'uid': 20000002, 'vs': 0, 'u': {'camserv': 502}})
+        plugin = MyFreeCams('https://www.myfreecams.com/#UserName')
+        with patch('plugins.myfreecams.http', HTTPSession()), \
+                patch.object(MyFreeCams, '_get_servers', return_value=(['xchat1'], servers)), \
+                patch.object(MyFreeCams, '_websocket_data', return_value=(message, php_message)), \
+                patch.object(VideoServers, 'measure') as measure, \
+                patch('plugins.myfreecams.HLSStream.parse_variant_playlist', return_value={}) as parse:
+            self.assertEqual(list(plugin._get_streams()), [])
+        return measure, parse.call_args[0][1]
+
+    def test_get_streams(self):
+        measure, url = self.get_streams(video_servers)
+        self.assertFalse(measure.called)
+        self.assertEqual(url, MyFreeCams.HLS_VIDEO_URL.format('video2', 120000002))
+
+    def test_get_streams_synthetic(self):
+        VideoServers.record('video2', 0.5)
+        VideoServers.record('video3', 0.1)
+        measure, url = self.get_streams(synthetic_video_servers)
+        self.assertEqual(measure.call_args[0][0], ['video2', 'video3'])
+        self.assertEqual(url, MyFreeCams.HLS_VIDEO_URL.format('video3', 120000002))
+
+    def test_rank(self):
+        VideoServers.record('video2', 0.5)
+        VideoServers.record('video3', 0.1)
+        VideoServers.record('video4')
+        self.assertEqual(VideoServers.rank(['video4', 'video1', 'video2', 'video3']),
+                         ['video3', 'video2', 'video1', 'video4'])
+
+    @patch('plugins.myfreecams.http', HTTPSession())
+    def test_measure(self):
+        with requests_mock.Mocker() as mock:
+            mock.get('http://video1.test.se/playlist.m3u8', text='#EXTM3U')
+            mock.get('http://video2.test.se/playlist.m3u8', status_code=404)
+            VideoServers.measure(['video1', 'video2'], 'http://{0}.test.se/playlist.m3u8'.format)
+            for i in range(50):
+                if len(VideoServers.stats) == 2 and not VideoServers.measuring:
+                    break
+                time.sleep(0.05)
+
+        self.assertIsNotNone(VideoServers.stats['video1'])
+        self.assertIsNone(VideoServers.stats['video2'])
+        self.assertEqual(VideoServers.rank(['video2', 'video1']), ['video1', 'video2'])
+
+
+class TestPHPFallback(unittest.TestCase):
+    def setUp(self):
+        MyFreeCams.php_index = {}
+        self.plugin = MyFreeCams('https://www.myfreecams.com/#UserName')
+
+    def tearDown(self):
+        MyFreeCams.php_index = {}
+
+    @patch('plugins.myfreecams.http')
+    def test_php_fallback(self, mock_http):
+        mock_http.get.return_value.text = text_php_models
+        self.assertEqual(self.plugin._php_fallback('username', None, php_message), {
+            'nm': 'UserName', 'sid': 100001, 'uid': 20000001, 'vs': 0, 'u': {'camserv': 501}})
+        self.assertEqual(self.plugin._php_fallback(None, '20000002', php_message)['nm'], 'Other_Name')
+        self.assertEqual(mock_http.get.call_count, 1)
+        # reloaded once for a miss
+        with self.assertRaises(NoStreamsError):
+            self.plugin._php_fallback('Unknown', None, php_message)
+        self.assertEqual(mock_http.get.call_count, 2)
+
+        # expired
+        MyFreeCams.php_index['expires'] = 0
+        self.plugin._php_fallback('UserName', None, php_message)
+        self.assertEqual(mock_http.get.call_count, 3)
+
+    @patch('plugins.myfreecams.http')
+    def test_php_fallback_new_model(self, mock_http):
+        mock_http.get.return_value.text = text_php_models
+        self.plugin._php_fallback('UserName', None, php_message)
+        # the model is online after the roster was cached
+        mock_http.get.return_value.text = text_php_models.replace('Other_Name', 'New_Name')
+        self.assertEqual(self.plugin._php_fallback('new_name', None, php_message)['uid'], 20000002)
+        self.assertEqual(mock_http.get.call_count, 2)
+        self.assertIn('new_name', MyFreeCams.php_index['names'])
+
+    @patch('plugins.myfreecams.http')
+    def test_php_fallback_miss(self, mock_http):
+        # a new index is not reloaded for a miss
+        mock_http.get.return_value.text = text_php_models
+        with self.assertRaises(NoStreamsError):
+            self.plugin._php_fallback('Unknown', None, php_message)
+        self.assertEqual(mock_http.get.call_count, 1)
+
+    @patch('plugins.myfreecams.http')
+    def test_php_fallback_empty(self, mock_http):
+        mock_http.get.return_value.text = '{"rdata":[]}'
+        with self.assertRaises(NoStreamsError):
+            self.plugin._php_fallback('UserName', None, php_message)
+        self.assertEqual(MyFreeCams.php_index, {})